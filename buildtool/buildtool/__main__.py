@@ -1,10 +1,11 @@
 from __future__ import annotations
 
 import os
+import time
 import traceback
 from json import loads
 from shutil import rmtree
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import click
 from cache import STATS
@@ -13,10 +14,15 @@ from colorama import Fore, Style
 from build_coordinator import run_build
 from build_worker import TIMINGS as BUILD_TIMINGS
 from common.cli_utils import pretty_print
+from daemon import Daemon, send_build_request
 from monitoring import enable_logging, enable_profiling
+from sandbox import COPY, SANDBOX_MODES
+from scheduling import CriticalPathQueue, TimingEstimates
 from state import BuildState
-from fs_utils import find_root, get_repo_files
+from fs_utils import find_root, get_repo_files, load_hash_index, save_hash_index
 from loader import config, load_rules, TIMINGS as LOAD_TIMINGS
+from tracing import enable_tracing, write_trace
+from transfer import configure_transfers
 from utils import BuildException
 from workspace_setup import initialize_workspace
 
@@ -37,6 +43,13 @@ def display_error(error: BuildException):
     is_flag=True,
     help="Show performance profiling data, cache hit rates, and log all executed commands.",
 )
+@click.option(
+    "--trace",
+    "trace_path",
+    default=None,
+    help="Write a timeline of the build to this path in the Chrome trace event format, "
+    "with a span for each stage of each rule on each worker. Open it in chrome://tracing or ui.perfetto.dev.",
+)
 @click.option(
     "--shell-log",
     "-s",
@@ -66,6 +79,20 @@ def display_error(error: BuildException):
     help="Disable the progress bars normally shown during a build. Does not affect the output of "
     "--locate or --profile, and errors will still be printed if the build fails.",
 )
+@click.option(
+    "--daemon",
+    default=False,
+    is_flag=True,
+    help="Run a long-lived build server that keeps rules, file hashes, and built targets in memory, "
+    "and watches the repo for changes. If targets are passed in, they are rebuilt whenever a file changes. "
+    "Install the watchdog package to avoid polling for changes.",
+)
+@click.option(
+    "--client",
+    default=False,
+    is_flag=True,
+    help="Send the targets to a running `buildtool --daemon` to build, rather than building them in this process.",
+)
 @click.option(
     "--skip-version-check",
     default=False,
@@ -98,6 +125,14 @@ def display_error(error: BuildException):
     default=8,
     help="The number of worker threads used in execution. Increase this number if using a remote build cache.",
 )
+@click.option(
+    "--processes",
+    "num_processes",
+    default=0,
+    help="The number of worker processes used to evaluate rule impls and hash their inputs. "
+    "By default, this is done on the worker threads, which are limited by the GIL. Requires fork(), "
+    "and rule impls must not rely on threads started before the build.",
+)
 @click.option(
     "--state-directory",
     default=".state",
@@ -110,6 +145,43 @@ def display_error(error: BuildException):
     "in as gs://bucket-name, it will be used alongside an .aux_cache local directory as a source for cached outputs. "
     "Override with the BUILDTOOL_CACHE_DIRECTORY environment variable.",
 )
+@click.option(
+    "--transfer-threads",
+    default=32,
+    help="The maximum number of concurrent uploads and downloads to a remote build cache, shared by all worker threads.",
+)
+@click.option(
+    "--pack-directories",
+    default=False,
+    is_flag=True,
+    help="Store each directory output in the build cache as a single compressed archive, rather than file by file. "
+    "This reduces the number of requests to a remote build cache, at the expense of deduplication.",
+)
+@click.option(
+    "--sandbox",
+    "sandbox_mode",
+    default=COPY,
+    type=click.Choice(SANDBOX_MODES),
+    help="How dependencies of rules with do_not_symlink set are placed in their sandbox. "
+    "`copy` uses copy-on-write clones where the filesystem supports them. "
+    "`link` uses hardlinks, which is faster, but a rule that modifies its dependencies in place will modify the repo. "
+    "`overlay` is like copy, but the directory dependencies of other rules are mirrored with a tree of symlinks, "
+    "so outputs written inside them stay in the sandbox.",
+)
+@click.option(
+    "--no-rule-cache",
+    default=False,
+    is_flag=True,
+    help="Execute every BUILD file, rather than reusing the targets they declared in previous runs. "
+    "Use this if a BUILD file imports Python modules other than through load(), since changes to them are not tracked.",
+)
+@click.option(
+    "--fast-hash",
+    default=False,
+    is_flag=True,
+    help="Use the non-cryptographic xxhash algorithm to detect changes to files, rather than md5. "
+    "Requires the xxhash package. Cache keys computed with and without this option are not shared.",
+)
 @click.option(
     "--flag",
     "-f",
@@ -122,32 +194,58 @@ def display_error(error: BuildException):
 def cli(
     targets: Tuple[str],
     profile: bool,
+    trace_path: Optional[str],
     shell_log: bool,
     locate: bool,
     verbose: bool,
     quiet: bool,
+    daemon: bool,
+    client: bool,
     skip_version_check: bool,
     skip_setup: bool,
     skip_build: bool,
     clean: bool,
     num_threads: int,
+    num_processes: int,
     state_directory: str,
     cache_directory: str,
+    transfer_threads: int,
+    pack_directories: bool,
+    sandbox_mode: str,
+    no_rule_cache: bool,
+    fast_hash: bool,
     flags: List[str],
 ):
     """
     This is a `make` alternative with a simpler syntax and some useful features.
     """
+    hash_index_loaded = False
+    if trace_path:
+        # resolved before we move to the repo root
+        trace_path = os.path.abspath(trace_path)
+        enable_tracing()
     try:
         repo_root = find_root()
         os.chdir(repo_root)
 
+        if client:
+            send_build_request(state_directory, list(targets))
+            pretty_print("✅", "Build succeeded.")
+            exit(0)
+
+        load_hash_index(state_directory, fast=fast_hash)
+        hash_index_loaded = True
+
         if verbose:
             enable_logging()
 
         if profile or shell_log:
             enable_profiling()
 
+        configure_transfers(
+            num_threads=transfer_threads, pack_directories=pack_directories
+        )
+
         flags = [flag.split("=", 1) + ["true"] for flag in flags]
         flags = {flag[0].lower(): loads(flag[1]) for flag in flags}
 
@@ -176,7 +274,25 @@ def cli(
                 quiet,
             )
 
-        target_rule_lookup = load_rules(flags, skip_version_check=skip_version_check)
+        if daemon:
+            if num_processes:
+                raise BuildException("--processes cannot be used with --daemon.")
+            Daemon(
+                repo_root=repo_root,
+                flags=flags,
+                skip_version_check=skip_version_check,
+                state_directory=state_directory,
+                cache_directory=cache_directory,
+                num_threads=num_threads,
+                sandbox_mode=sandbox_mode,
+                use_rule_cache=not no_rule_cache,
+            ).serve([target for target in targets if not target.startswith("setup:")])
+
+        target_rule_lookup = load_rules(
+            flags,
+            skip_version_check=skip_version_check,
+            state_directory=None if no_rule_cache else state_directory,
+        )
         target_rule_lookup.verify()
 
         all_files = get_repo_files()
@@ -215,7 +331,10 @@ def cli(
                 )
             exit(0)
 
+        build_time = 0
         if not skip_build:
+            timing_estimates = TimingEstimates.load(state_directory)
+            build_start_time = time.time()
             for _ in range(2 if clean else 1):
                 if clean:
                     for out_dir in config.output_directories:
@@ -231,11 +350,17 @@ def cli(
                         source_files=source_files,
                         cache_directory=cache_directory,
                         repo_root=repo_root,
+                        sandbox_mode=sandbox_mode,
+                        work_queue=CriticalPathQueue(timing_estimates.priority),
+                        timing_estimates=timing_estimates,
                     ),
                     [target for target in targets if not target.startswith("setup:")],
                     num_threads,
                     quiet,
+                    num_processes,
                 )
+            build_time = time.time() - build_start_time
+            timing_estimates.save(state_directory)
 
         if profile:
             print("Slow Rules (Execution Phase):")
@@ -244,6 +369,14 @@ def cli(
             )[:20]
             for key in slowest:
                 print(key, BUILD_TIMINGS[key])
+            if build_time:
+                print("Critical Path (Execution Phase):")
+                for key in timing_estimates.critical_path(BUILD_TIMINGS):
+                    print(key, BUILD_TIMINGS[key])
+                print(
+                    f"Achieved parallelism: {sum(BUILD_TIMINGS.values()) / build_time:.2f}x "
+                    f"with {num_threads} threads"
+                )
             print("Cache Statistics")
             print(
                 f"{STATS['hits']} cache hits, {STATS['misses']} cache misses, {STATS['inserts']} cache inserts (approx)"
@@ -256,6 +389,11 @@ def cli(
         display_error(BuildException("Internal error: " + repr(e)))
         print(f"\n{Style.RESET_ALL}" + traceback.format_exc())
         exit(1)
+    finally:
+        if hash_index_loaded:
+            save_hash_index(state_directory)
+        if trace_path:
+            write_trace(trace_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,173 @@
+import hashlib
+import os
+import stat
+import tarfile
+from contextlib import contextmanager
+from gzip import GzipFile
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Dict, Iterator, List, Tuple, Union
+from uuid import uuid4
+
+from fs_utils import clone_file
+
+BLOB_DIRECTORY = ".blobs"
+MANIFEST = ".manifest"
+
+# a file is recorded as [digest, mode]
+FileEntry = List[Union[str, int]]
+
+# maps each output of a rule to its FileEntry, or for directory outputs,
+# to a dict from paths relative to that directory to their FileEntry.
+# Packed directory outputs instead map to the FileEntry of a single archive
+Manifest = Dict[str, Union[FileEntry, Dict[str, FileEntry]]]
+
+
+def hash_contents(path) -> str:
+    # unlike hash_file, this is not memoized, since outputs can be rebuilt
+    state = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            state.update(chunk)
+    return state.hexdigest()
+
+
+def remote_blob_name(digest: str):
+    return f"{BLOB_DIRECTORY}/{digest}"
+
+
+class LocalBlobStore:
+    """
+    Stores files under the hash of their contents, so identical outputs
+    from different rules or cache keys are only stored once
+    """
+
+    def __init__(self, cache_directory: str):
+        self.root = Path(cache_directory).joinpath(BLOB_DIRECTORY)
+
+    def path(self, digest: str) -> Path:
+        return self.root.joinpath(digest[:2]).joinpath(digest)
+
+    def __contains__(self, digest: str):
+        return self.path(digest).exists()
+
+    @contextmanager
+    def stage(self, digest: str):
+        # the blob is written to a temporary path first, so a partially
+        # written blob is never visible to other workers
+        dest = self.path(digest)
+        os.makedirs(dest.parent, exist_ok=True)
+        temp = dest.with_name(f"{digest}.{uuid4().hex}.tmp")
+        try:
+            yield str(temp)
+            os.replace(temp, dest)
+        finally:
+            if temp.exists():
+                temp.unlink()
+
+    def insert(self, src, digest: str):
+        with self.stage(digest) as temp:
+            clone_file(src, temp)
+
+    def materialize(self, digest: str, mode: int, dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.islink(dest):
+            os.unlink(dest)
+        clone_file(self.path(digest), dest)
+        os.chmod(dest, mode)
+
+
+def pack_directory(src: Path, dest: str):
+    # archives must be reproducible, so identical directories share a blob
+    def normalize(info: tarfile.TarInfo):
+        info.mtime = 0
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        return info
+
+    with open(dest, "wb") as f, GzipFile(fileobj=f, mode="wb", mtime=0) as zipped:
+        with tarfile.open(fileobj=zipped, mode="w", dereference=True) as archive:
+            for path, subdirs, files in os.walk(src):
+                subdirs.sort()
+                for name in sorted(files):
+                    target = Path(path).joinpath(name)
+                    archive.add(
+                        target, arcname=str(target.relative_to(src)), filter=normalize
+                    )
+
+
+def unpack_directory(src, dest):
+    with tarfile.open(src, mode="r:gz") as archive:
+        for member in archive:
+            # the normalized mtimes should not be restored, only the modes
+            archive.extract(member, dest, set_attrs=False)
+            os.chmod(Path(dest).joinpath(member.name), member.mode)
+
+
+@contextmanager
+def scan_outputs(output_root: str, outputs, *, pack_directories: bool = False):
+    """
+    Hash the outputs of a rule, yielding its manifest and a location
+    from which each referenced blob can be read
+    """
+    manifest: Manifest = {}
+    sources: Dict[str, Path] = {}
+
+    def scan(path: Path) -> FileEntry:
+        digest = hash_contents(path)
+        sources.setdefault(digest, path)
+        return [digest, stat.S_IMODE(os.stat(path).st_mode)]
+
+    with TemporaryDirectory() as archive_root:
+        for i, output in enumerate(outputs):
+            src = Path(output_root).joinpath(output)
+            if output.endswith("/") and pack_directories:
+                archive = Path(archive_root).joinpath(str(i))
+                pack_directory(src, archive)
+                manifest[output] = scan(archive)
+            elif output.endswith("/"):
+                entries = {}
+                for path, subdirs, files in os.walk(src):
+                    for name in files:
+                        target = Path(path).joinpath(name)
+                        entries[str(target.relative_to(src))] = scan(target)
+                manifest[output] = entries
+            else:
+                manifest[output] = scan(src)
+
+        yield manifest, sources
+
+
+def is_packed(output: str, entry) -> bool:
+    return output.endswith("/") and isinstance(entry, list)
+
+
+def manifest_digests(manifest: Manifest) -> Iterator[str]:
+    for output, entry in manifest.items():
+        if output.endswith("/") and not is_packed(output, entry):
+            for digest, mode in entry.values():
+                yield digest
+        else:
+            digest, mode = entry
+            yield digest
+
+
+def manifest_files(manifest: Manifest) -> Iterator[Tuple[str, str, int]]:
+    # yields (path relative to the output root, digest, mode) for every unpacked file
+    for output, entry in manifest.items():
+        if is_packed(output, entry):
+            continue
+        elif output.endswith("/"):
+            for name, (digest, mode) in entry.items():
+                yield str(Path(output).joinpath(name)), digest, mode
+        else:
+            digest, mode = entry
+            yield output, digest, mode
+
+
+def manifest_archives(manifest: Manifest) -> Iterator[Tuple[str, str]]:
+    # yields (directory output, digest) for every packed directory
+    for output, entry in manifest.items():
+        if is_packed(output, entry):
+            digest, mode = entry
+            yield output, digest
@@ -3,11 +3,29 @@ from typing import List
 
 from build_worker import worker
 from monitoring import create_status_monitor
+from process_pool import ProcessEvaluator
 from state import BuildState
 from utils import BuildException
 
 
 def run_build(
+    build_state: BuildState,
+    targets: List[str],
+    num_threads: int,
+    quiet: bool,
+    num_processes: int = 0,
+):
+    if num_processes:
+        # must be forked before any other threads are started
+        build_state.deps_evaluator = ProcessEvaluator(build_state, num_processes)
+    try:
+        run_workers(build_state, targets, num_threads, quiet)
+    finally:
+        if build_state.deps_evaluator is not None:
+            build_state.deps_evaluator.stop()
+
+
+def run_workers(
     build_state: BuildState, targets: List[str], num_threads: int, quiet: bool
 ):
     build_state.status_monitor = create_status_monitor(num_threads, quiet)
@@ -16,6 +34,9 @@ def run_build(
         root_rule = build_state.target_rule_lookup.try_lookup(
             target
         ) or build_state.target_rule_lookup.lookup(build_state, ":" + target)
+        if root_rule in build_state.ready:
+            # already built, and still up to date
+            continue
         build_state.scheduled_but_not_ready.add(root_rule)
         build_state.work_queue.put(root_rule)
         build_state.status_monitor.move(total=1)
@@ -27,11 +48,12 @@ def run_build(
         thread.start()
     build_state.work_queue.join()
 
+    for _ in range(num_threads):
+        build_state.work_queue.put(None)
+
     if build_state.failure is not None:
         raise build_state.failure
 
-    for _ in range(num_threads):
-        build_state.work_queue.put(None)
     for thread in thread_instances:
         thread.join()
 
@@ -3,7 +3,6 @@ import traceback
 from collections import defaultdict
 from pathlib import Path
 from queue import Empty, Queue
-from shutil import rmtree
 from subprocess import CalledProcessError
 
 from cache import make_cache_fetcher, make_cache_memorize
@@ -11,7 +10,9 @@ from colorama import Style
 from execution import build
 from monitoring import log
 from preview_execution import get_deps
-from state import BuildState
+from sandbox import Sandbox
+from state import BuildState, Rule
+from tracing import name_thread, record_span, span, timestamp
 from utils import BuildException, MissingDependency
 from work_queue import enqueue_deps
 
@@ -27,14 +28,25 @@ def clear_queue(queue: Queue):
         queue.task_done()
 
 
+def evaluate_deps(build_state: BuildState, rule: Rule):
+    if build_state.deps_evaluator is not None:
+        return build_state.deps_evaluator.get_deps(build_state, rule)
+    return get_deps(build_state, rule)
+
+
 def worker(build_state: BuildState, index: int):
-    scratch_path = Path(build_state.repo_root).joinpath(Path(f".scratch_{index}"))
-    if scratch_path.exists():
-        rmtree(scratch_path, ignore_errors=True)
+    # reused by every rule run on this worker, and only cleaned up once the build succeeds
+    sandbox = Sandbox(
+        build_state.repo_root,
+        Path(build_state.repo_root).joinpath(Path(f".scratch_{index}")),
+        build_state.sandbox_mode,
+    )
 
     _, cache_save = make_cache_memorize(build_state.cache_directory)
     _, cache_loader = make_cache_fetcher(build_state.cache_directory)
 
+    name_thread(f"worker {index}")
+
     while True:
         if build_state.failure is not None:
             # every thread needs to clear the queue since otherwise some other thread might still be filling it up
@@ -42,9 +54,11 @@ def worker(build_state: BuildState, index: int):
             return  # some thread has failed, emergency stop
         todo = build_state.work_queue.get()
         if todo is None:
+            sandbox.destroy()
             return
 
         start_time = time.time()
+        trace_start_time = timestamp()
 
         try:
             build_state.status_monitor.update(index, "Parsing: " + str(todo))
@@ -52,7 +66,13 @@ def worker(build_state: BuildState, index: int):
             log(f"Target {todo} popped from queue by worker {index}")
 
             # only from caches, will never run a subprocess
-            cache_key, deps, uses_dynamic_deps = get_deps(build_state, todo)
+            with span("parse", "parse", rule=str(todo)):
+                cache_key, deps, uses_dynamic_deps = evaluate_deps(build_state, todo)
+            build_state.dependencies[todo] = deps
+            if build_state.timing_estimates is not None:
+                build_state.timing_estimates.record_dependencies(
+                    build_state, todo, deps
+                )
 
             if uses_dynamic_deps:
                 log("Target", todo, "Uses dynamic deps")
@@ -81,7 +101,9 @@ def worker(build_state: BuildState, index: int):
                 done = False
                 # check if we're already cached!
                 if cache_key:
-                    if cache_loader(cache_key, todo, build_state.repo_root):
+                    with span("cache lookup", "cache", rule=str(todo)):
+                        loaded = cache_loader(cache_key, todo, build_state.repo_root)
+                    if loaded:
                         log(f"Target {todo} was loaded from the cache")
                         done = True
 
@@ -91,6 +113,7 @@ def worker(build_state: BuildState, index: int):
                     # we don't care since *our* dependencies (so far) are all available
                     log(f"Target {todo} is not in the cache, rerunning...")
                     build_state.status_monitor.update(index, "Building: " + str(todo))
+                    build_start_time = time.time()
                     try:
                         # if cache_key is None, we haven't finished evaluating the impl, so we
                         # don't know all the dependencies it could need. Therefore, we must
@@ -108,16 +131,20 @@ def worker(build_state: BuildState, index: int):
                                 f"so we are running the impl in the root directory to find out!"
                             )
                             cache_key = build(
-                                build_state, todo, todo.deps, scratch_path=None
+                                build_state, todo, todo.deps, sandbox=None
                             )
                             # now, if no exception has thrown, all the deps are available to the deps finder
-                            alt_cache_key, deps, _ = get_deps(build_state, todo)
+                            with span("parse", "parse", rule=str(todo)):
+                                alt_cache_key, deps, _ = evaluate_deps(
+                                    build_state, todo
+                                )
+                            build_state.dependencies[todo] = deps
                             try:
                                 alt_cache_key_2 = build(
                                     build_state,
                                     todo,
                                     deps,
-                                    scratch_path=scratch_path,
+                                    sandbox=sandbox,
                                 )
                             except MissingDependency:
                                 raise BuildException("An internal error has occurred.")
@@ -136,11 +163,16 @@ def worker(build_state: BuildState, index: int):
                             log(
                                 f"We know all the dependencies of {todo}, so we can run it in a sandbox"
                             )
-                            build(build_state, todo, deps, scratch_path=scratch_path)
+                            build(build_state, todo, deps, sandbox=sandbox)
                         log(f"Target {todo} has been built fully!")
-                        cache_save(cache_key, todo, scratch_path)
+                        with span("cache save", "cache", rule=str(todo)):
+                            cache_save(cache_key, todo, sandbox.root)
 
                         done = True
+                        if build_state.timing_estimates is not None:
+                            build_state.timing_estimates.record_execution(
+                                todo, time.time() - build_start_time
+                            )
                     except MissingDependency as d:
                         log(
                             f"Target {todo} failed to fully build because of the missing dynamic "
@@ -153,12 +185,10 @@ def worker(build_state: BuildState, index: int):
                             build_state.work_queue.put(todo)
                             build_state.status_monitor.move(total=1)
 
-                    if scratch_path.exists():
-                        rmtree(scratch_path, ignore_errors=True)
-
                 if done:
                     with build_state.scheduling_lock:
                         build_state.ready.add(todo)
+                        build_state.ready_log.append(todo)
                         # no one will ever add us back, since we are in `ready`
                         build_state.scheduled_but_not_ready.remove(todo)
                         # now it's time to set up our dependents
@@ -178,6 +208,7 @@ def worker(build_state: BuildState, index: int):
             # record timing data
             run_time = time.time() - start_time
             TIMINGS[str(todo)] += run_time
+            record_span(str(todo), "rule", trace_start_time, worker=index)
         except Exception as e:
             if not isinstance(e, BuildException):
                 suffix = f"\n{Style.RESET_ALL}" + traceback.format_exc()
@@ -1,14 +1,28 @@
-import hashlib
 import os
-import traceback
-from os.path import dirname
+from functools import partial
+from json import dumps, loads
 from pathlib import Path
-from typing import Iterator
-
-from fs_utils import copy_helper, hash_file
+from threading import Lock
+
+from blob_store import (
+    LocalBlobStore,
+    MANIFEST,
+    Manifest,
+    manifest_archives,
+    manifest_digests,
+    manifest_files,
+    remote_blob_name,
+    scan_outputs,
+    unpack_directory,
+)
 from google.cloud.exceptions import NotFound
-from google.cloud.storage import Blob
 from state import Rule
+from tracing import counter
+from transfer import (
+    config as transfer_config,
+    get_bucket as get_remote_bucket,
+    run_transfers,
+)
 from utils import BuildException, CacheMiss
 
 CLOUD_BUCKET_PREFIX = "gs://"
@@ -16,17 +30,35 @@ AUX_CACHE = ".aux_cache"
 
 STATS = dict(hits=0, misses=0, inserts=0)
 
+# bytes of blobs read from and written to the cache
+TRANSFERRED = dict(read=0, written=0)
+transfer_lock = Lock()
+
+
+def reset_transfer_lock():
+    # a transfer thread may have held the lock when this process was forked
+    global transfer_lock
+    transfer_lock = Lock()
+
+
+os.register_at_fork(after_in_child=reset_transfer_lock)
+
+
+def record_transfer(**sizes: int):
+    with transfer_lock:
+        for key, size in sizes.items():
+            TRANSFERRED[key] += size
+        counter("cache bytes", **TRANSFERRED)
+
 
 def get_bucket(cache_directory: str):
     if cache_directory.startswith(CLOUD_BUCKET_PREFIX):
-        from google.cloud import storage
-
-        client = storage.Client()
-        return client.bucket(cache_directory[len(CLOUD_BUCKET_PREFIX) :])
+        return get_remote_bucket(cache_directory[len(CLOUD_BUCKET_PREFIX) :])
 
 
 def make_cache_fetcher(cache_directory: str, *, is_aux=False):
     bucket = get_bucket(cache_directory)
+    blobs = LocalBlobStore(AUX_CACHE if bucket else cache_directory)
     delta = 1 if not is_aux else 0
 
     def cache_fetcher(state: str, target: str) -> str:
@@ -59,72 +91,55 @@ def make_cache_fetcher(cache_directory: str, *, is_aux=False):
                 raise CacheMiss
 
     def cache_loader(cache_key: str, rule: Rule, dest_root: str) -> bool:
-        cache_location, cache_paths = get_cache_output_paths(
-            cache_directory, rule, cache_key
-        )
-        if bucket:
-            del cache_location
-            if not aux_loader(cache_key, rule, dest_root):
-                try:
-                    cache_fetcher(cache_key, ".touch")
-                except CacheMiss:
-                    STATS["misses"] += delta
-                    return False
-                for src_name, cache_path in zip(rule.outputs, cache_paths):
-                    cache_path = str(Path(cache_key).joinpath(cache_path))
-                    os.makedirs(dest_root, exist_ok=True)
-                    try:
-                        if src_name.endswith("/"):
-                            os.makedirs(
-                                Path(dest_root).joinpath(src_name), exist_ok=True
-                            )
-                            blobs: Iterator[Blob] = list(
-                                bucket.list_blobs(prefix=cache_path)
-                            )
-                            for blob in blobs:
-                                target = str(
-                                    Path(dest_root)
-                                    .joinpath(src_name)
-                                    .joinpath(blob.name[len(cache_path) + 1 :])
-                                )
-                                os.makedirs(dirname(target), exist_ok=True)
-                                blob.download_to_filename(target)
-                                STATS["hits"] += delta
-                        else:
-                            target = str(Path(dest_root).joinpath(src_name))
-                            os.makedirs(dirname(target), exist_ok=True)
-                            bucket.blob(cache_path).download_to_filename(target)
-                            STATS["hits"] += delta
-                    except NotFound:
-                        STATS["misses"] += delta
-                        return False
-                # now that we have fetched, let's cache it on disk
-                aux_save(cache_key, rule, dest_root)
-            return True
-        else:
-            if not os.path.exists(cache_location):
-                STATS["misses"] += delta
-                return False
-            try:
-                copy_helper(
-                    src_root=cache_location,
-                    src_names=cache_paths,
-                    dest_root=dest_root,
-                    dest_names=rule.outputs,
-                )
-                STATS["hits"] += delta
-            except FileNotFoundError:
-                raise BuildException(
-                    "Cache corrupted. This should never happen unless you modified the cache "
-                    "directory manually! If so, delete the cache directory and try again."
+        try:
+            manifest: Manifest = loads(cache_fetcher(cache_key, MANIFEST))
+        except CacheMiss:
+            return False
+
+        for output in manifest:
+            if output.endswith("/"):
+                os.makedirs(Path(dest_root).joinpath(output), exist_ok=True)
+
+        missing = {
+            digest for digest in manifest_digests(manifest) if digest not in blobs
+        }
+        if missing and not bucket:
+            raise BuildException(
+                "Cache corrupted. This should never happen unless you modified the cache "
+                "directory manually! If so, delete the cache directory and try again."
+            )
+
+        def download(digest: str):
+            with blobs.stage(digest) as temp:
+                bucket.blob(remote_blob_name(digest)).download_to_filename(temp)
+                record_transfer(read=os.path.getsize(temp))
+
+        try:
+            run_transfers([partial(download, digest) for digest in missing])
+        except NotFound:
+            STATS["misses"] += delta
+            return False
+
+        for path, digest, mode in manifest_files(manifest):
+            blobs.materialize(digest, mode, Path(dest_root).joinpath(path))
+        if not bucket:
+            record_transfer(
+                read=sum(
+                    os.path.getsize(blobs.path(digest))
+                    for digest in manifest_digests(manifest)
                 )
-            return True
+            )
+        for output, digest in manifest_archives(manifest):
+            unpack_directory(blobs.path(digest), Path(dest_root).joinpath(output))
+
+        return True
 
     return cache_fetcher, cache_loader
 
 
 def make_cache_memorize(cache_directory: str, *, is_aux=False):
     bucket = get_bucket(cache_directory)
+    blobs = LocalBlobStore(AUX_CACHE if bucket else cache_directory)
     delta = 1 if not is_aux else 0
 
     def memorize(state: str, target: str, data: str):
@@ -144,87 +159,30 @@ def make_cache_memorize(cache_directory: str, *, is_aux=False):
             cache_target.write_text(data)
 
     def save(cache_key: str, rule: Rule, output_root: str):
-        cache_location, cache_paths = get_cache_output_paths(
-            cache_directory, rule, cache_key
-        )
-
-        memorize(cache_key, ".touch", "")
-
-        if bucket:
-            del cache_location  # just to be safe
-
-            for src_name, cache_path in zip(rule.outputs, cache_paths):
-                if src_name.endswith("/"):
-                    dir_root = Path(output_root).joinpath(src_name)
-                    for path, subdirs, files in os.walk(dir_root):
-                        path = os.path.relpath(path, dir_root)
-                        for name in files:
-                            #               output_root -> src_name/ -> [path -> name]
-                            # <cache_base> -> cache_key -> cache_path -> [path -> name]
-                            target = Path(path).joinpath(name)
-                            src_loc = (
-                                Path(output_root).joinpath(src_name).joinpath(target)
-                            )
-                            aux_cache_loc = (
-                                Path(AUX_CACHE)
-                                .joinpath(cache_key)
-                                .joinpath(cache_path)
-                                .joinpath(target)
-                            )
-                            if not os.path.exists(aux_cache_loc) or (
-                                hash_file(src_loc) != hash_file(aux_cache_loc)
-                            ):
-                                STATS["inserts"] += delta
-                                bucket.blob(
-                                    str(
-                                        Path(cache_key)
-                                        .joinpath(cache_path)
-                                        .joinpath(target)
-                                    )
-                                ).upload_from_filename(str(src_loc))
-                else:
-                    #                 output_root -> src_name
-                    # <cache_base> -> cache_key -> cache_path
-
-                    target = Path(output_root).joinpath(src_name)
-                    aux_cache_loc = (
-                        Path(AUX_CACHE).joinpath(cache_key).joinpath(cache_path)
-                    )
-                    if not os.path.exists(aux_cache_loc) or (
-                        hash_file(target) != hash_file(aux_cache_loc)
-                    ):
-                        STATS["inserts"] += delta
-                        bucket.blob(
-                            str(Path(cache_key).joinpath(cache_path)),
-                        ).upload_from_filename(
-                            str(Path(output_root).joinpath(src_name)),
-                        )
-
-            aux_save(cache_key, rule, output_root)
-
-        else:
-            STATS["inserts"] += delta
-            copy_helper(
-                src_root=output_root,
-                src_names=rule.outputs,
-                dest_root=cache_location,
-                dest_names=cache_paths,
-            )
+        with scan_outputs(
+            output_root,
+            rule.outputs,
+            pack_directories=transfer_config.pack_directories,
+        ) as (manifest, sources):
+            # identical contents may already have been saved, by this or any other rule
+            missing = [digest for digest in sources if digest not in blobs]
+            STATS["inserts"] += delta * len(missing)
+
+            def upload(digest: str):
+                src = sources[digest]
+                if bucket:
+                    bucket.blob(remote_blob_name(digest)).upload_from_filename(str(src))
+                # in a bucket, the local copy is only written once the upload succeeds
+                blobs.insert(src, digest)
+                record_transfer(written=os.path.getsize(src))
+
+            run_transfers([partial(upload, digest) for digest in missing])
+
+        # the manifest is written last, so its presence implies that all its blobs are available
+        memorize(cache_key, MANIFEST, dumps(manifest, sort_keys=True))
 
     return memorize, save
 
 
-def get_cache_output_paths(cache_directory: str, rule: Rule, cache_key: str):
-    cache_location = Path(cache_directory).joinpath(cache_key)
-    keys = [
-        hashlib.md5(output_path.encode("utf-8")).hexdigest()
-        for output_path in rule.outputs
-    ]
-    for i, (output_path, key) in enumerate(zip(rule.outputs, keys)):
-        if output_path.endswith("/"):
-            keys[i] += "/"
-    return cache_location, keys
-
-
-aux_fetcher, aux_loader = make_cache_fetcher(AUX_CACHE, is_aux=True)
-aux_memorize, aux_save = make_cache_memorize(AUX_CACHE, is_aux=True)
+aux_fetcher, _ = make_cache_fetcher(AUX_CACHE, is_aux=True)
+aux_memorize, _ = make_cache_memorize(AUX_CACHE, is_aux=True)
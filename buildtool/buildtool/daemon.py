@@ -0,0 +1,356 @@
+from __future__ import annotations
+
+import json
+import os
+import socket
+import time
+import traceback
+from pathlib import Path
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Optional, Set
+
+from build_coordinator import run_build
+from cache import AUX_CACHE
+from colorama import Fore, Style
+from common.cli_utils import pretty_print
+from common.shell_utils import sh
+from fs_utils import get_repo_files, hash_file, save_hash_index
+from loader import LOAD_DEPENDENCIES, LOAD_FRAME_CACHE, config, load_rules
+from monitoring import log
+from scheduling import CriticalPathQueue, TimingEstimates
+from state import (
+    BuildState,
+    Rule,
+    SourceFileLookup,
+    TargetLookup,
+    parent_directories,
+)
+from utils import BuildException
+
+SOCKET_NAME = "daemon.sock"
+
+# how long to wait for more changes before rebuilding
+DEBOUNCE_INTERVAL = 0.05
+POLL_INTERVAL = 1
+
+
+def get_socket_path(state_directory: str):
+    return str(Path(state_directory).joinpath(SOCKET_NAME))
+
+
+class Daemon:
+    """
+    Keeps the rule graph, file hashes, and the set of ready rules in memory between builds,
+    invalidating only the rules affected by each changed file.
+    """
+
+    def __init__(
+        self,
+        *,
+        repo_root: str,
+        flags: Dict[str, object],
+        skip_version_check: bool,
+        state_directory: str,
+        cache_directory: str,
+        num_threads: int,
+        sandbox_mode: str,
+        use_rule_cache: bool,
+    ):
+        self.repo_root = repo_root
+        self.flags = flags
+        self.skip_version_check = skip_version_check
+        self.state_directory = state_directory
+        self.cache_directory = cache_directory
+        self.num_threads = num_threads
+        self.sandbox_mode = sandbox_mode
+        self.use_rule_cache = use_rule_cache
+
+        self.build_lock = Lock()
+        self.changes_lock = Lock()
+        self.changed = Event()
+        self.changed_paths: Set[str] = set()
+        self.files_added_or_removed = False
+
+        self.timing_estimates = TimingEstimates.load(state_directory)
+        self.load()
+
+    def load(self):
+        get_repo_files.cache_clear()
+        LOAD_FRAME_CACHE.clear()
+        LOAD_DEPENDENCIES.clear()
+        self.target_rule_lookup: TargetLookup = load_rules(
+            self.flags,
+            skip_version_check=self.skip_version_check,
+            state_directory=self.state_directory if self.use_rule_cache else None,
+        )
+        self.target_rule_lookup.verify()
+        self.source_files: SourceFileLookup = self.target_rule_lookup.find_source_files(
+            get_repo_files()
+        )
+        # rules are recreated on every load, so none of them are ready
+        self.ready: Set[Rule] = set()
+        self.dependencies: Dict[Rule, List[str]] = {}
+
+    def is_ignored(self, path: str):
+        root = path.split(os.sep)[0]
+        return (
+            root in (".git", AUX_CACHE, self.state_directory, self.cache_directory)
+            or root.startswith(".scratch_")
+            # outputs are rewritten by the builds themselves
+            or self.target_rule_lookup.declares(path)
+        )
+
+    def notify(self, path: str, *, added_or_removed: bool):
+        path = os.path.relpath(path, self.repo_root)
+        if path.startswith("..") or self.is_ignored(path):
+            return
+        with self.changes_lock:
+            self.changed_paths.add(path)
+            self.files_added_or_removed |= added_or_removed
+        self.changed.set()
+
+    def apply_changes(self):
+        with self.changes_lock:
+            changed_paths = self.changed_paths
+            files_added_or_removed = self.files_added_or_removed
+            self.changed_paths = set()
+            self.files_added_or_removed = False
+        if not changed_paths:
+            return
+
+        log(f"Files changed: {changed_paths}")
+
+        if "WORKSPACE" in changed_paths:
+            pretty_print(
+                "⚠️", "The WORKSPACE has changed, restart the daemon to apply it."
+            )
+
+        for path in changed_paths:
+            hash_file.cache.pop(path, None)
+
+        if changed_paths & self.target_rule_lookup.rules_files:
+            log("BUILD or rules files changed, reloading all rules")
+            self.load()
+            return
+
+        if files_added_or_removed:
+            get_repo_files.cache_clear()
+            source_files = self.target_rule_lookup.find_source_files(get_repo_files())
+            if source_files.tracked_files != self.source_files.tracked_files:
+                # the results of find() may have changed
+                log("Source files added or removed, reloading all rules")
+                self.load()
+                return
+
+        self.invalidate(changed_paths)
+
+    def invalidate(self, changed_paths: Set[str]):
+        file_dependents: Dict[str, Set[Rule]] = {}
+        rule_dependents: Dict[Rule, Set[Rule]] = {}
+        for rule, deps in self.dependencies.items():
+            for dep in deps:
+                file_dependents.setdefault(dep, set()).add(rule)
+                dep_rule = self.target_rule_lookup.try_lookup(dep)
+                if dep_rule is not None:
+                    rule_dependents.setdefault(dep_rule, set()).add(rule)
+
+        stale = set()
+        frontier = []
+        for path in changed_paths:
+            # rules can depend on a file directly, or on a directory containing it
+            for dep in [path, *parent_directories(path)]:
+                frontier.extend(file_dependents.get(dep, ()))
+        while frontier:
+            rule = frontier.pop()
+            if rule not in stale:
+                stale.add(rule)
+                frontier.extend(rule_dependents.get(rule, ()))
+
+        log(f"Invalidating rules: {list(map(str, stale))}")
+        self.ready -= stale
+
+        # the outputs of stale rules will be rebuilt, so their hashes are no longer locked in
+        outputs = [output for rule in stale for output in rule.outputs]
+        for path in list(hash_file.cache):
+            if any(
+                path == output or (output.endswith("/") and path.startswith(output))
+                for output in outputs
+            ):
+                del hash_file.cache[path]
+
+    def build(self, targets: List[str]):
+        with self.build_lock:
+            start_time = time.time()
+            self.apply_changes()
+            if not targets:
+                if config.default_build_rule is None:
+                    raise BuildException(
+                        "No target provided, and no default target set."
+                    )
+                targets = [config.default_build_rule]
+
+            for rule in set(self.target_rule_lookup.direct_lookup.values()) | set(
+                self.target_rule_lookup.location_lookup.values()
+            ):
+                rule.pending_rule_dependencies = set()
+                rule.runtime_dependents = set()
+
+            try:
+                run_build(
+                    BuildState(
+                        target_rule_lookup=self.target_rule_lookup,
+                        source_files=self.source_files,
+                        cache_directory=self.cache_directory,
+                        repo_root=self.repo_root,
+                        sandbox_mode=self.sandbox_mode,
+                        ready=self.ready,
+                        dependencies=self.dependencies,
+                        work_queue=CriticalPathQueue(self.timing_estimates.priority),
+                        timing_estimates=self.timing_estimates,
+                    ),
+                    targets,
+                    self.num_threads,
+                    True,
+                )
+            finally:
+                save_hash_index(self.state_directory)
+                self.timing_estimates.save(self.state_directory)
+            return time.time() - start_time
+
+    def serve(self, targets: List[str]):
+        """
+        Accept builds from clients, and if targets were provided, rebuild them whenever files change
+        """
+        start_watching(self.repo_root, self.notify)
+
+        socket_path = get_socket_path(self.state_directory)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = DaemonServer(socket_path, self)
+        Thread(target=server.serve_forever, daemon=True).start()
+        pretty_print("👀", f"Buildtool daemon listening on {socket_path}")
+
+        try:
+            while True:
+                if targets:
+                    report(lambda: self.build(targets))
+                self.changed.wait()
+                # wait for a burst of changes (e.g. a git checkout) to settle
+                while self.changed.is_set():
+                    self.changed.clear()
+                    time.sleep(DEBOUNCE_INTERVAL)
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+
+
+def report(build: Callable[[], float]) -> Optional[str]:
+    try:
+        elapsed = build()
+    except BuildException as e:
+        print(Fore.RED)
+        pretty_print("🚫", "Build failed.")
+        print(Style.BRIGHT)
+        print(e)
+        print(Style.RESET_ALL)
+        return str(e)
+    except Exception as e:
+        # a bug in a rule or in buildtool must not take down the daemon, which keeps watching
+        print(Fore.RED)
+        pretty_print("🚫", "Build failed with an internal error.")
+        print(Style.RESET_ALL)
+        traceback.print_exc()
+        return "Internal error: " + repr(e)
+    else:
+        pretty_print("✅", f"Build succeeded in {elapsed:.3f}s.")
+
+
+class DaemonRequestHandler(StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        error = report(lambda: self.server.buildtool_daemon.build(request["targets"]))
+        self.wfile.write(json.dumps(dict(error=error)).encode("utf-8") + b"\n")
+
+
+class DaemonServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, daemon: Daemon):
+        super().__init__(socket_path, DaemonRequestHandler)
+        self.buildtool_daemon = daemon
+
+
+def send_build_request(state_directory: str, targets: List[str]):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(get_socket_path(state_directory))
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise BuildException(
+                "Unable to connect to the buildtool daemon - start one with `buildtool --daemon`."
+            )
+        conn.sendall(json.dumps(dict(targets=targets)).encode("utf-8") + b"\n")
+        response = json.loads(conn.makefile().readline())
+    if response["error"] is not None:
+        raise BuildException(response["error"])
+
+
+def start_watching(repo_root: str, notify: Callable[..., None]):
+    try:
+        from watchdog.events import FileSystemEventHandler
+        from watchdog.observers import Observer
+    except ImportError:
+        pretty_print(
+            "⚠️",
+            "The watchdog package is not installed, so falling back to polling for changes.",
+        )
+        Thread(target=poll, args=(repo_root, notify), daemon=True).start()
+        return
+
+    class Handler(FileSystemEventHandler):
+        def on_any_event(self, event):
+            added_or_removed = event.event_type in ("created", "deleted", "moved")
+            if event.is_directory and not added_or_removed:
+                return
+            notify(event.src_path, added_or_removed=added_or_removed)
+            if getattr(event, "dest_path", None):
+                notify(event.dest_path, added_or_removed=added_or_removed)
+
+    observer = Observer()
+    observer.schedule(Handler(), repo_root, recursive=True)
+    observer.daemon = True
+    observer.start()
+
+
+def poll(repo_root: str, notify: Callable[..., None]):
+    def snapshot():
+        files = sh(
+            "git",
+            "ls-files",
+            "--cached",
+            "--others",
+            "--exclude-standard",
+            capture_output=True,
+            quiet=True,
+            cwd=repo_root,
+        ).splitlines()
+        out = {}
+        for file in files:
+            file = file.decode("utf-8")
+            try:
+                stat = os.stat(Path(repo_root).joinpath(file))
+            except FileNotFoundError:
+                continue
+            out[file] = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        return out
+
+    prev = snapshot()
+    while True:
+        time.sleep(POLL_INTERVAL)
+        curr = snapshot()
+        for file in curr.keys() ^ prev.keys():
+            notify(str(Path(repo_root).joinpath(file)), added_or_removed=True)
+        for file in curr.keys() & prev.keys():
+            if curr[file] != prev[file]:
+                notify(str(Path(repo_root).joinpath(file)), added_or_removed=False)
+        prev = curr
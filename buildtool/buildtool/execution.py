@@ -11,9 +11,11 @@ from colorama import Style
 from cache import make_cache_memorize
 from common.shell_utils import sh as run_shell
 from context import Env, MemorizeContext
-from fs_utils import copy_helper, hash_file
+from fs_utils import hash_file
 from monitoring import log
+from sandbox import Sandbox
 from state import BuildState, Rule
+from tracing import span
 from utils import BuildException, MissingDependency
 from common.hash_utils import HashState
 
@@ -61,15 +63,16 @@ class ExecutionContext(MemorizeContext):
     def run_shell_queue(self):
         for cmd, cwd, env in self.sh_queue:
             log("RUNNING cmd:", cmd)
-            run_shell(
-                cmd,
-                shell=True,
-                cwd=cwd,
-                quiet=True,
-                capture_output=True,
-                inherit_env=False,
-                env=env,
-            )
+            with span(cmd, "sh", cwd=str(cwd)):
+                run_shell(
+                    cmd,
+                    shell=True,
+                    cwd=cwd,
+                    quiet=True,
+                    capture_output=True,
+                    inherit_env=False,
+                    env=env,
+                )
         self.sh_queue = []
 
     def add_deps(self, deps: Sequence[str]):
@@ -92,15 +95,16 @@ class ExecutionContext(MemorizeContext):
                 return f.read()
         else:
             log("RUNNING", sh)
-            out = run_shell(
-                sh,
-                shell=True,
-                cwd=self.cwd,
-                capture_output=True,
-                quiet=True,
-                inherit_env=False,
-                env=self.normalize(env),
-            ).decode("utf-8")
+            with span(sh, "sh", cwd=str(self.cwd)):
+                out = run_shell(
+                    sh,
+                    shell=True,
+                    cwd=self.cwd,
+                    capture_output=True,
+                    quiet=True,
+                    inherit_env=False,
+                    env=self.normalize(env),
+                ).decode("utf-8")
             self.memorize(state, HashState().record(sh, env).state(), out)
             return out
 
@@ -110,7 +114,7 @@ def build(
     rule: Rule,
     deps: Collection[str],
     *,
-    scratch_path: Optional[Path],
+    sandbox: Optional[Sandbox],
 ):
     """
     All the dependencies that can be determined from caches have been
@@ -119,7 +123,8 @@ def build(
     """
     cache_memorize, _ = make_cache_memorize(build_state.cache_directory)
 
-    in_sandbox = scratch_path is not None
+    in_sandbox = sandbox is not None
+    scratch_path = sandbox.root if in_sandbox else None
 
     loaded_deps = set()
 
@@ -134,15 +139,16 @@ def build(
                     missing_deps.append(dep)
         if missing_deps:
             raise MissingDependency(*missing_deps)
+        first_load = not loaded_deps
         loaded_deps.update(deps)
         if in_sandbox:
             log(f"Loading dependencies {deps} into sandbox")
-            copy_helper(
-                src_root=build_state.repo_root,
-                dest_root=scratch_path,
-                src_names=[dep for dep in deps if not dep.startswith(":")],
-                symlink=not rule.do_not_symlink,
-            )
+            with span("sandbox sync", "sandbox", rule=str(rule)):
+                # the first load also clears out whatever the previous rule left behind
+                (sandbox.sync if first_load else sandbox.load)(
+                    [dep for dep in deps if not dep.startswith(":")],
+                    symlink=not rule.do_not_symlink,
+                )
 
     load_deps(deps)
     hashstate = HashState()
@@ -191,11 +197,8 @@ def build(
 
     if in_sandbox:
         try:
-            copy_helper(
-                src_root=scratch_path,
-                src_names=rule.outputs,
-                dest_root=build_state.repo_root,
-            )
+            with span("sandbox outputs", "sandbox", rule=str(rule)):
+                sandbox.export(rule.outputs, build_state.repo_root)
         except FileNotFoundError as e:
             raise BuildException(
                 f"Output file {e.filename} from rule {rule} was not generated."
@@ -1,14 +1,23 @@
+import errno
 import hashlib
+import json
 import os
+import time
 from functools import lru_cache
 from pathlib import Path
-from shutil import SameFileError, copyfile, copytree
+from shutil import copyfile
 from typing import List
 
 from utils import BuildException
 
 from common.shell_utils import sh
 
+HASH_INDEX = "file_hashes.json"
+RACY_HASH_WINDOW_NS = 2 * 10 ** 9
+
+# only imported when --fast-hash is used
+xxhash = None
+
 
 def find_root():
     repo_root = os.path.abspath(os.path.curdir)
@@ -28,16 +37,14 @@ def get_repo_files() -> List[str]:
     return [
         file.decode("ascii") if isinstance(file, bytes) else file
         for file in sh(
-            "git", "ls-files", "--exclude-standard", capture_output=True, quiet=True
-        ).splitlines()  # All tracked files
-        + sh(
             "git",
             "ls-files",
-            "-o",
-            "--exclude-standard",
+            "--cached",  # All tracked files
+            "--others",  # Untracked files...
+            "--exclude-standard",  # ...that are not ignored
             capture_output=True,
             quiet=True,
-        ).splitlines()  # Untracked but not ignored files
+        ).splitlines()
     ]
 
 
@@ -56,35 +63,101 @@ def normalize_path(repo_root, build_root, path):
     return str(path.relative_to(repo_root)) + suffix
 
 
-def copy_helper(*, src_root, dest_root, src_names, dest_names=None, symlink=False):
-    if not dest_names:
-        dest_names = src_names
-    assert len(src_names) == len(dest_names)
-    for src_name, dest_name in zip(src_names, dest_names):
-        src = Path(src_root).joinpath(src_name)
-        dest = Path(dest_root).joinpath(dest_name)
-        os.makedirs(os.path.dirname(dest), exist_ok=True)
+# ioctl request number to reflink one file into another, see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dest):
+    # share the underlying blocks copy-on-write if the filesystem supports it
+    # so that cached outputs do not take up additional space
+    if clone_file.supported:
         try:
-            if symlink:
-                Path(dest).symlink_to(src)
-            elif src_name.endswith("/"):
-                copytree(src=src, dst=dest, dirs_exist_ok=True)
-            else:
-                copyfile(src, dest)
-        except SameFileError:
-            pass
+            import fcntl
+
+            with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+                fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+            return
+        except ImportError:
+            clone_file.supported = False
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                clone_file.supported = False
+            elif e.errno != errno.EXDEV:
+                raise
+    copyfile(src, dest)
+
+
+clone_file.supported = True
 
 
 def hash_file(path):
     # only hash files whose contents are "locked in". That way we can cache safely.
     if path in hash_file.cache:
         return hash_file.cache[path]
-    else:
-        with open(path, "rb") as f:
-            out = hash_file.cache[path] = (
-                hashlib.md5(f.read()).hexdigest().encode("utf-8")
-            )
-            return out
+
+    # otherwise, reuse the digest from a previous run if the file is unchanged
+    stat = os.stat(path)
+    signature = [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+    entry = hash_file.index.get(path)
+    if entry is not None and entry[:3] == signature:
+        out = hash_file.cache[path] = entry[3].encode("utf-8")
+        return out
+
+    with open(path, "rb") as f:
+        state = xxhash.xxh3_128() if hash_file.fast else hashlib.md5()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            state.update(chunk)
+    digest = state.hexdigest()
+    hash_file.index[path] = signature + [digest]
+    out = hash_file.cache[path] = digest.encode("utf-8")
+    return out
 
 
 hash_file.cache = {}
+hash_file.index = {}
+hash_file.fast = False
+
+
+def load_hash_index(state_directory: str, *, fast: bool):
+    """
+    Load the digests of files hashed in previous runs, keyed by path and
+    validated against (mtime_ns, size, inode) when they are next used
+    """
+    global xxhash
+    if fast:
+        try:
+            import xxhash
+        except ImportError:
+            raise BuildException(
+                "The xxhash package must be installed to use --fast-hash."
+            )
+    hash_file.fast = fast
+    try:
+        with open(Path(state_directory).joinpath(HASH_INDEX)) as f:
+            index = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return
+    if index.get("algorithm") == get_hash_algorithm():
+        hash_file.index = index["files"]
+
+
+def save_hash_index(state_directory: str):
+    # files modified very recently may be modified again within the same mtime tick,
+    # so we cannot trust their signature in future runs
+    cutoff = time.time_ns() - RACY_HASH_WINDOW_NS
+    index = {
+        "algorithm": get_hash_algorithm(),
+        "files": {
+            path: entry for path, entry in hash_file.index.items() if entry[0] < cutoff
+        },
+    }
+    os.makedirs(state_directory, exist_ok=True)
+    target = Path(state_directory).joinpath(HASH_INDEX)
+    temp = target.with_name(f"{HASH_INDEX}.{os.getpid()}.tmp")
+    with open(temp, "w") as f:
+        json.dump(index, f, separators=(",", ":"))
+    os.replace(temp, target)
+
+
+def get_hash_algorithm():
+    return "xxh3_128" if hash_file.fast else "md5"
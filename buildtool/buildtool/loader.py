@@ -1,23 +1,34 @@
 from __future__ import annotations
 
+import json
 import os
 import sys
 import time
 import traceback
 from dataclasses import dataclass, field
 from glob import glob
+from pathlib import Path
 from importlib.metadata import version
 from typing import Callable, Dict, List, Optional, Sequence, Set, Union
 
 from colorama import Style
 
-from fs_utils import find_root, get_repo_files, normalize_path
+from fs_utils import find_root, get_repo_files, hash_file, normalize_path
 from packaging.version import parse
 from state import Rule, TargetLookup
 from utils import BuildException
+from common.hash_utils import HashState
 
 LOAD_FRAME_CACHE: Dict[str, Struct] = {}
 
+# the rules files loaded (transitively) by each rules file
+LOAD_DEPENDENCIES: Dict[str, Set[str]] = {}
+load_record_stack: List[Set[str]] = []
+
+RULE_GRAPH_CACHE = "rule_graph.json"
+# bump whenever a change to the loader would change the targets declared by a BUILD file
+RULE_GRAPH_CACHE_VERSION = 1
+
 TIMINGS = {}
 
 start_time_stack = []
@@ -89,6 +100,7 @@ def make_callback(
     make_callback.build_root = build_root
     make_callback.find_cache = {}
     make_callback.target_rule_lookup = target_rule_lookup
+    make_callback.record = None
 
     def fail(target):
         raise BuildException(
@@ -97,6 +109,12 @@ def make_callback(
 
     def add_target_rule(target, rule):
         target_rule_lookup = make_callback.target_rule_lookup
+        if target in target_rule_lookup.pending_direct_lookup or (
+            target in target_rule_lookup.pending_location_lookup
+        ):
+            fail(target)
+        if make_callback.record is not None:
+            make_callback.record.targets.append(target)
         if target.endswith("/"):
             # it's a folder dependency
             if target in target_rule_lookup.location_lookup:
@@ -147,6 +165,14 @@ def make_callback(
         return f":{name}"
 
     def find(path, *, unsafe_ignore_extension=False):
+        out = find_files(path, unsafe_ignore_extension=unsafe_ignore_extension)
+        if make_callback.record is not None:
+            make_callback.record.finds.append(
+                [path, unsafe_ignore_extension, sorted(out)]
+            )
+        return out
+
+    def find_files(path, *, unsafe_ignore_extension=False):
         build_root = make_callback.build_root
 
         target = normalize_path(repo_root, build_root, path)
@@ -193,6 +219,8 @@ def make_callback(
 
         return "//" + normalize_path(repo_root, build_root, path)
 
+    make_callback.find_files = find_files
+
     return callback, find, resolve
 
 
@@ -216,10 +244,16 @@ def make_load_rules(repo_root: str, rules_root: str):
         if not path.endswith(".py"):
             raise BuildException(f"Cannot import from a non .py file: {path}")
 
+        for loads in load_record_stack:
+            loads.add(path)
+
         if path in LOAD_FRAME_CACHE:
+            for loads in load_record_stack:
+                loads.update(LOAD_DEPENDENCIES[path])
             return LOAD_FRAME_CACHE[path]
 
         start_time_stack.append(time.time())
+        load_record_stack.append(LOAD_DEPENDENCIES.setdefault(path, set()))
 
         old_rules_root = make_load_rules.rules_root
         __builtins__["load"] = make_load_rules(repo_root, path)
@@ -240,6 +274,7 @@ def make_load_rules(repo_root: str, rules_root: str):
                 )
         make_callback.build_root = cached_root
         make_load_rules.rules_root = old_rules_root
+        load_record_stack.pop()
 
         TIMINGS[path] = load_time = time.time() - start_time_stack.pop()
         start_time_stack[0] += load_time
@@ -258,12 +293,69 @@ def reset_mock_imports(frame, targets):
     )
 
 
+@dataclass
+class BuildFileRecord:
+    # the inputs that determine the targets declared by a BUILD file, other than its own contents
+    loads: Set[str] = field(default_factory=set)
+    finds: List[List[Union[str, bool, List[str]]]] = field(default_factory=list)
+    # the targets it declares
+    targets: List[str] = field(default_factory=list)
+
+    def key(self, build_file: str, flags: Dict[str, object]):
+        hashstate = HashState().record(flags)
+        for path in [build_file, *sorted(self.loads)]:
+            hashstate.record(path)
+            hashstate.update(hash_file(path))
+        return hashstate.state()
+
+    def to_json(self, build_file: str, flags: Dict[str, object]):
+        return dict(
+            key=self.key(build_file, flags),
+            loads=sorted(self.loads),
+            finds=self.finds,
+            targets=self.targets,
+        )
+
+
+def load_rule_graph_cache(state_directory: str, flags: Dict[str, object]):
+    try:
+        with open(Path(state_directory).joinpath(RULE_GRAPH_CACHE)) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if cache.get("version") != RULE_GRAPH_CACHE_VERSION or cache.get("flags") != flags:
+        return {}
+    return cache["build_files"]
+
+
+def save_rule_graph_cache(
+    state_directory: str, flags: Dict[str, object], build_files: Dict[str, object]
+):
+    os.makedirs(state_directory, exist_ok=True)
+    with open(Path(state_directory).joinpath(RULE_GRAPH_CACHE), "w") as f:
+        json.dump(
+            dict(
+                version=RULE_GRAPH_CACHE_VERSION, flags=flags, build_files=build_files
+            ),
+            f,
+        )
+
+
 def load_rules(
     flags: Dict[str, object],
     *,
     skip_version_check: bool,
     workspace: bool = False,
+    state_directory: Optional[str] = None,
 ):
+    """
+    Load the rules declared in the WORKSPACE or in every BUILD file.
+
+    If a state_directory is provided, the targets declared by each BUILD file are cached there,
+    and BUILD files whose contents, flags, load()ed files, and find() results are unchanged are
+    not executed until one of their targets is looked up.
+    """
+    raw_flags = flags
     flags = Struct(flags, default=True)
     repo_root = find_root()
     src_files = get_repo_files()
@@ -278,8 +370,12 @@ def load_rules(
         repo_root, None, set(src_files), target_rule_lookup
     )
     config.skip_version_check = skip_version_check
-    for build_file in build_files:
+
+    def execute(build_file: str):
+        record = BuildFileRecord()
         make_callback.build_root = os.path.dirname(build_file)
+        make_callback.record = record
+        load_record_stack.append(record.loads)
 
         with open(build_file) as f:
             frame = {}
@@ -315,6 +411,56 @@ def load_rules(
                 )
             TIMINGS[build_file] = time.time() - start_time_stack.pop()
 
+        load_record_stack.pop()
+        make_callback.record = None
         make_callback.build_root = None
+        return record
+
+    def is_unchanged(build_file: str, cached) -> bool:
+        try:
+            key = BuildFileRecord(set(cached["loads"])).key(build_file, raw_flags)
+        except FileNotFoundError:
+            # a previously loaded file has been removed
+            return False
+        if cached["key"] != key:
+            return False
+        # find() results depend on the files in the repo, not just the BUILD file
+        make_callback.build_root = os.path.dirname(build_file)
+        try:
+            return all(
+                sorted(
+                    make_callback.find_files(
+                        path, unsafe_ignore_extension=unsafe_ignore_extension
+                    )
+                )
+                == cached_result
+                for path, unsafe_ignore_extension, cached_result in cached["finds"]
+            )
+        except BuildException:
+            return False
+        finally:
+            make_callback.build_root = None
+
+    target_rule_lookup.rules_files = set(build_files)
+
+    if workspace or state_directory is None:
+        for build_file in build_files:
+            target_rule_lookup.rules_files.update(execute(build_file).loads)
+        return target_rule_lookup
+
+    cache = load_rule_graph_cache(state_directory, raw_flags)
+    records = {}
+    for build_file in build_files:
+        cached = cache.get(build_file)
+        if cached is not None and is_unchanged(build_file, cached):
+            target_rule_lookup.defer(build_file, cached["targets"])
+            records[build_file] = cached
+        else:
+            record = execute(build_file)
+            records[build_file] = record.to_json(build_file, raw_flags)
+        target_rule_lookup.rules_files.update(records[build_file]["loads"])
+
+    target_rule_lookup.load_build_file = execute
+    save_rule_graph_cache(state_directory, raw_flags, records)
 
     return target_rule_lookup
@@ -0,0 +1,192 @@
+from __future__ import annotations
+
+import multiprocessing
+import pickle
+import traceback
+from dataclasses import dataclass
+from itertools import chain
+from multiprocessing.connection import Connection
+from queue import Queue
+from typing import Dict, List
+
+from cache import STATS, TRANSFERRED, record_transfer
+from fs_utils import hash_file
+from monitoring import log
+from preview_execution import get_deps
+from state import BuildState, Rule
+from tracing import EVENTS, name_thread, span
+from utils import BuildException
+
+
+@dataclass
+class EvaluatorProcess:
+    process: multiprocessing.Process
+    conn: Connection
+    # the prefix of build_state.ready_log that this process has been sent
+    synced: int = 0
+
+
+def serve(
+    conn: Connection, build_state: BuildState, rules: List[Rule], process_index: int
+):
+    # runs in a forked process, so all the rules and their impls are inherited
+    # from the parent, and only the set of ready rules needs to be kept in sync
+    EVENTS.clear()
+    name_thread(f"evaluator {process_index}")
+    while True:
+        request = conn.recv()
+        if request is None:
+            return
+        updates, index = request
+        for ready_index, provided_value in updates:
+            rules[ready_index].provided_value = provided_value
+            build_state.ready.add(rules[ready_index])
+
+        rule = rules[index]
+        num_hashed = len(hash_file.cache)
+        prev_stats = dict(STATS)
+        prev_transferred = dict(TRANSFERRED)
+        try:
+            with span("evaluate", "parse", rule=str(rule)):
+                cache_key, deps, uses_dynamic_deps = get_deps(build_state, rule)
+            provided_value = pickle.dumps(rule.provided_value)
+        except BuildException as e:
+            response = ("error", e)
+        except pickle.PicklingError:
+            response = ("unpicklable", None)
+        except Exception:
+            response = ("error", BuildException(traceback.format_exc()))
+        else:
+            response = (
+                "ok",
+                (cache_key, list(deps), uses_dynamic_deps, provided_value),
+            )
+
+        # report back anything hashed, counted, or traced here, so the parent can keep it
+        hashed = {
+            path: hash_file.index[path]
+            for path in list(hash_file.cache)[num_hashed:]
+            if path in hash_file.index
+        }
+        stats = {key: STATS[key] - prev_stats[key] for key in STATS}
+        transferred = {
+            key: TRANSFERRED[key] - prev_transferred[key] for key in TRANSFERRED
+        }
+        # the parent records its own counters, from the totals it is sent
+        events = [event for event in EVENTS if event["ph"] != "C"]
+        conn.send(response + ((hashed, stats, transferred, events),))
+        EVENTS.clear()
+
+
+class ProcessEvaluator:
+    """
+    Runs the preview evaluation of rules (their impls and the hashing of
+    their inputs) in a pool of forked processes, so it is not serialized by the GIL.
+    Subprocesses and the scheduler itself still run on the worker threads.
+
+    The processes are forked at the start of each build, after the workspace has been
+    set up, so they only inherit the state of the main thread. Threads started before
+    then (such as remote cache transfers) do not exist in them, so each process creates
+    its own remote cache client and transfer threads if it needs them, and rule impls
+    must not rely on any other threads or locks of the main process.
+    Anything hashed, counted, or traced in the processes is sent back to the main process.
+    """
+
+    def __init__(self, build_state: BuildState, num_processes: int):
+        if "fork" not in multiprocessing.get_all_start_methods():
+            raise BuildException(
+                "Process-based evaluation is not supported on this platform."
+            )
+        lookup = build_state.target_rule_lookup
+        # the processes cannot see BUILD files executed after they are forked
+        lookup.load_all()
+        self.rules: List[Rule] = list(
+            {
+                id(rule): rule
+                for rule in chain(
+                    lookup.direct_lookup.values(), lookup.location_lookup.values()
+                )
+            }.values()
+        )
+        self.rule_ids: Dict[Rule, int] = {
+            rule: index for index, rule in enumerate(self.rules)
+        }
+        self.disabled = False
+        self.idle: Queue[EvaluatorProcess] = Queue()
+
+        context = multiprocessing.get_context("fork")
+        self.processes = []
+        for index in range(num_processes):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=serve,
+                args=(child_conn, build_state, self.rules, index),
+                daemon=True,
+            )
+            process.start()
+            evaluator_process = EvaluatorProcess(process, conn)
+            self.processes.append(evaluator_process)
+            self.idle.put(evaluator_process)
+
+    def get_deps(self, build_state: BuildState, rule: Rule):
+        if self.disabled:
+            return get_deps(build_state, rule)
+
+        evaluator_process = self.idle.get()
+        try:
+            with build_state.scheduling_lock:
+                updates = build_state.ready_log[evaluator_process.synced :]
+            try:
+                evaluator_process.conn.send(
+                    (
+                        [
+                            (self.rule_ids[ready], ready.provided_value)
+                            for ready in updates
+                        ],
+                        self.rule_ids[rule],
+                    )
+                )
+            except (pickle.PicklingError, AttributeError, TypeError):
+                # a rule provided a value that cannot be sent to another process
+                log(
+                    f"Falling back to in-process evaluation, as a dependency of {rule} "
+                    f"provides a value that cannot be pickled"
+                )
+                self.disabled = True
+                return get_deps(build_state, rule)
+            evaluator_process.synced += len(updates)
+            status, response, report = evaluator_process.conn.recv()
+        finally:
+            self.idle.put(evaluator_process)
+
+        hashed, stats, transferred, events = report
+        hash_file.index.update(hashed)
+        for path, entry in hashed.items():
+            hash_file.cache[path] = entry[3].encode("utf-8")
+        if status != "unpicklable":
+            # otherwise, the rule is evaluated again here, and counted then
+            for key, delta in stats.items():
+                STATS[key] += delta
+        if any(transferred.values()):
+            record_transfer(**transferred)
+        EVENTS.extend(events)
+
+        if status == "error":
+            raise response
+        elif status == "unpicklable":
+            return get_deps(build_state, rule)
+
+        cache_key, deps, uses_dynamic_deps, provided_value = response
+        rule.provided_value = pickle.loads(provided_value)
+        return cache_key, deps, uses_dynamic_deps
+
+    def stop(self):
+        for evaluator_process in self.processes:
+            try:
+                evaluator_process.conn.send(None)
+            except OSError:
+                pass
+        for evaluator_process in self.processes:
+            evaluator_process.process.join(timeout=1)
+            if evaluator_process.process.is_alive():
+                evaluator_process.process.terminate()
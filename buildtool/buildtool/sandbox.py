@@ -0,0 +1,179 @@
+import errno
+import os
+from pathlib import Path
+from shutil import copymode, copytree, rmtree
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fs_utils import clone_file
+
+# how dependencies that are not symlinked are placed in the sandbox
+COPY = "copy"  # reflinked where supported, otherwise copied
+LINK = "link"  # hardlinked where possible, so a rule that modifies its inputs in place modifies the repo
+OVERLAY = "overlay"  # like copy, but directory dependencies are mirrored by a tree of symlinks
+
+SANDBOX_MODES = [COPY, LINK, OVERLAY]
+
+SYMLINK = "symlink"
+CLONE = "clone"
+HARDLINK = "hardlink"
+
+# (mtime_ns, size, inode, mode)
+Signature = Tuple[int, int, int, int]
+
+
+def get_signature(stat: os.stat_result) -> Signature:
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino, stat.st_mode
+
+
+def clone_with_mode(src, dest):
+    if os.path.islink(dest):
+        os.unlink(dest)
+    clone_file(src, dest)
+    copymode(src, dest)
+
+
+class Entry:
+    def __init__(self, src: Path, method: str):
+        self.src = src
+        self.method = method
+        # set once the entry has been placed in the sandbox
+        self.src_signature: Optional[Signature] = None
+        self.dest_signature: Optional[Signature] = None
+
+
+class Sandbox:
+    """
+    A scratch directory that persists across all the rules run by a worker.
+    Rather than being rebuilt from scratch for every rule, it is synced with the
+    dependencies of each rule, so only the entries that differ are touched.
+    """
+
+    def __init__(self, repo_root: str, root: Path, mode: str = COPY):
+        self.repo_root = Path(repo_root)
+        self.root = root
+        self.mode = mode
+        # the entries we have placed in the sandbox, keyed by their path relative to the root
+        self.entries: Dict[str, Entry] = {}
+        if self.root.exists():
+            # left over from a previous run, so we do not know what it contains
+            rmtree(self.root, ignore_errors=True)
+
+    def plan(self, deps: Iterable[str], *, symlink: bool) -> Dict[str, Entry]:
+        planned = {}
+        for dep in deps:
+            src = self.repo_root.joinpath(dep)
+            if symlink and not (dep.endswith("/") and self.mode == OVERLAY):
+                # a directory is symlinked as a whole, as the repo always has
+                planned[dep.rstrip("/")] = Entry(src, SYMLINK)
+            elif dep.endswith("/"):
+                method = SYMLINK if symlink else self.file_method()
+                for path, subdirs, files in os.walk(src):
+                    for name in files:
+                        target = Path(path).joinpath(name)
+                        planned[str(target.relative_to(self.repo_root))] = Entry(
+                            target, method
+                        )
+            else:
+                planned[dep] = Entry(src, self.file_method())
+        return planned
+
+    def file_method(self):
+        return HARDLINK if self.mode == LINK else CLONE
+
+    def sync(self, deps: Iterable[str], *, symlink: bool):
+        """
+        Make the sandbox contain exactly the given deps, removing anything else,
+        including the files created by the previous rule
+        """
+        planned = self.plan(deps, symlink=symlink)
+        self.prune(planned)
+        self.place(planned)
+
+    def load(self, deps: Iterable[str], *, symlink: bool):
+        # add deps discovered while a rule is running
+        self.place(self.plan(deps, symlink=symlink))
+
+    def prune(self, planned: Dict[str, Entry]):
+        kept = {}
+        for path, subdirs, files in os.walk(self.root, topdown=False):
+            for name in files + [
+                subdir for subdir in subdirs if Path(path).joinpath(subdir).is_symlink()
+            ]:
+                dest = Path(path).joinpath(name)
+                key = str(dest.relative_to(self.root))
+                entry = self.entries.get(key)
+                if (
+                    entry is not None
+                    and key in planned
+                    and planned[key].method == entry.method
+                    and self.is_fresh(entry, dest)
+                ):
+                    kept[key] = entry
+                else:
+                    os.unlink(dest)
+            if path != str(self.root):
+                try:
+                    os.rmdir(path)
+                except OSError as e:
+                    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                        raise
+        self.entries = kept
+
+    @staticmethod
+    def is_fresh(entry: Entry, dest: Path):
+        try:
+            if get_signature(os.lstat(dest)) != entry.dest_signature:
+                # modified by the rule that last ran here
+                return False
+            if entry.method == SYMLINK:
+                # always reflects the current contents of the repo
+                return True
+            return get_signature(os.stat(entry.src)) == entry.src_signature
+        except FileNotFoundError:
+            return False
+
+    def place(self, planned: Dict[str, Entry]):
+        # parents are placed before their children, so we can tell if they are already symlinked
+        for key, entry in sorted(planned.items()):
+            if key in self.entries or self.inside_symlink(key):
+                continue
+            dest = self.root.joinpath(key)
+            os.makedirs(dest.parent, exist_ok=True)
+            if entry.method == SYMLINK:
+                dest.symlink_to(entry.src)
+            elif entry.method == HARDLINK:
+                try:
+                    os.link(entry.src, dest)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+                    # e.g. the sandbox is on a different filesystem
+                    clone_with_mode(entry.src, dest)
+            else:
+                clone_with_mode(entry.src, dest)
+            if entry.method != SYMLINK:
+                entry.src_signature = get_signature(os.stat(entry.src))
+            entry.dest_signature = get_signature(os.lstat(dest))
+            self.entries[key] = entry
+
+    def inside_symlink(self, key: str):
+        # the dep is already visible through a symlinked parent directory
+        return any(
+            str(parent) in self.entries and self.entries[str(parent)].method == SYMLINK
+            for parent in Path(key).parents
+        )
+
+    def export(self, outputs: List[str], dest_root: str):
+        # outputs are cloned rather than moved, since the cache still reads them from the sandbox
+        for output in outputs:
+            src = self.root.joinpath(output)
+            dest = Path(dest_root).joinpath(output)
+            os.makedirs(dest.parent, exist_ok=True)
+            if output.endswith("/"):
+                copytree(src, dest, copy_function=clone_with_mode, dirs_exist_ok=True)
+            else:
+                clone_with_mode(src, dest)
+
+    def destroy(self):
+        rmtree(self.root, ignore_errors=True)
+        self.entries = {}
@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+import json
+import os
+from collections import defaultdict
+from heapq import heappop, heappush
+from itertools import count
+from math import inf
+from pathlib import Path
+from queue import Queue
+from threading import Lock
+from typing import Callable, Collection, Dict, List, Optional, Set, Tuple
+
+from state import BuildState, Rule
+from tracing import counter
+
+TIMINGS_FILE = "timings.json"
+
+
+def longest_paths(
+    weights: Dict[str, float], dependents: Dict[str, Set[str]]
+) -> Tuple[Dict[str, float], Dict[str, Optional[str]]]:
+    """
+    For each rule, find the heaviest chain of dependents starting from it,
+    returning the total weight of that chain and the next rule along it.
+    Edges that would form a cycle are ignored.
+    """
+    lengths = {}
+    successors = {}
+    for root in set(weights) | set(dependents):
+        if root in lengths:
+            continue
+        # iterative DFS, since dependency chains can be deeper than the recursion limit
+        visiting = {root}
+        stack = [(root, iter(dependents.get(root, ())))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if child not in lengths and child not in visiting:
+                    visiting.add(child)
+                    stack.append((child, iter(dependents.get(child, ()))))
+                    break
+            else:
+                stack.pop()
+                visiting.remove(node)
+                successor = max(
+                    (child for child in dependents.get(node, ()) if child in lengths),
+                    key=lengths.get,
+                    default=None,
+                )
+                lengths[node] = weights.get(node, 0) + (
+                    lengths[successor] if successor is not None else 0
+                )
+                successors[node] = successor
+    return lengths, successors
+
+
+class TimingEstimates:
+    """
+    Execution times and dependency edges of rules from previous builds, used to
+    estimate how much work remains downstream of each rule
+    """
+
+    def __init__(
+        self,
+        durations: Dict[str, float] = None,
+        dependents: Dict[str, Set[str]] = None,
+    ):
+        self.durations = durations or {}
+        self.dependents = defaultdict(set, dependents or {})
+        self.lock = Lock()
+        # priorities are fixed for the duration of a build, so the work queue stays consistent
+        self.critical_paths, _ = longest_paths(self.durations, self.dependents)
+
+    @classmethod
+    def load(cls, state_directory: str):
+        try:
+            with open(Path(state_directory).joinpath(TIMINGS_FILE)) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return cls()
+        return cls(
+            data["durations"],
+            {rule: set(dependents) for rule, dependents in data["dependents"].items()},
+        )
+
+    def save(self, state_directory: str):
+        os.makedirs(state_directory, exist_ok=True)
+        with self.lock:
+            data = dict(
+                durations=self.durations,
+                dependents={
+                    rule: sorted(dependents)
+                    for rule, dependents in self.dependents.items()
+                },
+            )
+        with open(Path(state_directory).joinpath(TIMINGS_FILE), "w") as f:
+            json.dump(data, f)
+
+    def priority(self, rule: Rule) -> float:
+        # rules we have never seen may well be on the critical path, so run them early
+        return self.critical_paths.get(str(rule), inf)
+
+    def record_execution(self, rule: Rule, duration: float):
+        # only time spent actually building is recorded, not loading from the cache
+        with self.lock:
+            self.durations[str(rule)] = duration
+
+    def record_dependencies(
+        self, build_state: BuildState, rule: Rule, deps: Collection[str]
+    ):
+        dep_rules = set()
+        for dep in deps:
+            dep_rule = build_state.target_rule_lookup.try_lookup(dep)
+            if dep_rule is not None and dep_rule is not rule:
+                dep_rules.add(str(dep_rule))
+        with self.lock:
+            for dep_rule in dep_rules:
+                self.dependents[dep_rule].add(str(rule))
+
+    def critical_path(self, timings: Dict[str, float]) -> List[str]:
+        # the heaviest chain of rules in a build, given how long each one took
+        with self.lock:
+            dependents = {
+                rule: {dependent for dependent in rules if dependent in timings}
+                for rule, rules in self.dependents.items()
+                if rule in timings
+            }
+        lengths, successors = longest_paths(timings, dependents)
+        if not lengths:
+            return []
+        pos = max(lengths, key=lengths.get)
+        chain = []
+        while pos is not None:
+            chain.append(pos)
+            pos = successors[pos]
+        return chain
+
+
+class CriticalPathQueue(Queue):
+    """
+    A work queue that yields the ready rule with the longest estimated
+    chain of remaining work first, breaking ties in FIFO order
+    """
+
+    def __init__(self, priority: Callable[[Rule], float]):
+        self.priority = priority
+        self.sequence = count()
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, item: Optional[Rule]):
+        # the None sentinel used to stop workers is only taken once the queue is drained
+        key = inf if item is None else -self.priority(item)
+        heappush(self.queue, (key, next(self.sequence), item))
+        counter("work queue", depth=len(self.queue))
+
+    def _get(self) -> Optional[Rule]:
+        item = heappop(self.queue)[2]
+        counter("work queue", depth=len(self.queue))
+        return item
@@ -2,15 +2,30 @@ from __future__ import annotations
 
 import os
 from dataclasses import dataclass, field
-from pathlib import Path
 from queue import Queue
-from threading import Lock
-from typing import Callable, Dict, List, Optional, Sequence, Set
+from threading import Lock, RLock
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Collection,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    TypeVar,
+)
 
 from context import Context
 from monitoring import StatusMonitor
 from utils import BuildException
 
+T = TypeVar("T")
+
+if TYPE_CHECKING:
+    from process_pool import ProcessEvaluator
+    from scheduling import TimingEstimates
+
 
 @dataclass
 class BuildState:
@@ -19,6 +34,8 @@ class BuildState:
     target_rule_lookup: TargetLookup
     source_files: SourceFileLookup
     repo_root: str
+    # how dependencies are placed in the sandbox, see sandbox.py
+    sandbox_mode: str = "copy"
 
     # logging
     status_monitor: StatusMonitor = None
@@ -26,17 +43,48 @@ class BuildState:
     # dynamic state
     scheduling_lock: Lock = field(default_factory=Lock)
     ready: Set[Rule] = field(default_factory=set)
+    # rules in the order they became ready, so process-based evaluators can be kept in sync
+    ready_log: List[Rule] = field(default_factory=list)
+    # the dependencies of each rule, as of when it was last parsed
+    dependencies: Dict[Rule, Collection[str]] = field(default_factory=dict)
     scheduled_but_not_ready: Set[Rule] = field(default_factory=set)
     work_queue: Queue[Optional[Rule]] = field(default_factory=Queue)
     failure: Optional[BuildException] = None
 
+    # optional process pool used for preview evaluation
+    deps_evaluator: Optional[ProcessEvaluator] = None
+
+    # used to prioritize the work queue, and updated with data from this build
+    timing_estimates: Optional[TimingEstimates] = None
+
+
+def parent_directories(path: str):
+    """
+    Equivalent to str(parent) + "/" for each of Path(path).parents other than the root,
+    deepest first, but without constructing any Paths, since this is called for every lookup
+    """
+    end = path.rfind("/", 0, len(path) - 1)
+    while end != -1:
+        yield path[: end + 1]
+        end = path.rfind("/", 0, end)
+
 
 @dataclass
 class SourceFileLookup:
     tracked_files: Set[str]
+    # whether each path that is not itself tracked resolves to a tracked file
+    resolved: Dict[str, bool] = field(default_factory=dict, compare=False)
 
     def __contains__(self, dep):
-        return os.path.relpath(os.path.realpath(dep), os.curdir) in self.tracked_files
+        if dep in self.tracked_files:
+            return True
+        # the path may be unnormalized, or go through a symlink, so resolve it once
+        out = self.resolved.get(dep)
+        if out is None:
+            out = self.resolved[dep] = (
+                os.path.relpath(os.path.realpath(dep), os.curdir) in self.tracked_files
+            )
+        return out
 
 
 @dataclass
@@ -44,9 +92,29 @@ class TargetLookup:
     direct_lookup: Dict[str, Rule] = field(default_factory=dict)
     location_lookup: Dict[str, Rule] = field(default_factory=dict)
 
+    # targets declared by BUILD files that have not yet been executed, mapped to those files
+    pending_direct_lookup: Dict[str, str] = field(default_factory=dict)
+    pending_location_lookup: Dict[str, str] = field(default_factory=dict)
+    pending_build_files: Dict[str, List[str]] = field(default_factory=dict)
+    load_build_file: Optional[Callable[[str], None]] = None
+    # the BUILD files and the rules files they load, whose changes could affect these targets
+    rules_files: Set[str] = field(default_factory=set)
+    loading_lock: RLock = field(default_factory=RLock)
+
     def __iter__(self):
         yield from self.direct_lookup
         yield from self.location_lookup
+        yield from self.pending_direct_lookup
+        yield from self.pending_location_lookup
+
+    def __contains__(self, target: str):
+        # without this, `in` would fall back to scanning __iter__
+        return (
+            target in self.direct_lookup
+            or target in self.location_lookup
+            or target in self.pending_direct_lookup
+            or target in self.pending_location_lookup
+        )
 
     def lookup(self, build_state: BuildState, dep: str) -> Rule:
         if dep in build_state.source_files:
@@ -60,30 +128,84 @@ class TargetLookup:
                 raise BuildException(f"Unable to resolve dependency {dep}")
             return rule
 
-    def try_lookup(self, dep: str) -> Optional[Rule]:
-        if dep in self.direct_lookup:
-            return self.direct_lookup[dep]
+    @staticmethod
+    def find(dep: str, direct_lookup: Dict[str, T], location_lookup: Dict[str, T]):
+        if dep in direct_lookup:
+            return direct_lookup[dep]
         else:
             # check locations
-            for parent in Path(dep).parents:
-                key = str(parent) + "/"
-                if key in self.location_lookup:
-                    return self.location_lookup[key]
+            if location_lookup:
+                for key in parent_directories(dep):
+                    if key in location_lookup:
+                        return location_lookup[key]
+
+    def try_lookup(self, dep: str) -> Optional[Rule]:
+        rule = self.find(dep, self.direct_lookup, self.location_lookup)
+        if rule is None:
+            build_file = self.find(
+                dep, self.pending_direct_lookup, self.pending_location_lookup
+            )
+            if build_file is not None:
+                self.load(build_file)
+                rule = self.find(dep, self.direct_lookup, self.location_lookup)
+        return rule
+
+    def declares(self, dep: str) -> bool:
+        # like try_lookup, but without executing any pending BUILD files
+        return (
+            self.find(dep, self.direct_lookup, self.location_lookup) is not None
+            or self.find(dep, self.pending_direct_lookup, self.pending_location_lookup)
+            is not None
+        )
+
+    def defer(self, build_file: str, targets: List[str]):
+        for target in targets:
+            if target in self:
+                raise BuildException(
+                    f"The target `{target}` is built by multiple rules. "
+                    f"Targets can only be produced by a single rule."
+                )
+            if target.endswith("/"):
+                self.pending_location_lookup[target] = build_file
+            else:
+                self.pending_direct_lookup[target] = build_file
+        self.pending_build_files[build_file] = targets
+
+    def load(self, build_file: str):
+        with self.loading_lock:
+            if build_file not in self.pending_build_files:
+                # another thread got here first
+                return
+            for target in self.pending_build_files.pop(build_file):
+                self.pending_direct_lookup.pop(target, None)
+                self.pending_location_lookup.pop(target, None)
+            self.load_build_file(build_file)
+
+    def load_all(self):
+        for build_file in list(self.pending_build_files):
+            self.load(build_file)
 
     def find_source_files(self, all_files: List[str]) -> SourceFileLookup:
-        out = set(all_files)
-        for file in all_files:
-            if self.try_lookup(file) is not None:
-                out.remove(file)
-        return SourceFileLookup(out)
+        outputs = self.direct_lookup.keys() | self.pending_direct_lookup.keys()
+        locations = self.location_lookup.keys() | self.pending_location_lookup.keys()
+        return SourceFileLookup(
+            {
+                file
+                for file in all_files
+                if file not in outputs
+                and not (
+                    locations
+                    and any(key in locations for key in parent_directories(file))
+                )
+            }
+        )
 
     def verify(self):
         # check for overlaps involving location_lookups
-        for path in list(self.direct_lookup) + list(self.location_lookup):
+        for path in self:
             # check that this path does not lie inside a parent, by checking all prefixes
-            for parent in Path(path).parents:
-                key = str(parent) + "/"
-                if key in self.location_lookup:
+            for key in parent_directories(path):
+                if key in self.location_lookup or key in self.pending_location_lookup:
                     raise BuildException(
                         f"Outputs {key} and {path} overlap - all outputs must be disjoint"
                     )
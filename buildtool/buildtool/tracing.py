@@ -0,0 +1,76 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# events in the Chrome trace event format, viewable in chrome://tracing or ui.perfetto.dev
+EVENTS = []
+
+
+def enable_tracing():
+    span.enabled = True
+    span.start_time = time.perf_counter()
+
+
+def timestamp():
+    # in microseconds, as the trace format expects
+    return (time.perf_counter() - span.start_time) * 10 ** 6
+
+
+@contextmanager
+def span(name: str, category: str, **args):
+    if not span.enabled:
+        yield
+        return
+    start_time = timestamp()
+    try:
+        yield
+    finally:
+        record_span(name, category, start_time, **args)
+
+
+def record_span(name: str, category: str, start_time: float, **args):
+    # for spans that cannot be conveniently expressed as a `with` block
+    if span.enabled:
+        EVENTS.append(
+            dict(
+                name=name,
+                cat=category,
+                ph="X",
+                ts=start_time,
+                dur=timestamp() - start_time,
+                pid=os.getpid(),
+                tid=threading.get_ident(),
+                args=args,
+            )
+        )
+
+
+span.enabled = False
+span.start_time = 0
+
+
+def counter(name: str, **values: float):
+    if span.enabled:
+        EVENTS.append(
+            dict(name=name, ph="C", ts=timestamp(), pid=os.getpid(), args=values)
+        )
+
+
+def name_thread(name: str):
+    if span.enabled:
+        EVENTS.append(
+            dict(
+                name="thread_name",
+                ph="M",
+                pid=os.getpid(),
+                tid=threading.get_ident(),
+                args=dict(name=name),
+            )
+        )
+
+
+def write_trace(path: str):
+    with open(path, "w") as f:
+        json.dump(dict(traceEvents=EVENTS, displayTimeUnit="ms"), f)
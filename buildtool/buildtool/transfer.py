@@ -0,0 +1,124 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from shutil import copyfile
+from typing import Callable, List, Optional
+
+from google.cloud.exceptions import NotFound
+
+# if set, gs:// buckets are simulated by directories inside this folder,
+# so the remote cache can be exercised without network access
+FAKE_BUCKET_ROOT_VARIABLE = "BUILDTOOL_FAKE_BUCKET_ROOT"
+
+
+@dataclass
+class TransferConfig:
+    num_threads: int = 32
+    pack_directories: bool = False
+
+
+config = TransferConfig()
+
+
+def configure_transfers(*, num_threads: int, pack_directories: bool):
+    config.num_threads = num_threads
+    config.pack_directories = pack_directories
+
+
+@lru_cache()
+def get_client():
+    # a single client is shared by all the workers, so its connections are reused
+    from google.cloud import storage
+    from requests.adapters import HTTPAdapter
+
+    client = storage.Client()
+    client._http.mount(
+        "https://",
+        HTTPAdapter(pool_connections=1, pool_maxsize=config.num_threads),
+    )
+    return client
+
+
+@lru_cache()
+def get_transfer_pool():
+    # shared by all the workers, to bound the total number of concurrent transfers
+    return ThreadPoolExecutor(
+        max_workers=config.num_threads, thread_name_prefix="transfer"
+    )
+
+
+# a process forked from a build (see process_pool) cannot use the parent's client or
+# transfer threads, since those threads do not exist in the child and may have held
+# locks when it was forked, so it creates its own if it needs them
+def reset_transfers():
+    get_client.cache_clear()
+    get_transfer_pool.cache_clear()
+
+
+os.register_at_fork(after_in_child=reset_transfers)
+
+
+def run_transfers(transfers: List[Callable[[], None]]):
+    if len(transfers) <= 1:
+        for transfer in transfers:
+            transfer()
+        return
+    futures = [get_transfer_pool().submit(transfer) for transfer in transfers]
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in not_done:
+        future.cancel()
+    wait(not_done)
+    for future in done:
+        future.result()
+
+
+def get_bucket(bucket_name: str):
+    fake_root = os.getenv(FAKE_BUCKET_ROOT_VARIABLE)
+    if fake_root:
+        return LocalBucket(Path(fake_root).joinpath(bucket_name))
+    return get_client().bucket(bucket_name)
+
+
+class LocalBucket:
+    """
+    Implements the subset of google.cloud.storage.Bucket used by the cache
+    """
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def blob(self, name: str):
+        return LocalBlob(self.root.joinpath(name))
+
+
+@dataclass
+class LocalBlob:
+    path: Path
+
+    def _check_exists(self):
+        if not self.path.exists():
+            raise NotFound(str(self.path))
+
+    def _prepare(self):
+        os.makedirs(self.path.parent, exist_ok=True)
+
+    def exists(self, client: Optional[object] = None):
+        return self.path.exists()
+
+    def download_as_string(self) -> bytes:
+        self._check_exists()
+        return self.path.read_bytes()
+
+    def download_to_filename(self, filename: str):
+        self._check_exists()
+        copyfile(self.path, filename)
+
+    def upload_from_string(self, data: str):
+        self._prepare()
+        self.path.write_text(data)
+
+    def upload_from_filename(self, filename: str):
+        self._prepare()
+        copyfile(filename, self.path)
@@ -10,9 +10,10 @@ from flask import Response, jsonify, abort
 from google.oauth2 import id_token
 from google.cloud.exceptions import NotFound
 
-from examtool.api.scramble import scramble
+from examtool.api.scramble import compile_scramble
 
 from examtool_web_common.safe_firestore import SafeFirestore
+from examtool_web_common.ttl_cache import TTLCache
 
 # this can be public
 
@@ -20,6 +21,16 @@ CLIENT_ID = "713452892775-59gliacuhbfho8qvn4ctngtp3858fgf9.apps.googleuserconten
 
 DEV_EMAIL = getenv("DEV_EMAIL", "exam-test@berkeley.edu")
 
+# how long an instance may use the exam list and roster entries it has read
+EXAM_LIST_TTL = 30
+STUDENT_DATA_TTL = 15
+
+exam_list_cache = TTLCache(EXAM_LIST_TTL)
+student_data_cache = TTLCache(STUDENT_DATA_TTL)
+
+# the client is reused by every request to this instance
+db = None
+
 if getenv("ENV") == "dev":
     import importlib.util
     import sys
@@ -46,6 +57,13 @@ def update_cache():
 update_cache()
 
 
+def get_db():
+    global db
+    if db is None:
+        db = SafeFirestore()
+    return db
+
+
 def get_email(request):
     if getenv("ENV") == "dev":
         return request.json.get("loginas") or DEV_EMAIL, "loginas" in request.json
@@ -83,13 +101,21 @@ def get_exam_dict(exam, db):
 
 
 def get_student_data(exam, email, db):
-    ref = db.collection("roster").document(exam).collection("deadline").document(email)
-    try:
-        data = ref.get().to_dict()
-        if data:
-            return data
-    except NotFound:
-        pass
+    def fetch():
+        ref = (
+            db.collection("roster")
+            .document(exam)
+            .collection("deadline")
+            .document(email)
+        )
+        try:
+            return ref.get().to_dict() or None
+        except NotFound:
+            return None
+
+    data = student_data_cache.get((exam, email), fetch)
+    if data:
+        return data
 
     abort(401)
 
@@ -99,7 +125,10 @@ def get_deadline(exam, email, db):
 
 
 def list_exams(db):
-    return db.collection("exams").document("all").get().to_dict()["exam-list"]
+    return exam_list_cache.get(
+        "all",
+        lambda: db.collection("exams").document("all").get().to_dict()["exam-list"],
+    )
 
 
 def get_roster_exams(email, db):
@@ -116,7 +145,7 @@ def index(request):
         if getenv("ENV") == "dev":
             update_cache()
 
-        db = SafeFirestore()
+        db = get_db()
 
         if request.path.endswith("main.js"):
             return main_js
@@ -152,10 +181,10 @@ def index(request):
             no_watermark = student_data.get("no_watermark", False)
 
             exam_data = get_exam_dict(exam, db)
-            exam_data = scramble(
-                email,
-                exam_data,
-            )
+            # the secret is not needed to scramble, and may not be serializable
+            secret = exam_data.pop("secret")
+            # the plan is reused across requests until the exam is redeployed
+            exam_data = compile_scramble(exam_data).scramble(email)
 
             # 120 second grace period in case of network latency or something
             if deadline + 120 < time.time() and not is_admin:
@@ -168,7 +197,7 @@ def index(request):
                     "exam": exam,
                     "publicGroup": exam_data["public"],
                     "privateGroups": (
-                        Fernet(exam_data["secret"])
+                        Fernet(secret)
                         .encrypt_at_time(
                             json.dumps(exam_data["groups"]).encode("ascii"), 0
                         )
@@ -194,13 +223,13 @@ def index(request):
             if exam not in list_exams(db):
                 abort(401)
 
-            db.collection(exam).document(email).collection("log").document().set(
-                {"timestamp": time.time(), "sentTime": sent_time, question_id: value}
-            )
+            log_ref = db.collection(exam).document(email).collection("log").document()
+            log = {"timestamp": time.time(), "sentTime": sent_time, question_id: value}
 
             deadline = get_deadline(exam, email, db)
 
             if deadline + 120 < time.time() and not is_admin:
+                log_ref.set(log)
                 abort(401)
                 return
 
@@ -218,12 +247,20 @@ def index(request):
             recent_time = recency.get("sentTime", -1)
             if recent_time - 300 <= sent_time <= recent_time:
                 # the current request was delayed and is now out of date
+                log_ref.set(log)
                 abort(409)
                 return
 
-            recency_ref.set({"sentTime": sent_time})
-
-            db.collection(exam).document(email).set({question_id: value}, merge=True)
+            # the log, the recency and the answer are committed together
+            batch = db.batch()
+            batch.set(log_ref.obj, log)
+            batch.set(recency_ref.obj, {"sentTime": sent_time})
+            batch.set(
+                db.collection(exam).document(email).obj,
+                {question_id: value},
+                merge=True,
+            )
+            batch.commit()
             return jsonify({"success": True})
 
         if request.path.endswith("backup_all"):
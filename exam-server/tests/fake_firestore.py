@@ -0,0 +1,138 @@
+"""
+An in-memory stand-in for the parts of the Firestore client used by the exam apps,
+for testing them without the Firestore emulator.
+Wrap it like the real client: SafeFirestore(FakeFirestore()).
+The reads, writes, and commits made against it are counted.
+"""
+import copy
+import uuid
+from collections import Counter
+from threading import RLock
+
+MAX_BATCH_WRITES = 500
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.documents = {}
+        self.stats = Counter()
+        self.lock = RLock()
+
+    def collection(self, name):
+        return FakeCollection(self, (name,))
+
+    def document(self, path):
+        return FakeDocument(self, tuple(path.split("/")))
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def write(self, path, data, merge):
+        with self.lock:
+            data = copy.deepcopy(data)
+            if merge and path in self.documents:
+                self.documents[path].update(data)
+            else:
+                self.documents[path] = data
+            self.stats["writes"] += 1
+
+    def delete(self, path):
+        with self.lock:
+            self.documents.pop(path, None)
+            self.stats["writes"] += 1
+
+
+class FakeCollection:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path[-1]
+        self.filters = []
+
+    def document(self, name=None):
+        return FakeDocument(self.client, self.path + (name or uuid.uuid4().hex,))
+
+    def where(self, field, op, value):
+        query = FakeCollection(self.client, self.path)
+        query.filters = self.filters + [(field, op, value)]
+        return query
+
+    def matches(self, data):
+        for field, op, value in self.filters:
+            if op == "==" and data.get(field) != value:
+                return False
+            if op == "array_contains" and value not in data.get(field, []):
+                return False
+        return True
+
+    def stream(self):
+        with self.client.lock:
+            paths = [
+                path
+                for path, data in self.client.documents.items()
+                if path[:-1] == self.path and self.matches(data)
+            ]
+        for path in sorted(paths):
+            yield FakeDocument(self.client, path).get()
+
+    def get(self):
+        return list(self.stream())
+
+
+class FakeDocument:
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.client, self.path + (name,))
+
+    def get(self):
+        with self.client.lock:
+            self.client.stats["reads"] += 1
+            data = copy.deepcopy(self.client.documents.get(self.path))
+        return FakeSnapshot(self, data)
+
+    def set(self, data, merge=False):
+        self.client.stats["commits"] += 1
+        self.client.write(self.path, data, merge)
+
+    def delete(self):
+        self.client.stats["commits"] += 1
+        self.client.delete(self.path)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.data = data
+
+    def to_dict(self):
+        return self.data
+
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.writes = []
+
+    def set(self, reference, data, merge=False):
+        self.writes.append((reference.path, data, merge))
+
+    def delete(self, reference):
+        self.writes.append((reference.path, None, False))
+
+    def commit(self):
+        if len(self.writes) > MAX_BATCH_WRITES:
+            raise ValueError("A batch can contain at most 500 writes")
+        with self.client.lock:
+            self.client.stats["commits"] += 1
+            for path, data, merge in self.writes:
+                if data is None:
+                    self.client.delete(path)
+                else:
+                    self.client.write(path, data, merge)
+        self.writes = []
@@ -0,0 +1,128 @@
+"""
+Tests for how exam-server records answers, run against an in-memory Firestore.
+"""
+import importlib
+import os
+import sys
+import time
+
+import pytest
+from flask import Flask, request
+
+from fake_firestore import FakeFirestore
+
+EXAM_SERVER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+EXAM = "cs61a-test-final"
+EMAIL = "student@berkeley.edu"
+
+
+@pytest.fixture
+def firestore():
+    return FakeFirestore()
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch, firestore):
+    # main reads the built frontend from the working directory when it is imported
+    (tmp_path / "static").mkdir()
+    for name in ["index.html", "main.js"]:
+        (tmp_path / "static" / name).write_text("")
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(EXAM_SERVER)
+    monkeypatch.delenv("ENV", raising=False)
+    sys.modules.pop("main", None)
+    main = importlib.import_module("main")
+
+    from examtool_web_common.safe_firestore import SafeFirestore
+
+    monkeypatch.setattr(main, "db", SafeFirestore(firestore))
+    monkeypatch.setattr(main, "get_email", lambda request: (EMAIL, False))
+
+    main.db.collection("exams").document("all").set({"exam-list": [EXAM]})
+    yield main
+    sys.modules.pop("main", None)
+
+
+def set_deadline(main, deadline):
+    main.db.collection("roster").document(EXAM).collection("deadline").document(
+        EMAIL
+    ).set({"deadline": deadline})
+
+
+def submit(main, question_id, value, sent_time):
+    app = Flask(__name__)
+    with app.test_request_context(
+        "/submit_question",
+        method="POST",
+        json={"exam": EXAM, "id": question_id, "value": value, "sentTime": sent_time},
+    ):
+        return main.index(request).get_json()
+
+
+def get_answers(main):
+    return main.db.collection(EXAM).document(EMAIL).get().to_dict()
+
+
+def get_logs(main):
+    return [
+        log.to_dict()
+        for log in main.db.collection(EXAM).document(EMAIL).collection("log").stream()
+    ]
+
+
+def test_answer_log_and_recency_are_committed_together(main, firestore):
+    set_deadline(main, time.time() + 3600)
+    commits = firestore.stats["commits"]
+
+    assert submit(main, "q1", "first", 1000) == {"success": True}
+
+    assert firestore.stats["commits"] == commits + 1
+    assert get_answers(main) == {"q1": "first"}
+    assert [log["q1"] for log in get_logs(main)] == ["first"]
+    assert main.db.collection(EXAM).document(EMAIL).collection("recency").document(
+        "q1"
+    ).get().to_dict() == {"sentTime": 1000}
+
+    assert submit(main, "q2", "second", 1001) == {"success": True}
+    assert get_answers(main) == {"q1": "first", "q2": "second"}
+
+
+def test_late_answer_is_logged_but_not_saved(main, firestore):
+    set_deadline(main, time.time() - 3600)
+    commits = firestore.stats["commits"]
+
+    assert submit(main, "q1", "late", 1000) == {"success": False}
+
+    assert firestore.stats["commits"] == commits + 1
+    assert get_answers(main) is None
+    assert [log["q1"] for log in get_logs(main)] == ["late"]
+
+
+def test_out_of_date_answer_is_logged_but_not_saved(main, firestore):
+    set_deadline(main, time.time() + 3600)
+    assert submit(main, "q1", "newer", 1000) == {"success": True}
+    commits = firestore.stats["commits"]
+
+    # sent before the answer that was already saved, but delivered after it
+    assert submit(main, "q1", "older", 990) == {"success": False}
+
+    assert firestore.stats["commits"] == commits + 1
+    assert get_answers(main) == {"q1": "newer"}
+    assert sorted(log["q1"] for log in get_logs(main)) == ["newer", "older"]
+
+
+def test_missing_roster_entry_is_not_cached(main, firestore):
+    assert submit(main, "q1", "too early", 1000) == {"success": False}
+    assert get_answers(main) is None
+
+    # a student added to the roster can submit straight away
+    set_deadline(main, time.time() + 3600)
+    assert submit(main, "q1", "added", 1001) == {"success": True}
+    assert get_answers(main) == {"q1": "added"}
+
+    # but once found, their roster entry is not read again for every answer
+    reads = firestore.stats["reads"]
+    assert submit(main, "q2", "cached", 1002) == {"success": True}
+    # only the recency of the question is read
+    assert firestore.stats["reads"] == reads + 1
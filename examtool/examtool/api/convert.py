@@ -1,6 +1,9 @@
+import hashlib
 import json
 import re
 import os
+from functools import lru_cache
+from uuid import uuid4
 
 import pypandoc
 from tqdm import tqdm
@@ -20,6 +23,76 @@ def tex_convert(x):
     return pypandoc.convert_text(x, "latex", "md")
 
 
+CONVERTERS = {"html": html_convert, "tex": tex_convert}
+
+# raw blocks passed through verbatim by pandoc, to mark the boundaries between fragments
+BOUNDARIES = {
+    "html": ("```{{=html}}\n<!--{}-->\n```", "<!--{}-->"),
+    "tex": ("```{{=latex}}\n%{}\n```", "%{}"),
+}
+
+
+@lru_cache()
+def get_pandoc_version():
+    return pypandoc.get_pandoc_version()
+
+
+def batch_convert(texts, type):
+    """
+    Convert many fragments with a single pandoc invocation, separated by raw blocks
+    that pandoc passes through untouched. Unlike converting each fragment separately,
+    fragments can affect each other (e.g. through footnotes or link references),
+    so the results are approximate. Returns None if the fragments could not be separated.
+    """
+    if not texts:
+        return []
+    marker = "EXAMTOOL-FRAGMENT-" + uuid4().hex
+    boundary, boundary_output = BOUNDARIES[type]
+    converted = CONVERTERS[type](
+        ("\n\n" + boundary.format(marker) + "\n\n").join(texts)
+    )
+    parts = converted.split(boundary_output.format(marker))
+    opening = boundary.format(marker).split("\n")[0]
+    if len(parts) != len(texts) or any(
+        marker in part or (opening in part and opening not in text)
+        for part, text in zip(parts, texts)
+    ):
+        # a fragment swallowed a boundary, e.g. with an unterminated code block
+        return None
+    return [part.strip("\n") + "\n" for part in parts]
+
+
+class FragmentCache:
+    """
+    Converted fragments, keyed by their text, target format, and the pandoc version,
+    persisted in a directory so that later compiles only convert the fragments that changed
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_path(self, text, type):
+        key = hashlib.sha256(
+            json.dumps([get_pandoc_version(), type, text]).encode("utf-8")
+        ).hexdigest()
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, text, type):
+        try:
+            with open(self.get_path(text, type)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, text, type, converted):
+        path = self.get_path(text, type)
+        os.makedirs(dirname(path), exist_ok=True)
+        temp_path = path + "." + uuid4().hex
+        with open(temp_path, "w") as f:
+            f.write(converted)
+        os.replace(temp_path, path)
+
+
 class LineBuffer:
     def __init__(self, text, *, src_map=None):
         self.lines = text.strip().split("\n")
@@ -452,7 +525,7 @@ def _convert(text, *, path=None, allow_random_ids=True):
     }
 
 
-def pandoc(target, *, draft=False, num_threads):
+def pandoc(target, *, draft=False, num_threads, cache: FragmentCache = None):
     to_parse = []
 
     def explore(pos):
@@ -467,30 +540,29 @@ def pandoc(target, *, draft=False, num_threads):
 
     explore(target)
 
-    pandoc_delimiter = """\n\nDELIMITER\n\n"""
+    if cache is not None:
+        for x in to_parse:
+            x.__dict__[x.type] = cache.get(x.text, x.type)
+        to_parse = [x for x in to_parse if x.__dict__[x.type] is None]
 
-    if draft:
-
-        def transpile_target(t):
-            return pandoc_delimiter.join(x.text for x in to_parse if x.type == t)
-
-        html = html_convert(transpile_target("html")).split(
-            html_convert(pandoc_delimiter)
-        )
-        tex = tex_convert(transpile_target("tex")).split(tex_convert(pandoc_delimiter))
+    def pandoc_convert(x):
+        x.__dict__[x.type] = CONVERTERS[x.type](x.text)
+        if cache is not None:
+            cache.set(x.text, x.type, x.__dict__[x.type])
 
-        for x, h in zip(filter(lambda x: x.type == "html", to_parse), html):
-            x.html = h
-
-        for x, t in zip(filter(lambda x: x.type == "tex", to_parse), tex):
-            x.tex = t
+    if draft:
+        for type in CONVERTERS:
+            targets = [x for x in to_parse if x.type == type]
+            converted = batch_convert([x.text for x in targets], type)
+            if converted is None:
+                # the fragments must be converted separately
+                for x in targets:
+                    pandoc_convert(x)
+            else:
+                # batched conversions are approximate, so they are not cached
+                for x, result in zip(targets, converted):
+                    x.__dict__[type] = result
     else:
-
-        def pandoc_convert(x):
-            x.__dict__[x.type] = (
-                html_convert(x.text) if x.type == "html" else tex_convert(x.text)
-            )
-
         with ThreadPool(num_threads) as p:
             list(
                 tqdm(
@@ -508,7 +580,15 @@ def pandoc(target, *, draft=False, num_threads):
     return json.dumps(target, default=pandoc_dump)
 
 
-def convert(text, *, path=None, draft=False, allow_random_ids=True, num_threads):
+def convert(
+    text,
+    *,
+    path=None,
+    draft=False,
+    allow_random_ids=True,
+    num_threads,
+    cache: FragmentCache = None,
+):
     return json.loads(
         convert_str(
             text,
@@ -516,6 +596,7 @@ def convert(text, *, path=None, draft=False, allow_random_ids=True, num_threads)
             draft=draft,
             allow_random_ids=allow_random_ids,
             num_threads=num_threads,
+            cache=cache,
         )
     )
 
@@ -527,11 +608,13 @@ def convert_str(
     draft=False,
     allow_random_ids=True,
     num_threads=16,
+    cache: FragmentCache = None,
 ):
     return pandoc(
         _convert(text, path=path, allow_random_ids=allow_random_ids),
         draft=draft,
         num_threads=num_threads,
+        cache=cache,
     )
 
 
@@ -1,86 +1,180 @@
+import csv
 import json
+import os
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 from tqdm import tqdm
 
+from examtool.api.assemble_export import assemble_exam
 from examtool.api.database import get_exam, get_roster, get_submissions
 from examtool.api.extract_questions import extract_questions
-from examtool.api.scramble import scramble
+from examtool.api.render_pdf_export import render_pdf_exam
+from examtool.api.scramble import compile_scramble
 
 
-def download(exam, emails_to_download: [str] = None, debug: bool = False):
+def stream_download(exam, emails_to_download: [str] = None, debug: bool = False):
+    """
+    Returns the exam, its template questions, and an iterator over (email, data) for each submission,
+    where data contains the student's scrambled questions and their responses.
+    Submissions are scrambled as they are iterated over, so only one is held in memory at a time.
+    """
     exam_json = get_exam(exam=exam)
     exam_json.pop("secret")
-    exam_json = json.dumps(exam_json)
-
-    template_questions = list(extract_questions(json.loads(exam_json)))
-
-    total = [
-        ["Email"]
-        + [question["text"] for question in extract_questions(json.loads(exam_json))]
-    ]
 
-    email_to_data_map = {}
+    template_questions = list(extract_questions(json.loads(json.dumps(exam_json))))
+    scramble_plan = compile_scramble(exam_json)
 
     if emails_to_download is None:
         roster = get_roster(exam=exam)
         emails_to_download = [email for email, _ in roster]
+    emails_to_download = set(emails_to_download)
 
-    i = 1
-    for email, response in tqdm(
-        get_submissions(exam=exam), dynamic_ncols=True, desc="Downloading", unit="Exam"
-    ):
-        i += 1
-        if emails_to_download is not None and email not in emails_to_download:
-            continue
+    def submissions():
+        for email, response in tqdm(
+            get_submissions(exam=exam),
+            dynamic_ncols=True,
+            desc="Downloading",
+            unit="Exam",
+        ):
+            if email not in emails_to_download:
+                continue
 
-        if debug and 1 < len(response) < 10:
-            tqdm.write(email, response)
+            if debug and 1 < len(response) < 10:
+                tqdm.write(email, response)
 
-        total.append([email])
-        for question in template_questions:
-            total[-1].append(response.get(question["id"], ""))
+            student_questions = list(
+                extract_questions(
+                    scramble_plan.scramble(email, keep_data=True, cache=False)
+                )
+            )
 
-        student_questions = list(
-            extract_questions(scramble(email, json.loads(exam_json), keep_data=True))
-        )
+            yield email, {
+                "student_questions": student_questions,
+                "responses": response,
+            }
 
-        email_to_data_map[email] = {
-            "student_questions": student_questions,
-            "responses": response,
-        }
+    return exam_json, template_questions, submissions()
 
-    return json.loads(exam_json), template_questions, email_to_data_map, total
 
+def get_summary_header(template_questions):
+    return ["Email"] + [question["text"] for question in template_questions]
 
-def get_question_to_page_mapping(
+
+def get_summary_row(email, response, template_questions):
+    return [email] + [
+        response.get(question["id"], "") for question in template_questions
+    ]
+
+
+def download(exam, emails_to_download: [str] = None, debug: bool = False):
+    exam_json, template_questions, submissions = stream_download(
+        exam, emails_to_download, debug
+    )
+
+    total = [get_summary_header(template_questions)]
+    email_to_data_map = {}
+    for email, data in submissions:
+        total.append(get_summary_row(email, data["responses"], template_questions))
+        email_to_data_map[email] = data
+
+    return exam_json, template_questions, email_to_data_map, total
+
+
+def export(
     template_questions,
+    student_responses,
     exam,
     out,
     name_question,
     sid_question,
+    *,
     dispatch=None,
+    include_outline=True,
+    substitute_in_question_text=False,
+    render=None,
+    num_threads=16,
 ):
-    questions = []
-    pages = []
-    for q in tqdm(
-        template_questions,
-        desc="Getting question page numbers",
-        unit="Question",
-        dynamic_ncols=True,
-    ):
-        questions.append(q)
-        pdf = write_exam(
+    """
+    Write summary.csv and a PDF for each student (and an OUTLINE.pdf) into out.
+    student_responses can be a dict or an iterator of (email, data) pairs, such as the one
+    returned by stream_download(), in which case students are exported as they are downloaded.
+    """
+    if render is None:
+        render = render_pdf_to_file
+    if isinstance(student_responses, dict):
+        student_responses = student_responses.items()
+
+    if include_outline:
+        outline = assemble_exam(
+            exam,
             None,
             {},
+            template_questions,
+            template_questions,
+            name_question,
+            sid_question,
+            dispatch,
+        )
+        render(outline, os.path.join(out, "OUTLINE.pdf"))
+
+    def export_student(email_data):
+        email, data = email_data
+        assembled_exam = assemble_exam(
             exam,
-            questions,
-            questions,
+            email,
+            data.get("responses"),
+            template_questions,
+            data.get("student_questions"),
             name_question,
             sid_question,
             dispatch,
+            substitute_in_question_text=substitute_in_question_text,
         )
-        pages.append(pdf.page_no())
-    # for i, q in enumerate(questions):
-    #     print(f"[{i}] pg: {pages[i]} - {q['id']}")
-    # import ipdb; ipdb.set_trace()
+        render(assembled_exam, os.path.join(out, f"{email}.pdf"))
+
+    with open(os.path.join(out, "summary.csv"), "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(get_summary_header(template_questions))
+        student_responses = iter(student_responses)
+        with ThreadPool(num_threads) as p:
+            while True:
+                # only a bounded number of students are held in memory at once
+                batch = list(islice(student_responses, num_threads * 4))
+                if not batch:
+                    break
+                for email, data in batch:
+                    writer.writerow(
+                        get_summary_row(email, data["responses"], template_questions)
+                    )
+                p.map(export_student, batch)
+
+
+def render_pdf_to_file(assembled_exam, target):
+    render_pdf_exam(assembled_exam).output(target)
+
+
+def get_question_to_page_mapping(
+    template_questions,
+    exam,
+    out,
+    name_question,
+    sid_question,
+    dispatch=None,
+):
+    """
+    The page of the outline that each template question ends on, found in a single render
+    """
+    outline = assemble_exam(
+        exam,
+        None,
+        {},
+        template_questions,
+        template_questions,
+        name_question,
+        sid_question,
+        dispatch,
+    )
+    pages = []
+    render_pdf_exam(outline, question_pages=pages)
     return pages
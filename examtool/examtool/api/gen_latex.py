@@ -1,8 +1,13 @@
+import hashlib
 import os
 import re
+import shutil
 import subprocess
 from collections import defaultdict
 from contextlib import contextmanager
+from threading import Lock
+
+import requests
 
 from examtool.api.scramble import latex_escape
 from examtool.api.watermarks import create_watermark
@@ -113,46 +118,134 @@ def generate(exam, *, include_watermark):
     return "".join(out)
 
 
-@contextmanager
-def render_latex(exam, subs=None, *, do_twice=False):
+IMAGE_PATTERN = r"\\includegraphics(\[.*\])?{(http.*/(.+))}"
+
+
+def prepare_latex(exam, subs=None, *, fetch_images=True):
+    """
+    Generate the LaTeX source of an exam, the SVG of its watermark if it has one,
+    and the (url, filename) of each image it includes.
+    If fetch_images is set, images are fetched by pdflatex itself,
+    otherwise they must be placed alongside the source using fetch_latex_images().
+    """
     include_watermark = exam.get("watermark") and "value" in exam["watermark"]
 
     latex = generate(exam, include_watermark=include_watermark)
+    images = [
+        (match.group(2), match.group(3)) for match in re.finditer(IMAGE_PATTERN, latex)
+    ]
     latex = re.sub(
-        r"\\includegraphics(\[.*\])?{(http.*/(.+))}",
-        r"\\immediate\\write18{wget -N \2}\n\\includegraphics\1{\3}",
+        IMAGE_PATTERN,
+        r"\\immediate\\write18{wget -N \2}\n\\includegraphics\1{\3}"
+        if fetch_images
+        else r"\\includegraphics\1{\3}",
         latex,
     )
     if subs:
         for k, v in subs.items():
             latex = latex.replace(f"<{k.upper()}>", v)
-    if not os.path.exists("temp"):
-        os.mkdir("temp")
-    with open("temp/out.tex", "w+") as f:
-        f.write(latex)
 
     if include_watermark:
-        with open("temp/watermark.svg", "w+") as f:
-            f.write(
-                create_watermark(
-                    exam["watermark"]["value"],
-                    brightness=exam["watermark"]["brightness"],
-                )
-            )
+        watermark = create_watermark(
+            exam["watermark"]["value"],
+            brightness=exam["watermark"]["brightness"],
+        )
+    else:
+        watermark = None
+
+    return latex, watermark, images
+
+
+image_fetch_locks = defaultdict(Lock)
+image_fetch_locks_lock = Lock()
+
+
+def fetch_latex_images(images, path, image_cache):
+    """
+    Place the given images in path, downloading each url into image_cache
+    only if it has not been downloaded before
+    """
+    for url, filename in images:
+        cached = os.path.join(
+            image_cache, hashlib.sha256(url.encode("utf-8")).hexdigest()
+        )
+        # only fetches of the same url wait on each other
+        with image_fetch_locks_lock:
+            url_lock = image_fetch_locks[cached]
+        with url_lock:
+            if not os.path.exists(cached):
+                os.makedirs(image_cache, exist_ok=True)
+                resp = requests.get(url)
+                resp.raise_for_status()
+                with open(cached + ".tmp", "wb") as f:
+                    f.write(resp.content)
+                os.replace(cached + ".tmp", cached)
+        shutil.copyfile(cached, os.path.join(path, filename))
+
+
+class LatexError(Exception):
+    """
+    pdflatex reported an error. nonstopmode may still have written a PDF, which is
+    kept in pdf (or None if there was none) so callers can decide whether to use it
+    """
+
+    def __init__(self, message, pdf):
+        super().__init__(message)
+        self.pdf = pdf
+
+
+def compile_latex(
+    latex, watermark=None, *, do_twice=False, path="temp", quiet=False, check=False
+):
+    """
+    Compile LaTeX source from prepare_latex() to a PDF in the given working directory,
+    which must not be shared with any other compilation running at the same time.
+    If check is set, raise a LatexError rather than return a PDF that pdflatex failed on
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    with open(os.path.join(path, "out.tex"), "w+") as f:
+        f.write(latex)
+
+    if watermark is not None:
+        with open(os.path.join(path, "watermark.svg"), "w+") as f:
+            f.write(watermark)
         subprocess.run(
-            "inkscape -D -z --file=temp/watermark.svg --export-pdf=temp/watermark.pdf",
+            "inkscape -D -z --file=watermark.svg --export-pdf=watermark.pdf",
             shell=True,
+            cwd=path,
         ).check_returncode()
 
-    subprocess.run(
-        "cd temp && pdflatex --shell-escape -interaction=nonstopmode out.tex",
-        shell=True,
-    )
-    if do_twice:
-        subprocess.run(
-            "cd temp && pdflatex --shell-escape -interaction=nonstopmode out.tex",
-            shell=True,
+    returncode = 0
+    for _ in range(2 if do_twice else 1):
+        returncode = (
+            subprocess.run(
+                "pdflatex --shell-escape -interaction=nonstopmode out.tex",
+                shell=True,
+                cwd=path,
+                stdout=subprocess.DEVNULL if quiet else None,
+            ).returncode
+            or returncode
         )
-    with open("temp/out.pdf", "rb") as f:
-        yield f.read()
+
+    if check and returncode:
+        errors = []
+        if os.path.exists(os.path.join(path, "out.log")):
+            with open(os.path.join(path, "out.log"), errors="replace") as f:
+                errors = [line.strip() for line in f if line.startswith("!")]
+        pdf = None
+        if os.path.exists(os.path.join(path, "out.pdf")):
+            with open(os.path.join(path, "out.pdf"), "rb") as f:
+                pdf = f.read()
+        raise LatexError(
+            "pdflatex failed: " + (errors[0] if errors else str(returncode)), pdf
+        )
+    with open(os.path.join(path, "out.pdf"), "rb") as f:
+        return f.read()
+
+
+@contextmanager
+def render_latex(exam, subs=None, *, do_twice=False):
+    latex, watermark, _ = prepare_latex(exam, subs)
+    yield compile_latex(latex, watermark, do_twice=do_twice)
     # shutil.rmtree("temp")
@@ -3,6 +3,7 @@ Developed by ThaumicMekanism [Stephan K.] - all credit goes to him!
 """
 import contextlib
 import sys
+from threading import Lock
 from typing import Callable, List
 
 from multiprocessing.pool import ThreadPool
@@ -10,6 +11,13 @@ from tqdm.contrib import DummyTqdmFile
 
 import examtool.api.download
 from examtool.api.gradescope_upload import APIClient
+from examtool.api.gradescope_sync import (
+    SYNC_STATE_NAME,
+    AdaptiveLimiter,
+    GradescopeSyncState,
+    get_digest,
+    limit_requests,
+)
 from examtool.api.extract_questions import (
     extract_groups,
     extract_questions,
@@ -57,6 +65,7 @@ class GradescopeGrader:
         gs_login_tokens_path: str = None,
         simultaneous_jobs: int = 10,
         simultaneous_sub_jobs: int = 10,
+        max_requests: int = 10,
     ):
         print(f"Setting up the Gradescope Grader...")
         entered_email_pwd = email is not None and password is not None
@@ -67,7 +76,7 @@ class GradescopeGrader:
             gs_login_tokens = LoginTokens.load(gs_login_tokens_path)
             if gs_login_tokens is not None:
                 logged_in = True
-        else:
+        elif entered_email_pwd:
             print(
                 "Ignoring current token file since you entered an email and password.\nLogging in with those credentials..."
             )
@@ -86,6 +95,15 @@ class GradescopeGrader:
 
         self.simultaneous_jobs = simultaneous_jobs
         self.simultaneous_sub_jobs = simultaneous_sub_jobs
+
+        # Every request to Gradescope, from any thread, shares one limit on how many may be in flight
+        self.limiter = AdaptiveLimiter(max_requests)
+        limit_requests(self.gs_client.session, self.limiter)
+        limit_requests(self.gs_api_client.session, self.limiter)
+
+        self.sync_state = GradescopeSyncState()
+        self.assignment_rubrics = {}
+        self.assignment_rubrics_lock = Lock()
         print(f"Finished setting up the Gradescope Grader")
 
     def main(
@@ -105,6 +123,7 @@ class GradescopeGrader:
         custom_grouper_map: {
             str: Callable[[str, GS_Question, dict, dict], "QuestionGrouper"]
         } = None,
+        resync: bool = False,
     ):
         if gs_assignment_title is None:
             gs_assignment_title = "Examtool Exam"
@@ -114,6 +133,7 @@ class GradescopeGrader:
             )
 
         out = out or "out/export/" + exams[0]
+        self.load_sync_state(out, resync)
 
         (
             exam_json,
@@ -169,7 +189,11 @@ class GradescopeGrader:
         # We can now upload the student submission since we have an outline
         print("Uploading student submissions...")
         failed_uploads = self.upload_student_submissions(
-            out, gs_class_id, gs_assignment_id, emails=email_to_data_map.keys()
+            out,
+            gs_class_id,
+            gs_assignment_id,
+            emails=email_to_data_map.keys(),
+            digests=self.get_submission_digests(email_to_data_map),
         )
 
         # Removing emails which failed to upload
@@ -275,11 +299,13 @@ class GradescopeGrader:
         custom_grouper_map: {
             str: Callable[[str, GS_Question, dict, dict], "QuestionGrouper"]
         } = None,
+        resync: bool = False,
     ):
         """
         If emails is None, we will import the entire exam, if it has emails in it, it will only upload submissions
         from the students in the emails list contained in the exams list. If the student has submissions in multiple exams,
         the tool will warn you and ask which exam you would like to use as the student submission.
+        Anything a previous run into the same output folder already synced to Gradescope is skipped, unless resync is set.
         """
         if not exams:
             raise ValueError(
@@ -289,6 +315,7 @@ class GradescopeGrader:
             email_mutation_list = {}
 
         out = out or "out/export/" + exams[0]
+        self.load_sync_state(out, resync)
 
         (
             exam_json,
@@ -331,7 +358,11 @@ class GradescopeGrader:
         # We can now upload the student submission since we have an outline
         print("Uploading student submissions...")
         failed_uploads = self.upload_student_submissions(
-            out, gs_class_id, gs_assignment_id, emails=email_to_data_map.keys()
+            out,
+            gs_class_id,
+            gs_assignment_id,
+            emails=email_to_data_map.keys(),
+            digests=self.get_submission_digests(email_to_data_map),
         )
 
         # Removing emails which failed to upload
@@ -556,7 +587,6 @@ class GradescopeGrader:
         examtool.api.download.export(
             template_questions,
             email_to_data_map,
-            total,
             exam,
             out,
             name_question_id,
@@ -576,26 +606,74 @@ class GradescopeGrader:
     ) -> GS_assignment_Grader:
         return self.gs_client.get_assignment_grader(gs_class_id, assignment_id)
 
+    def load_sync_state(self, out: str, resync: bool = False):
+        """
+        Loads what previous runs into the same output folder synced to Gradescope,
+        so that only what has changed since is sent. If resync is set, everything is sent again.
+        """
+        self.sync_state = GradescopeSyncState(
+            os.path.join(out, SYNC_STATE_NAME), reset=resync
+        )
+        self.assignment_rubrics = {}
+
+    def get_assignment_key(self, grader: GS_assignment_Grader):
+        return (grader.course_id, grader.assignment_id)
+
+    def get_question_key(self, question: GS_Question):
+        return self.get_assignment_key(question.assignment_grader) + (
+            "questions",
+            question.question_id,
+        )
+
+    def get_submission_digests(self, email_to_data_map: dict):
+        return {email: get_digest(data) for email, data in email_to_data_map.items()}
+
     def upload_outline(
         self, grader: GS_assignment_Grader, examtool_outline: "ExamtoolOutline"
     ):
-        outline = grader.update_outline(examtool_outline.get_gs_outline())
+        key = self.get_assignment_key(grader)
+        digest = get_digest(examtool_outline.get_gs_outline().json())
+        if self.sync_state.get(*key, "outline") == digest:
+            print("The outline is unchanged since it was last uploaded.")
+            outline = grader.get_outline()
+        else:
+            outline = grader.update_outline(examtool_outline.get_gs_outline())
         if not outline:
             raise ValueError("Failed to upload or get the outline")
         examtool_outline.merge_gs_outline_ids(outline)
+        self.sync_state.set(*key, "outline", value=digest)
+        self.sync_state.save()
 
     def upload_student_submissions(
-        self, out: str, gs_class_id: str, assignment_id: str, emails: [str] = None
+        self,
+        out: str,
+        gs_class_id: str,
+        assignment_id: str,
+        emails: [str] = None,
+        digests: {str: str} = None,
     ):
+        """
+        If digests maps emails to a digest of their submission, students whose submission
+        has not changed since it was last uploaded to the assignment are skipped.
+        """
         failed_emails = []
         email_files = []
+        key = (gs_class_id, assignment_id, "submissions")
+        uploaded = self.sync_state.get(*key) or {}
+        skipped = 0
         for file_name in os.listdir(out):
             if "@" not in file_name:
                 continue
             student_email = file_name[:-4]
             if emails and student_email not in emails:
                 continue
+            digest = digests and digests.get(student_email)
+            if digest and uploaded.get(student_email) == digest:
+                skipped += 1
+                continue
             email_files.append((file_name, student_email))
+        if skipped:
+            print(f"Skipping {skipped} submissions which are already uploaded.")
         with std_out_err_redirect_tqdm() as orig_stdout:
             # for file_name, student_email in tqdm(
             #     email_files, file=orig_stdout, unit="Submission", **def_tqdm_args
@@ -609,6 +687,10 @@ class GradescopeGrader:
                     os.path.join(out, file_name),
                 ):
                     failed_emails.append(student_email)
+                elif digests:
+                    self.sync_state.set(
+                        *key, student_email, value=digests.get(student_email)
+                    )
 
             with ThreadPool(self.simultaneous_jobs) as p:
                 list(
@@ -620,6 +702,7 @@ class GradescopeGrader:
                         **def_tqdm_args,
                     )
                 )
+        self.sync_state.save()
         return failed_emails
 
     def set_group_types(self, outline: GS_Outline, debug=True):
@@ -643,6 +726,7 @@ class GradescopeGrader:
                         **def_tqdm_args,
                     )
                 )
+        self.sync_state.save()
 
     def set_group_type(self, o_question: GS_Outline_Question):
         question_type = o_question.data.get("type")
@@ -652,7 +736,13 @@ class GradescopeGrader:
             q_type = GroupTypes.mc
         # if question_type in ["long_answer", "long_code_answer"]:
         #     q_type = GroupTypes.non_grouped
-        return q.set_group_type(q_type)
+        key = self.get_question_key(q)
+        if self.sync_state.get(*key, "group_type") == q_type.value:
+            return True
+        res = q.set_group_type(q_type)
+        if res:
+            self.sync_state.set(*key, "group_type", value=q_type.value)
+        return res
 
     def process_question(
         self,
@@ -964,8 +1054,31 @@ class GradescopeGrader:
         self, qid: str, question: GS_Question, groups: "QuestionGrouper"
     ):
         """
-        Groups is a list of name, submission_id, selected answers
+        Groups is a list of name, submission_id, selected answers.
+        Groups whose submissions are unchanged since they were last synced are not sent again.
         """
+        key = self.get_question_key(question)
+        synced_groups = self.sync_state.get(*key, "groups") or {}
+
+        def get_sids_digest(group):
+            return get_digest(sorted(group.get_sids()))
+
+        def is_synced(group):
+            synced_group = synced_groups.get(group.get_name())
+            return synced_group is not None and synced_group["sids"] == get_sids_digest(
+                group
+            )
+
+        # We do not want to create groups which no questions exist.
+        gps = [group for group in groups.get_groups() if group.get_sids()]
+        pending_gps = [group for group in gps if not is_synced(group)]
+        for group in gps:
+            if is_synced(group):
+                group.set_id(synced_groups[group.get_name()]["id"])
+        if not pending_gps:
+            tqdm.write(f"[{qid}]: Groups are unchanged since the last sync!")
+            return
+
         failed_groups_names = []
         i = 1
         failed = False
@@ -990,7 +1103,7 @@ class GradescopeGrader:
         def set_group(group, gs_group):
             group.set_id(gs_group.get("id"))
 
-        for group in groups.get_groups():
+        for group in pending_gps:
             g_name = group.get_name()
             for gs_group in gradescope_groups:
                 if gs_group["question_type"] == "mc":
@@ -1024,9 +1137,6 @@ class GradescopeGrader:
             attempt = 1
             g_name = group.get_name()
             sids = group.get_sids()
-            if not sids:
-                # We do not want to create groups which no questions exist.
-                return
             group_id = group.get_id()
             while attempt < max_attempts:
                 if not group_id:
@@ -1034,12 +1144,20 @@ class GradescopeGrader:
                 if group_id is None:
                     attempt += 1
                     time.sleep(1)
-                    return
+                    continue
+                group.set_id(group_id)
                 if not question.group_submissions(group_id, sids):
                     tqdm.write(
                         f"[{qid}]: Failed to group submissions to {group_id}. SIDS: {sids}"
                     )
                     failed_groups_names.append(g_name)
+                else:
+                    self.sync_state.set(
+                        *key,
+                        "groups",
+                        g_name,
+                        value={"id": group_id, "sids": get_sids_digest(group)},
+                    )
                 break
             else:
                 tqdm.write(f"[{qid}]: Failed to create group for {g_name}! ({groups})")
@@ -1054,22 +1172,22 @@ class GradescopeGrader:
         # ):
         #     submit_group(group, question, failed_groups_names, max_attempts)
 
-        gps = groups.get_groups()
-
         def sg(g):
             submit_group(g, question, failed_groups_names, 5)
 
         with ThreadPool(self.simultaneous_sub_jobs) as p:
             list(
                 tqdm(
-                    p.imap_unordered(sg, gps),
-                    total=len(gps),
+                    p.imap_unordered(sg, pending_gps),
+                    total=len(pending_gps),
                     desc=f"[{qid}]: Syncing Groups",
                     unit="Group",
                     **def_tqdm_args,
                 )
             )
 
+        self.sync_state.save()
+
         # This is to decrease down stream errors
         for failed_group_name in failed_groups_names:
             groups.remove(failed_group_name)
@@ -1101,15 +1219,44 @@ class GradescopeGrader:
     ):
         return [0] * len(correct_seq)
 
+    def get_question_rubric(self, question: GS_Question) -> QuestionRubric:
+        """
+        The rubrics of every question in an assignment are fetched together, once per run
+        """
+        grader = question.assignment_grader
+        with self.assignment_rubrics_lock:
+            if grader.assignment_id not in self.assignment_rubrics:
+                self.assignment_rubrics[grader.assignment_id] = grader.get_rubrics()
+            assignment_rubrics = self.assignment_rubrics[grader.assignment_id]
+        raw_rubric = question.get_rubric(assignment_rubrics) or {}
+        return SyncedQuestionRubric(
+            question,
+            [RubricItem(**item) for item in raw_rubric.get("rubric_items", [])],
+        )
+
     def sync_rubric(
         self, qid: str, question: GS_Question, groups: "QuestionGrouper"
     ) -> QuestionRubric:
-        rubric = QuestionRubric(question)
+        """
+        Adds the rubric items which are missing from the question, and updates the weights
+        of those whose weight has changed since they were last synced.
+        """
         if len(groups) == 0:
-            return rubric
+            return self.get_question_rubric(question)
 
         qrubric: [RubricItem] = groups.get_rubric()
 
+        key = self.get_question_key(question)
+        expected_rubric = [[item.description, item.weight] for item in qrubric]
+        synced_rubric = self.sync_state.get(*key, "rubric")
+        if synced_rubric is not None and synced_rubric["expected"] == expected_rubric:
+            tqdm.write(f"[{qid}]: Rubric is unchanged since the last sync!")
+            return SyncedQuestionRubric(
+                question, [RubricItem(**item) for item in synced_rubric["items"]]
+            )
+        synced_weights = dict(synced_rubric["expected"]) if synced_rubric else {}
+
+        rubric = self.get_question_rubric(question)
         if len(rubric) == 1:
             default_rubric_item = rubric.get_rubric_items()[0]
             if default_rubric_item.description == "Correct":
@@ -1124,22 +1271,78 @@ class GradescopeGrader:
                     )
                 # qrubric.remove(first_item)
 
-        existing_rubric_items = rubric.get_rubric_items()
-        existing_rubric_items_desc = [
-            item.description for item in existing_rubric_items
-        ]
+        existing_rubric_items = {
+            item.description: item for item in rubric.get_rubric_items()
+        }
 
         for rubric_item in tqdm(
             qrubric, desc=f"[{qid}]: Syncing Rubric", unit="Rubric", **def_tqdm_args
         ):
-            if rubric_item.description not in existing_rubric_items_desc:
+            existing_item = existing_rubric_items.get(rubric_item.description)
+            if existing_item is None:
                 rubric.add_rubric_item(rubric_item)
+            elif synced_weights.get(rubric_item.description, rubric_item.weight) != (
+                rubric_item.weight
+            ):
+                if not rubric.update_rubric_item(
+                    existing_item, weight=rubric_item.weight
+                ):
+                    tqdm.write(
+                        f'[{qid}]: Failed to update the weight of "{rubric_item.description}"!'
+                    )
 
+        items = rubric.get_rubric_items()
+        if all(item.item_id is not None for item in items):
+            self.sync_state.set(
+                *key,
+                "rubric",
+                value={
+                    "expected": expected_rubric,
+                    "items": [
+                        {
+                            "id": item.item_id,
+                            "description": item.description,
+                            "weight": item.weight,
+                        }
+                        for item in items
+                    ],
+                },
+            )
+            self.sync_state.save()
         return rubric
 
     def grade_question(
         self, qid: str, question: GS_Question, rubric: QuestionRubric, groups: dict
     ):
+        """
+        Groups which were graded with the same rubric items and submissions by a previous run are skipped.
+        Changing the weight of a rubric item does not need any regrading.
+        """
+        key = self.get_question_key(question)
+        graded_groups = self.sync_state.get(*key, "grades") or {}
+
+        def get_grade_digest(group):
+            selected_item_ids = [
+                item.item_id
+                for item, selected in zip(
+                    rubric.get_rubric_items(), group.get_selected_items()
+                )
+                if selected
+            ]
+            return get_digest(
+                [group.get_id(), selected_item_ids, sorted(group.get_sids())]
+            )
+
+        gps = [
+            group
+            for group in groups.get_groups()
+            if group.get_sids()
+            and graded_groups.get(group.get_name()) != get_grade_digest(group)
+        ]
+        if not gps:
+            tqdm.write(f"[{qid}]: Grades are unchanged since the last sync!")
+            return
+
         question_data = question.get_question_info()
         sub_id_mapping = {str(sub["id"]): sub for sub in question_data["submissions"]}
         # for group in tqdm(
@@ -1148,15 +1351,15 @@ class GradescopeGrader:
         def sg(group):
             group_sel = group.get_selected_items()
             group_sids = group.get_sids()
-            if len(group_sids) > 0:
-                sid = group_sids[0]
-                if not sub_id_mapping[str(sid)]["graded"]:
-                    if not rubric.grade(sid, group_sel, save_group=True):
-                        tqdm.write(
-                            f"[{qid}]: Failed to grade group {group.get_name()}!"
-                        )
+            sid = group_sids[0]
+            if not sub_id_mapping[str(sid)]["graded"]:
+                if not rubric.grade(sid, group_sel, save_group=True):
+                    tqdm.write(f"[{qid}]: Failed to grade group {group.get_name()}!")
+                    return
+            self.sync_state.set(
+                *key, "grades", group.get_name(), value=get_grade_digest(group)
+            )
 
-        gps = groups.get_groups()
         with ThreadPool(self.simultaneous_sub_jobs) as p:
             list(
                 tqdm(
@@ -1167,6 +1370,7 @@ class GradescopeGrader:
                     **def_tqdm_args,
                 )
             )
+        self.sync_state.save()
 
 
 class ExamtoolOutline:
@@ -1286,6 +1490,16 @@ class ExamtoolOutline:
         yield from self.gs_outline.questions_iterator()
 
 
+class SyncedQuestionRubric(QuestionRubric):
+    """
+    A QuestionRubric made from rubric items which are already known, rather than fetched for each question
+    """
+
+    def __init__(self, question: GS_Question, rubric_items: [RubricItem]):
+        self.question = question
+        self.rubric_items = rubric_items
+
+
 class QuestionGroup:
     def __init__(self, name: str, selected_rubric_items: [bool], gid: str = None):
         self.name = name
@@ -3,7 +3,10 @@ from fpdf import FPDF
 from examtool.api.assemble_export import AssembledExam, OptionQuestion, TextQuestion
 
 
-def render_pdf_exam(assembled_exam: AssembledExam):
+def render_pdf_exam(assembled_exam: AssembledExam, *, question_pages=None):
+    """
+    If question_pages is provided, the page each question ends on is appended to it
+    """
     pdf = FPDF()
     pdf.add_page()
 
@@ -55,4 +58,7 @@ def render_pdf_exam(assembled_exam: AssembledExam):
         out("\nAUTOGRADER")
         out(question.autograde_output)
 
+        if question_pages is not None:
+            question_pages.append(pdf.page_no())
+
     return pdf
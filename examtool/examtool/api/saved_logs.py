@@ -0,0 +1,133 @@
+import gzip
+import json
+import os
+import random
+import time
+from threading import Lock
+
+LOG_SUFFIX = ".jsonl.gz"
+MANIFEST_NAME = "manifest.jsonl"
+
+SHORT = "short"
+FULL = "full"
+
+
+def get_log_path(out, email, kind):
+    if kind == FULL:
+        return os.path.join(out, "full", email + LOG_SUFFIX)
+    return os.path.join(out, email + LOG_SUFFIX)
+
+
+def get_legacy_log_path(out, email, kind):
+    # logs used to be saved as a single JSON document per student, with no extension
+    if kind == FULL:
+        return os.path.join(out, "full", email)
+    return os.path.join(out, email)
+
+
+def write_logs(path, logs):
+    """
+    Write the records of a log as gzipped JSON Lines, atomically,
+    so an interrupted download never leaves a partial file behind
+    """
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8") as f:
+        for record in logs:
+            f.write(json.dumps(record, separators=(",", ":")))
+            f.write("\n")
+    os.replace(temp_path, path)
+
+
+def read_logs(out, email, kind):
+    """
+    Read the saved log of the given kind for a student, or None if it has not been saved
+    """
+    path = get_log_path(out, email, kind)
+    if os.path.exists(path):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    path = get_legacy_log_path(out, email, kind)
+    if os.path.isfile(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+def fetch_with_retry(fetch, *, retries, backoff):
+    """
+    Call fetch(), retrying with jittered exponential backoff if it fails
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fetch()
+        except KeyboardInterrupt:
+            raise
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+class LogManifest:
+    """
+    Records which logs have been saved, so an interrupted `save-logs` can resume where it left off.
+    Each record is appended to the manifest as one JSON line, and later lines override earlier ones.
+    """
+
+    def __init__(self, out):
+        self.path = os.path.join(out, MANIFEST_NAME)
+        self.lock = Lock()
+        self.entries = {}
+        num_lines = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    num_lines += 1
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line is incomplete if a run was killed while writing it
+                        continue
+                    email, kind = entry.pop("email"), entry.pop("kind")
+                    self.entries.setdefault(email, {})[kind] = entry
+        except FileNotFoundError:
+            pass
+        # drop superseded and incomplete lines, so that new lines are appended cleanly
+        if num_lines > sum(len(kinds) for kinds in self.entries.values()):
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the manifest atomically with only the latest record of each log
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            for email, kinds in self.entries.items():
+                for kind, entry in kinds.items():
+                    f.write(json.dumps(dict(email=email, kind=kind, **entry)))
+                    f.write("\n")
+        os.replace(temp_path, self.path)
+
+    def is_saved(self, out, email, kind):
+        entry = self.entries.get(email, {}).get(kind)
+        return (
+            entry is not None
+            and entry.get("error") is None
+            and os.path.exists(get_log_path(out, email, kind))
+        )
+
+    def record(self, email, kind, *, count=None, error=None):
+        entry = dict(count=count, error=error, time=time.time())
+        line = json.dumps(dict(email=email, kind=kind, **entry)) + "\n"
+        with self.lock:
+            self.entries.setdefault(email, {})[kind] = entry
+            with open(self.path, "a") as f:
+                f.write(line)
+
+    def failures(self):
+        return [
+            (email, kind, entry["error"])
+            for email, kinds in self.entries.items()
+            for kind, entry in kinds.items()
+            if entry.get("error") is not None
+        ]
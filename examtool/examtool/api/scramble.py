@@ -1,15 +1,36 @@
+import json
 import random
+import re
+from functools import lru_cache
+from heapq import heapify, heappop, heappush
+from typing import Iterable, List
 
 from examtool.api.utils import dict_to_list
 
+# the number of scrambled exams each plan keeps, serialized, for repeated requests
+VARIANT_CACHE_SIZE = 256
 
-def scramble(email, exam, *, keep_data=False):
-    random.seed(email)
+# beyond this, substitutions that form new patterns fall back to replacing everything
+MAX_FORMED_PATTERNS = 16
+# texts containing the patterns of over 1 / DENSE_FRACTION of the replacements are replaced sequentially
+DENSE_FRACTION = 8
+
+
+def scramble(email, exam, *, keep_data=False, sites: "SubstitutionSites" = None):
+    """
+    Scramble the exam for the given student, in place.
+    sites can be shared between calls for the same exam, so its texts are only searched once.
+    """
+    if sites is None:
+        sites = get_substitution_sites(frozenset(get_substitution_keys(exam)))
+
+    # a generator of its own, so concurrent calls for other students cannot interleave with it
+    rng = random.Random(email)
 
     version = exam.get("version", 1)
 
     def scramble_group(group, substitutions, config, depth):
-        group_substitutions = select_substitutions(group)
+        group_substitutions = select_substitutions(group, rng)
         substitute(
             group,
             [*substitutions, group_substitutions],
@@ -20,7 +41,7 @@ def scramble(email, exam, *, keep_data=False):
             if depth in config["scramble_groups"] or group.get("scramble"):
                 scramble_keep_fixed(get_elements(group))
             if group.get("pick_some"):
-                get_elements(group)[:] = random.sample(
+                get_elements(group)[:] = rng.sample(
                     get_elements(group), group["pick_some"]
                 )
 
@@ -65,7 +86,7 @@ def scramble(email, exam, *, keep_data=False):
         return [group]
 
     def scramble_question(question, substitutions, config):
-        question_substitutions = select_substitutions(question)
+        question_substitutions = select_substitutions(question, rng)
         substitute(
             question,
             [question_substitutions, *substitutions],
@@ -108,17 +129,17 @@ def scramble(email, exam, *, keep_data=False):
         merged = {}
         for substitutions in list_substitutions:
             merged = {**merged, **substitutions}
-            for attr in attrs:
-                if attr not in target:
-                    continue
-                for k, v in substitutions.items():
-                    target[attr] = target[attr].replace(k, v)
-                    if k.title() != k:
-                        target[attr] = target[attr].replace(k.title(), v.title())
-                    if latex_escape(k) != k:
-                        target[attr] = target[attr].replace(
-                            latex_escape(k), latex_escape(v)
-                        )
+        replacements = None
+        for attr in attrs:
+            if attr in target and sites.find(target[attr]):
+                if replacements is None:
+                    replacements = Replacements(
+                        [
+                            get_layer_replacements(substitutions)
+                            for substitutions in list_substitutions
+                        ]
+                    )
+                target[attr] = replacements.apply(target[attr], sites)
         if store:
             if keep_data:
                 target["substitutions"] = merged
@@ -127,6 +148,18 @@ def scramble(email, exam, *, keep_data=False):
                 target.pop("substitution_groups", None)
                 target.pop("substitutions_match", None)
 
+    def get_layer_replacements(substitutions):
+        # the same layers are applied to many elements, so their replacements are reused.
+        # The layer is kept alive alongside them, so that its id cannot be reused
+        key = id(substitutions)
+        if key not in layer_replacements:
+            layer_replacements[key] = substitutions, ReplacementLayer(
+                get_replacements(substitutions)
+            )
+        return layer_replacements[key][1]
+
+    layer_replacements = {}
+
     def scramble_keep_fixed(objects):
         if keep_data:
             for i, object in enumerate(objects):
@@ -137,11 +170,11 @@ def scramble(email, exam, *, keep_data=False):
             if not object.get("fixed"):
                 movable_object_pos.append(i)
                 movable_object_values.append(object)
-        random.shuffle(movable_object_values)
+        rng.shuffle(movable_object_values)
         for i, object in zip(movable_object_pos, movable_object_values):
             objects[i] = object
 
-    global_substitutions = select_substitutions(exam)
+    global_substitutions = select_substitutions(exam, rng)
     exam["config"]["scramble_groups"] = exam["config"].get(
         "scramble_groups", [-1]
     ) or range(100)
@@ -158,32 +191,280 @@ def scramble(email, exam, *, keep_data=False):
     exam.pop("substitutions_match", None)
 
     if exam.get("watermark"):
-        exam["watermark"]["value"] = random.randrange(2 ** 20)
+        exam["watermark"]["value"] = rng.randrange(2 ** 20)
 
     return exam
 
 
+def get_replacements(substitutions):
+    """
+    The (old, new) pairs that applying a layer of substitutions replaces, in order
+    """
+    out = []
+    for k, v in substitutions.items():
+        out.append((k, v))
+        if k.title() != k:
+            out.append((k.title(), v.title()))
+        if latex_escape(k) != k:
+            out.append((latex_escape(k), latex_escape(v)))
+    return tuple((old, new) for old, new in out if old != new)
+
+
+class ReplacementLayer:
+    """
+    The (old, new) replacements made by a layer of substitutions,
+    indexed by the pattern each one replaces
+    """
+
+    def __init__(self, replacements):
+        self.replacements = replacements
+        self.positions = {}
+        for i, (old, new) in enumerate(replacements):
+            self.positions.setdefault(old, []).append(i)
+
+
+class Replacements:
+    """
+    The replacements made by several layers of substitutions, applied in order
+    """
+
+    def __init__(self, layers: List[ReplacementLayer]):
+        self.replacements = []
+        self.layers = []
+        for layer in layers:
+            self.layers.append((len(self.replacements), layer.positions))
+            self.replacements.extend(layer.replacements)
+
+    def positions(self, pattern):
+        return [
+            offset + i
+            for offset, positions in self.layers
+            for i in positions.get(pattern, ())
+        ]
+
+    def apply(self, text, sites: "SubstitutionSites"):
+        """
+        Equivalent to calling text.replace(old, new) for each replacement in turn.
+        A pattern not found in the original text can only appear after an earlier replacement
+        inserts text overlapping it, so only the replacements of patterns that are found,
+        or that could have been formed by an earlier replacement, are made.
+        """
+        live = set(sites.find(text))
+        if len(live) * DENSE_FRACTION > len(self.replacements):
+            # many of the replacements will be made anyway, so skip the bookkeeping
+            for old, new in self.replacements:
+                text = text.replace(old, new)
+            return text
+        pending = [i for pattern in live for i in self.positions(pattern)]
+        heapify(pending)
+        while pending:
+            i = heappop(pending)
+            old, new = self.replacements[i]
+            if old not in text:
+                continue
+            text = text.replace(old, new)
+            formed = sites.overlapping(new) - live
+            if len(formed) > MAX_FORMED_PATTERNS:
+                # cheaper to make all the remaining replacements than to track them
+                for old, new in self.replacements[i + 1 :]:
+                    text = text.replace(old, new)
+                return text
+            for pattern in formed:
+                live.add(pattern)
+                for j in self.positions(pattern):
+                    if j > i:
+                        heappush(pending, j)
+        return text
+
+
+def trie_regex(words):
+    # a regex matching any of the words, with common prefixes factored out so it is fast to match.
+    # Where one word is a prefix of another, the longest match is preferred
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def to_regex(node):
+        is_word = node.pop("", None) is not None
+        branches = [re.escape(char) + to_regex(child) for char, child in node.items()]
+        if not branches:
+            return ""
+        elif len(branches) == 1:
+            out = branches[0]
+        else:
+            out = "(?:" + "|".join(branches) + ")"
+        return "(?:" + out + ")?" if is_word else out
+
+    return to_regex(trie)
+
+
+class SubstitutionSites:
+    """
+    Finds the substitution directives, in any form, that appear in each text of an exam,
+    in a single pass over the text. Results are cached, since the same texts are
+    searched once per student.
+    """
+
+    def __init__(self, keys: Iterable[str]):
+        patterns = set()
+        for key in keys:
+            patterns.update([key, key.title(), latex_escape(key)])
+        # an empty key appears in every text, but cannot be searched for
+        self.empty = frozenset([""]) & patterns
+        patterns -= self.empty
+        self.patterns = patterns
+        # matches the longest pattern starting at each position, including overlapping ones
+        self.pattern = (
+            re.compile("(?=(" + trie_regex(patterns) + "))") if patterns else None
+        )
+        # the shorter patterns starting at the same position are implied by the longest
+        self.prefixes = {
+            pattern: {
+                pattern[:i]
+                for i in range(1, len(pattern) + 1)
+                if pattern[:i] in patterns
+            }
+            for pattern in patterns
+        }
+        # the patterns starting or ending with each proper prefix or suffix of a pattern
+        self.by_prefix = {}
+        self.by_suffix = {}
+        for pattern in patterns:
+            for i in range(1, len(pattern)):
+                self.by_prefix.setdefault(pattern[:i], set()).add(pattern)
+                self.by_suffix.setdefault(pattern[i:], set()).add(pattern)
+        self.known = {}
+        self.known_overlapping = {}
+
+    def find(self, text):
+        out = self.known.get(text)
+        if out is None:
+            found = set(self.empty)
+            if self.pattern is not None:
+                for match in self.pattern.finditer(text):
+                    found.update(self.prefixes[match.group(1)])
+            out = self.known[text] = frozenset(found)
+        return out
+
+    def overlapping(self, text):
+        """
+        The patterns that inserting this text could cause to appear: those containing it
+        or contained in it, and those that it could complete from either side
+        """
+        out = self.known_overlapping.get(text)
+        if out is None:
+            if not text:
+                # deleting text can join any pattern together
+                out = frozenset(self.patterns) | self.empty
+            else:
+                found = set(self.find(text))
+                found.update(pattern for pattern in self.patterns if text in pattern)
+                for i in range(1, len(text)):
+                    found.update(self.by_prefix.get(text[i:], ()))
+                    found.update(self.by_suffix.get(text[:i], ()))
+                out = frozenset(found) | self.empty
+            self.known_overlapping[text] = out
+        return out
+
+
+@lru_cache(maxsize=32)
+def get_substitution_sites(keys: frozenset) -> SubstitutionSites:
+    return SubstitutionSites(keys)
+
+
+class ScramblePlan:
+    """
+    An exam compiled for scrambling once per student: it is parsed once, its
+    substitution sites are indexed, and recently requested variants are cached
+    """
+
+    def __init__(self, exam_json: str, *, cache_size=VARIANT_CACHE_SIZE):
+        self.exam_json = exam_json
+        self.sites = SubstitutionSites(get_substitution_keys(json.loads(exam_json)))
+        self.get_variant = lru_cache(cache_size)(self.generate_variant)
+
+    def generate_variant(self, email, keep_data):
+        return json.dumps(self.generate(email, keep_data=keep_data))
+
+    def generate(self, email, *, keep_data=False, sites=None):
+        return scramble(
+            email,
+            json.loads(self.exam_json),
+            keep_data=keep_data,
+            sites=self.sites if sites is None else sites,
+        )
+
+    def scramble(self, email, *, keep_data=False, cache=True):
+        """
+        Scramble the exam for a student. Pass cache=False for students unlikely to be requested again.
+        """
+        if not cache:
+            return self.generate(email, keep_data=keep_data)
+        return json.loads(self.get_variant(email, keep_data))
+
+    def scramble_all(self, emails: Iterable[str], *, keep_data=False):
+        """
+        Yield (email, exam) for many students at once, bypassing the variant cache
+        """
+        for email in emails:
+            yield email, self.generate(email, keep_data=keep_data)
+
+    def watermark(self, email):
+        # the watermark only depends on the random choices made, not on the text,
+        # so sites with no directives are passed in, and no substitutions are made
+        exam = self.generate(email, sites=SubstitutionSites([]))
+        return exam["watermark"]["value"] if exam.get("watermark") else None
+
+
+@lru_cache(maxsize=8)
+def get_scramble_plan(exam_json: str) -> ScramblePlan:
+    return ScramblePlan(exam_json)
+
+
+def compile_scramble(exam) -> ScramblePlan:
+    """
+    Get a plan for scrambling the exam, reusing the previous one unless the exam has changed
+    """
+    return get_scramble_plan(json.dumps(exam))
+
+
+def get_substitution_keys(element):
+    keys = set(element.get("substitutions", {}))
+    for item in [
+        *element.get("substitutions_match", []),
+        *element.get("substitution_groups", []),
+    ]:
+        keys.update(item["directives"])
+    keys.update(element.get("substitution_ranges", {}))
+    for child in element.get("groups") or get_elements(element) or []:
+        keys |= get_substitution_keys(child)
+    return keys
+
+
 def get_elements(group):
     return group.get("elements") if "elements" in group else group.get("questions")
 
 
-def select_substitutions(element):
-    substitutions = select_regular(element.get("substitutions", {}))
-    substitutions.update(select_no_replace(element.get("substitutions_match", [])))
-    substitutions.update(select_group(element.get("substitution_groups", [])))
-    substitutions.update(select_ranges(element.get("substitution_ranges", {})))
+def select_substitutions(element, rng):
+    substitutions = select_regular(element.get("substitutions", {}), rng)
+    substitutions.update(select_no_replace(element.get("substitutions_match", []), rng))
+    substitutions.update(select_group(element.get("substitution_groups", []), rng))
+    substitutions.update(select_ranges(element.get("substitution_ranges", {}), rng))
     return substitutions
 
 
-def select_regular(substitutions):
+def select_regular(substitutions, rng):
     out = {}
     # DEFINE
     for k, v in sorted(substitutions.items()):
-        out[k] = random.choice(v)
+        out[k] = rng.choice(v)
     return out
 
 
-def select_no_replace(substitutions_match):
+def select_no_replace(substitutions_match, rng):
     out = {}
     # DEFINE MATCH
     for item in substitutions_match:
@@ -191,30 +472,30 @@ def select_no_replace(substitutions_match):
         v = item["replacements"]
         values = v.copy()
         for choice in k:
-            c = random.choice(values)
+            c = rng.choice(values)
             values.remove(c)
             out[choice] = c
     return out
 
 
-def select_group(substitution_groups):
+def select_group(substitution_groups, rng):
     out = {}
     # DEFINE GROUP
     for blocks in substitution_groups:
         k = blocks["directives"]
         v = dict_to_list(blocks["replacements"])
-        v = dict_to_list(random.choice(v))
+        v = dict_to_list(rng.choice(v))
         assert len(k) == len(v)
         for k0, v0 in zip(k, v):
             out[k0] = v0
     return out
 
 
-def select_ranges(substitution_ranges):
+def select_ranges(substitution_ranges, rng):
     out = {}
     # DEFINE RANGE
     for k, [low, high] in sorted(substitution_ranges.items()):
-        out[k] = str(random.randrange(low, high))
+        out[k] = str(rng.randrange(low, high))
     return out
 
 
@@ -1,13 +1,19 @@
 import json
 from dataclasses import dataclass
-from typing import Dict
+from multiprocessing import Pool
+from threading import Semaphore
+from typing import Dict, Iterable, List, Tuple
 
 from examtool.api.utils import dict_to_list
 from tqdm import tqdm
 
 from examtool.api.database import get_exam, get_roster
 from examtool.api.extract_questions import extract_questions, get_name
-from examtool.api.scramble import scramble, get_elements
+from examtool.api.scramble import compile_scramble, scramble, get_elements
+
+# the logs sent to each process at a time, and the most it may have been sent but not finished
+CHUNK_SIZE = 4
+LOGS_PER_PROCESS = 4 * CHUNK_SIZE
 
 
 @dataclass
@@ -31,57 +37,135 @@ class SuspectedCheating:
         )
 
 
-def find_unexpected_words(exam, logs):
-    data = get_exam(exam=exam)
-    exam_json = json.dumps(data)
-    original_questions = {q["id"]: q for q in extract_questions(json.loads(exam_json))}
-    suspected_cheating = []
-    for i, (email, log) in enumerate(tqdm(logs)):
-        all_alternatives = get_substitutions(data)
+class CheatingDetector:
+    """
+    Checks the logs of each student against the keywords used in the exams of other students.
+    Everything that does not depend on the student is computed once, up front, and
+    the variants each student could be flagged for are computed once per question,
+    so each answer in their log only has to be searched for those.
+    """
+
+    def __init__(self, exam_data):
+        self.scramble_plan = compile_scramble(exam_data)
+        self.original_questions = {
+            q["id"]: q for q in extract_questions(json.loads(json.dumps(exam_data)))
+        }
+        self.all_alternatives = get_substitutions(exam_data)
+
+    def get_candidates(self, question, scrambled_question):
+        # the (keyword, variant) pairs that would be suspicious in an answer to this question
+        student_substitutions = scrambled_question["substitutions"]
+        candidates = {}
+        for keyword in student_substitutions:
+            for variant in self.all_alternatives[question][keyword]:
+                if variant == student_substitutions[keyword]:
+                    continue
+                # variants that appear in the question itself are false positives
+                if variant in scrambled_question["text"]:
+                    continue
+                candidates[keyword, variant] = None
+        return list(candidates)
+
+    def check(self, email, log) -> List[SuspectedCheating]:
         scrambled_questions = {
             q["id"]: q
             for q in extract_questions(
-                scramble(email, json.loads(exam_json), keep_data=True), nest_all=True
+                self.scramble_plan.scramble(email, keep_data=True, cache=False),
+                nest_all=True,
             )
         }
-        flagged_question_variants = set()
+        # the candidates of each question that have not been flagged yet
+        remaining = {}
+        suspected_cheating = []
         for record in log:
             record.pop("timestamp")
             for question, answer in record.items():
                 question = question.split("|")[0]
-                if question not in all_alternatives:
+                if question not in self.all_alternatives:
                     continue
 
-                student_substitutions = scrambled_questions[question]["substitutions"]
+                if question not in remaining:
+                    remaining[question] = self.get_candidates(
+                        question, scrambled_questions[question]
+                    )
+
+                flagged = [
+                    (keyword, variant)
+                    for keyword, variant in remaining[question]
+                    if variant in answer
+                ]
+                if not flagged:
+                    continue
 
-                for keyword in student_substitutions:
-                    for variant in all_alternatives[question][keyword]:
-                        if variant == student_substitutions[keyword]:
-                            continue
-                        if (question, keyword, variant) in flagged_question_variants:
-                            continue
-                        if variant in answer:
-                            # check for false positives
-                            if variant in scrambled_questions[question]["text"]:
-                                continue
-
-                            flagged_question_variants.add((question, keyword, variant))
-
-                            suspected_cheating.append(
-                                SuspectedCheating(
-                                    get_name(original_questions[question]),
-                                    email,
-                                    keyword,
-                                    student_substitutions[keyword],
-                                    variant,
-                                    answer,
-                                    student_substitutions,
-                                )
-                            )
+                student_substitutions = scrambled_questions[question]["substitutions"]
+                for keyword, variant in flagged:
+                    suspected_cheating.append(
+                        SuspectedCheating(
+                            get_name(self.original_questions[question]),
+                            email,
+                            keyword,
+                            student_substitutions[keyword],
+                            variant,
+                            answer,
+                            student_substitutions,
+                        )
+                    )
+                remaining[question] = [
+                    candidate
+                    for candidate in remaining[question]
+                    if candidate not in flagged
+                ]
+
+        return suspected_cheating
+
+
+def find_unexpected_words(
+    exam, logs: Iterable[Tuple[str, list]], *, num_processes=1, total=None
+):
+    """
+    logs can be a generator, so that only the logs being checked need to be in memory at once
+    """
+    data = get_exam(exam=exam)
+    if total is None and hasattr(logs, "__len__"):
+        total = len(logs)
+    suspected_cheating = []
+    if num_processes > 1:
+        # the pool reads its tasks as fast as it can, so logs are only handed to it
+        # once earlier ones are done, rather than all being read into memory
+        in_flight = Semaphore(num_processes * LOGS_PER_PROCESS)
+
+        def feed():
+            for email_log in logs:
+                in_flight.acquire()
+                yield email_log
+
+        with Pool(num_processes, initializer=init_worker, initargs=(data,)) as p:
+            for suspects in tqdm(
+                p.imap(check_worker, feed(), chunksize=CHUNK_SIZE), total=total
+            ):
+                in_flight.release()
+                suspected_cheating.extend(suspects)
+    else:
+        detector = CheatingDetector(data)
+        for email, log in tqdm(logs, total=total):
+            suspected_cheating.extend(detector.check(email, log))
 
     return suspected_cheating
 
 
+# the detector used by each process in the pool
+worker_detector: CheatingDetector = None
+
+
+def init_worker(exam_data):
+    global worker_detector
+    worker_detector = CheatingDetector(exam_data)
+
+
+def check_worker(email_log):
+    return worker_detector.check(*email_log)
+
+
 def find_keyword(exam, phrase):
     data = get_exam(exam=exam)
     exam_json = json.dumps(data)
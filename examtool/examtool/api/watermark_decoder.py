@@ -1,29 +1,130 @@
-from json import dumps, loads
-from typing import List
+import hashlib
+import json
+import os
+from typing import List, Optional
 
 import numpy as np
 from tqdm import tqdm
 
-from examtool.api.scramble import scramble
+from examtool.api.scramble import ScramblePlan, compile_scramble
 from examtool.api.watermarks import Point, get_watermark_points
 
+# the number of observed bits furthest from any expected bit that are ignored, as stray clicks
+NUM_OUTLIERS = 5
 
-def decode_watermark(exam_data, roster, corners: List[Point], bits: List[Point]):
+
+class WatermarkTable:
+    """
+    The watermark points of every student on a roster, as an array of shape (students, points, 2)
+    """
+
+    def __init__(self, key: str, emails: List[str], points: np.ndarray):
+        self.key = key
+        self.emails = emails
+        self.points = points
+
+    @classmethod
+    def build(cls, exam_data, roster, key: str = None):
+        assert exam_data.get("watermark"), "This exam is not watermarked"
+        scramble_plan = compile_scramble(exam_data)
+        emails = [email for email, *_ in roster]
+        points = np.array(
+            [
+                [
+                    list(point)
+                    for point in get_watermark_points(scramble_plan.watermark(email))
+                ]
+                for email in tqdm(emails, desc="Computing watermarks")
+            ],
+            dtype=float,
+        )
+        return cls(key or get_table_key(exam_data, roster), emails, points)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(
+                str(data["key"]),
+                [str(email) for email in data["emails"]],
+                data["points"],
+            )
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(f, key=self.key, emails=np.array(self.emails), points=self.points)
+
+    def distances(self, observed_points: List[Point]) -> np.ndarray:
+        """
+        The bit_distance from the observed points to the watermark of every student
+        """
+        observed = np.array([list(point) for point in observed_points], dtype=float)
+        assert len(observed) >= self.points.shape[1] / 2, "Too few observed bits"
+        # (students, observed, expected)
+        squared_distances = (
+            (observed[np.newaxis, :, np.newaxis, :] - self.points[:, np.newaxis, :, :])
+            ** 2
+        ).sum(axis=3)
+        costs = squared_distances.min(axis=2) ** 2  # large penalty for misalignment
+        costs.sort(axis=1)
+        return costs[:, : max(len(observed) - NUM_OUTLIERS, 0)].mean(axis=1)
+
+
+def get_table_key(exam_data, roster):
+    # the watermarks depend on the exam and on who is taking it
+    return hashlib.sha256(
+        json.dumps([exam_data, [email for email, *_ in roster]], sort_keys=True).encode(
+            "utf-8"
+        )
+    ).hexdigest()
+
+
+def get_watermark_table(exam_data, roster, cache_path: Optional[str] = None):
+    """
+    Load the watermark table for the roster from cache_path,
+    computing and saving it if it is missing or out of date
+    """
+    key = get_table_key(exam_data, roster)
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            table = WatermarkTable.load(cache_path)
+        except (OSError, ValueError, KeyError):
+            table = None
+        if table is not None and table.key == key:
+            return table
+    table = WatermarkTable.build(exam_data, roster, key)
+    if cache_path is not None:
+        table.save(cache_path)
+    return table
+
+
+def decode_watermark(
+    exam_data,
+    roster,
+    corners: List[Point],
+    bits: List[Point],
+    *,
+    table: WatermarkTable = None,
+):
     """
     Assume x coord increases from left to right, y increases from top to bottom
     """
     observed_points = correct_watermark_bits(corners, bits)
-    email_distances = [
-        [email, bit_distance(observed_points, exam_data, email)]
-        for email, _ in tqdm(roster)
+    if table is None:
+        table = get_watermark_table(exam_data, roster)
+    distances = table.distances(observed_points)
+    return [
+        [table.emails[i], float(distances[i])]
+        for i in np.argsort(distances, kind="stable")[:10]
     ]
-    email_distances.sort(key=lambda x: x[1])
-    return email_distances[:10]
 
 
-def bit_distance(observed_points: List[Point], exam_data, email):
-    scrambled_exam = scramble(email, loads(dumps(exam_data)))
-    expected_points = get_watermark_points(scrambled_exam["watermark"]["value"])
+def bit_distance(
+    observed_points: List[Point], exam_data, email, scramble_plan: ScramblePlan = None
+):
+    if scramble_plan is None:
+        scramble_plan = compile_scramble(exam_data)
+    expected_points = get_watermark_points(scramble_plan.watermark(email))
     assert len(observed_points) >= len(expected_points) / 2, "Too few observed bits"
     costs = []
     for observed_point in observed_points:
@@ -32,7 +133,7 @@ def bit_distance(observed_points: List[Point], exam_data, email):
             observed_point.dist(closest) ** 2
         )  # large penalty for misalignment
     costs.sort()
-    del costs[-5:]
+    del costs[-NUM_OUTLIERS:]
     return sum(costs) / len(costs)
 
 
@@ -1,12 +1,11 @@
 import csv
-import json
 import os
-from collections import defaultdict
 from dataclasses import asdict
 
 import click
 
 from examtool.api.database import get_roster
+from examtool.api.saved_logs import FULL, SHORT, read_logs
 from examtool.api.substitution_finder import find_unexpected_words
 from examtool.cli.utils import exam_name_option, hidden_target_folder_option
 
@@ -20,34 +19,45 @@ from examtool.cli.utils import exam_name_option, hidden_target_folder_option
     default=None,
     help="Output a CSV containing the list of cheaters",
 )
-def cheaters(exam, target, out):
+@click.option(
+    "--num-processes",
+    default=os.cpu_count(),
+    type=int,
+    help="The number of processes to check logs with.",
+)
+def cheaters(exam, target, out, num_processes):
     """
     Identify potential instances of cheating.
     """
     if not target:
         target = "out/logs/" + exam
-    logs = defaultdict(list)
-    for email, deadline in get_roster(exam=exam):
-        short_target = os.path.join(target, email)
-        full_target = os.path.join(target, "full", email)
-        if os.path.exists(short_target):
-            with open(short_target) as f:
-                logs[email].extend(json.load(f))
-        if os.path.exists(full_target):
-            with open(full_target) as f:
-                data = json.load(f)
-                for record in data:
+
+    def read_all_logs():
+        # logs are read as they are needed, so they are not all in memory at once
+        for email, deadline in roster:
+            logs = []
+            short_logs = read_logs(target, email, SHORT)
+            full_logs = read_logs(target, email, FULL)
+            if short_logs is not None:
+                logs.extend(short_logs)
+            if full_logs is not None:
+                for record in full_logs:
                     if "snapshot" not in record:
                         print(email, record)
                     else:
-                        logs[email].append(
+                        logs.append(
                             {**record["snapshot"], "timestamp": record["timestamp"]}
                         )
-                        logs[email].append(
+                        logs.append(
                             {**record["history"], "timestamp": record["timestamp"]}
                         )
-    logs = list(logs.items())
-    suspects = find_unexpected_words(exam, logs)
+            if short_logs is not None or full_logs is not None:
+                yield email, logs
+
+    roster = get_roster(exam=exam)
+    suspects = find_unexpected_words(
+        exam, read_all_logs(), num_processes=num_processes, total=len(roster)
+    )
     if out:
         if suspects:
             writer = csv.writer(out)
@@ -6,7 +6,7 @@ from json import dump, load
 import click
 from pikepdf import Pdf
 
-from examtool.api.convert import convert, load_imports
+from examtool.api.convert import FragmentCache, convert, load_imports
 from examtool.api.database import get_exam
 from examtool.api.gen_latex import render_latex
 from examtool.api.scramble import scramble
@@ -77,6 +77,13 @@ from examtool.cli.utils import (
     type=int,
     help="The number of threads to process the JSON file.",
 )
+@click.option(
+    "--pandoc-cache",
+    default=".pandoc_cache",
+    type=click.Path(),
+    help="The folder to cache converted Markdown in, so unchanged parts are not reconverted. "
+    "Pass an empty string to disable.",
+)
 @click.option(
     "--require-explicit-ids",
     default=False,
@@ -97,6 +104,7 @@ def compile(
     merged_md,
     draft,
     num_threads,
+    pandoc_cache,
     require_explicit_ids,
     out,
 ):
@@ -128,6 +136,7 @@ def compile(
                 draft=draft,
                 num_threads=num_threads,
                 allow_random_ids=not require_explicit_ids,
+                cache=FragmentCache(pandoc_cache) if pandoc_cache else None,
             )
         except SyntaxError as e:
             print("SyntaxError:", e)
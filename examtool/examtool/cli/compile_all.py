@@ -1,17 +1,27 @@
+import hashlib
 import json
 import os
 import pathlib
+import shutil
+import tempfile
 from datetime import datetime
 from io import BytesIO
+from multiprocessing.pool import ThreadPool
 
 from pikepdf import Pdf, Encryption
 import click
 import pytz
+from tqdm import tqdm
 
 from examtool.api.database import get_exam, get_roster
 from examtool.api.utils import sanitize_email
-from examtool.api.scramble import scramble
-from examtool.api.gen_latex import render_latex
+from examtool.api.scramble import compile_scramble
+from examtool.api.gen_latex import (
+    LatexError,
+    compile_latex,
+    fetch_latex_images,
+    prepare_latex,
+)
 from examtool.cli.utils import (
     determine_semester,
     exam_name_option,
@@ -49,6 +59,12 @@ from examtool.cli.utils import (
     default=None,
     help="Generates exam regardless of if student is in roster with the set deadline.",
 )
+@click.option(
+    "--num-threads",
+    default=os.cpu_count(),
+    type=int,
+    help="The number of PDFs to compile simultaneously.",
+)
 def compile_all(
     exam,
     out,
@@ -58,10 +74,13 @@ def compile_all(
     exam_type,
     semester,
     deadline,
+    num_threads,
 ):
     """
     Compile individualized PDFs for the specified exam.
     Exam must have been deployed first.
+    Compiled PDFs are cached, so rerunning this command only recompiles
+    the students whose exams have changed.
     """
     if not out:
         out = "out/latex/" + exam
@@ -76,7 +95,7 @@ def compile_all(
         return
     password = exam_data.pop("secret")[:-1]
     print(password)
-    exam_str = json.dumps(exam_data)
+    scramble_plan = compile_scramble(exam_data)
 
     roster = get_roster(exam=exam, include_no_watermark=True)
 
@@ -88,11 +107,13 @@ def compile_all(
             else:
                 raise ValueError("Email does not exist in the roster!")
 
-    for email, deadline, no_watermark in roster:
-        if not deadline:
-            continue
-        exam_data = json.loads(exam_str)
-        scramble(email, exam_data)
+    cache_dir = os.path.join(out, ".cache")
+    image_cache = os.path.join(cache_dir, "images")
+    pathlib.Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    def compile_student(line_info):
+        email, deadline, no_watermark = line_info
+        exam_data = scramble_plan.scramble(email, cache=False)
         if no_watermark:
             exam_data.pop("watermark")
         deadline_utc = datetime.utcfromtimestamp(int(deadline))
@@ -101,7 +122,7 @@ def compile_all(
         )
         deadline_string = deadline_pst.strftime("%I:%M%p")
 
-        with render_latex(
+        latex, watermark, images = prepare_latex(
             exam_data,
             {
                 "emailaddress": sanitize_email(email),
@@ -111,16 +132,72 @@ def compile_all(
                 "examtype": exam_type,
                 "semester": semester,
             },
-            do_twice=do_twice,
-        ) as pdf:
-            pdf = Pdf.open(BytesIO(pdf))
-            pdf.save(
-                os.path.join(
-                    out, "exam_" + email.replace("@", "_").replace(".", "_") + ".pdf"
-                ),
-                encryption=Encryption(owner=password, user=password),
+            fetch_images=False,
+        )
+
+        # the compiled PDF only depends on what is passed to pdflatex
+        key = hashlib.sha256(
+            json.dumps([latex, watermark, images, do_twice]).encode("utf-8")
+        ).hexdigest()
+        cached = os.path.join(cache_dir, key + ".pdf")
+        warning = None
+        if os.path.exists(cached):
+            with open(cached, "rb") as f:
+                pdf = f.read()
+        else:
+            # each compilation gets its own working directory, so they can run in parallel
+            path = tempfile.mkdtemp(prefix="compile_", dir=cache_dir)
+            try:
+                fetch_latex_images(images, path, image_cache)
+                pdf = compile_latex(
+                    latex,
+                    watermark,
+                    do_twice=do_twice,
+                    path=path,
+                    quiet=True,
+                    check=True,
+                )
+            except LatexError as e:
+                if e.pdf is None:
+                    return email, e
+                # pdflatex often still produces a usable PDF, but it is not cached
+                # so that the next run tries again
+                pdf, warning = e.pdf, e
+            except Exception as e:
+                return email, e
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+            if warning is None:
+                with open(cached + ".tmp", "wb") as f:
+                    f.write(pdf)
+                os.replace(cached + ".tmp", cached)
+
+        pdf = Pdf.open(BytesIO(pdf))
+        pdf.save(
+            os.path.join(
+                out, "exam_" + email.replace("@", "_").replace(".", "_") + ".pdf"
+            ),
+            encryption=Encryption(owner=password, user=password),
+        )
+        pdf.close()
+        return email, warning
+
+    students = [line_info for line_info in roster if line_info[1]]
+    with ThreadPool(num_threads) as p:
+        results = list(
+            tqdm(
+                p.imap_unordered(compile_student, students),
+                total=len(students),
+                desc="Compiling",
+                unit="Exam",
             )
-            pdf.close()
+        )
+
+    for email, error in results:
+        if isinstance(error, LatexError) and error.pdf is not None:
+            print(f"Compiled the exam for {email} despite an error: {error}")
+        elif error is not None:
+            print(f"Failed to compile the exam for {email}: {error}")
 
 
 if __name__ == "__main__":
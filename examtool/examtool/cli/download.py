@@ -1,16 +1,11 @@
-import csv
-import os
 import pathlib
-from multiprocessing.pool import ThreadPool
 
 import click
-from tqdm import tqdm
 
 from examtool.api.render_html_export import render_html_exam
 from examtool.api.render_pdf_export import render_pdf_exam
 from examtool.cli.utils import exam_name_option, hidden_output_folder_option
 import examtool.api.download
-import examtool.api.assemble_export
 
 
 @click.command()
@@ -54,47 +49,30 @@ def download(
     (
         exam_json,
         template_questions,
-        email_to_data_map,
-        total,
-    ) = examtool.api.download.download(exam)
+        submissions,
+    ) = examtool.api.download.stream_download(exam)
 
-    with open(os.path.join(out, "summary.csv"), "w") as f:
-        writer = csv.writer(f)
-        for row in total:
-            writer.writerow(row)
+    def render(assembled_exam, target):
+        if via_html:
+            export = render_html_exam(assembled_exam)
+            export(target)
 
-    assembled_exams = examtool.api.assemble_export.export(
+        else:
+            pdf = render_pdf_exam(assembled_exam)
+            pdf.output(target)
+
+    examtool.api.download.export(
         template_questions,
-        email_to_data_map,
+        submissions,
         exam,
+        out,
         name_question,
         sid_question,
         substitute_in_question_text=with_substitutions,
+        render=render,
+        num_threads=num_threads,
     )
 
-    def render(name_exam):
-        name, exam = name_exam
-
-        target = os.path.join(out, f"{name}.pdf")
-
-        if via_html:
-            export = render_html_exam(exam)
-            export(target)
-
-        else:
-            pdf = render_pdf_exam(exam)
-            pdf.output(target)
-
-    with ThreadPool(num_threads) as p:
-        list(
-            tqdm(
-                p.imap_unordered(render, assembled_exams.items()),
-                total=len(assembled_exams),
-                desc="Rendering",
-                unit="Exam",
-            )
-        )
-
 
 if __name__ == "__main__":
     download()
@@ -98,6 +98,18 @@ from examtool.api.gradescope_autograde import GradescopeGrader
     type=int,
     help="This is the number of simultaneous jobs of a question currently being processed. Note this is per question. Default: 10",
 )
+@click.option(
+    "--max-requests",
+    default=10,
+    type=int,
+    help="This is the most requests which will be sent to Gradescope at once, across all jobs. It is lowered automatically if Gradescope throttles requests. Default: 10",
+)
+@click.option(
+    "--resync",
+    default=False,
+    is_flag=True,
+    help="Send everything to Gradescope again, rather than only what has changed since the last run into the same target folder. Use this if the assignment was edited on Gradescope.",
+)
 @hidden_target_folder_option
 def gradescope_autograde(
     exam,
@@ -118,6 +130,8 @@ def gradescope_autograde(
     custom_grouper,
     jobs,
     sub_jobs,
+    max_requests,
+    resync,
     target,
 ):
     """
@@ -142,6 +156,7 @@ def gradescope_autograde(
         gs_login_tokens_path=token,
         simultaneous_jobs=jobs,
         simultaneous_sub_jobs=sub_jobs,
+        max_requests=max_requests,
     )
 
     email_mutation_list = None
@@ -175,6 +190,7 @@ def gradescope_autograde(
             question_numbers=question_numbers,
             blacklist_question_numbers=blacklist_question_numbers,
             custom_grouper_map=grouper_map,
+            resync=resync,
         )
     else:
         grader.add_additional_exams(
@@ -190,6 +206,7 @@ def gradescope_autograde(
             question_numbers=question_numbers,
             blacklist_question_numbers=blacklist_question_numbers,
             custom_grouper_map=grouper_map,
+            resync=resync,
         )
 
 
@@ -1,24 +1,41 @@
+import os
+
 import click
 import cv2
 
 from examtool.api.database import get_exam, get_roster
-from examtool.api.watermark_decoder import decode_watermark
+from examtool.api.watermark_decoder import decode_watermark, get_watermark_table
 from examtool.api.watermarks import Point
-from examtool.cli.utils import exam_name_option
+from examtool.cli.utils import exam_name_option, hidden_output_folder_option
 
 
 @click.command()
 @exam_name_option
 @click.option(
     "--image",
-    prompt=True,
+    "images",
+    required=True,
+    multiple=True,
     type=click.Path(exists=True),
-    help="The image or screenshot you wish to identify.",
+    help="The image or screenshot you wish to identify. Can be repeated to identify several.",
 )
-def identify_watermark(exam, image):
+@hidden_output_folder_option
+def identify_watermark(exam, images, out):
     """
     Identify the student from a screenshot containing a watermark.
+    The watermarks of the roster are computed once and cached, so later lookups are fast.
     """
+    out = out or "out/watermarks/" + exam
+    exam_data = get_exam(exam=exam)
+    roster = get_roster(exam=exam)
+    table = get_watermark_table(exam_data, roster, os.path.join(out, "table.npz"))
+    for image in images:
+        corners, bits = select_points(image)
+        print(image)
+        print(decode_watermark(exam_data, roster, corners, bits, table=table))
+
+
+def select_points(image):
     img = cv2.imread(image)
     img = cv2.copyMakeBorder(img, 100, 100, 100, 100, cv2.BORDER_CONSTANT)
 
@@ -40,4 +57,4 @@ def identify_watermark(exam, image):
         if cv2.waitKey(20) & 0xFF == 13:
             break
 
-    print(decode_watermark(get_exam(exam=exam), get_roster(exam=exam), corners, bits))
+    return corners, bits
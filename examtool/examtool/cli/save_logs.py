@@ -1,10 +1,18 @@
-import json
-import os
 import pathlib
+from multiprocessing.pool import ThreadPool
 
 import click
+from tqdm import tqdm
 
 from examtool.api.database import get_full_logs, get_roster, get_logs
+from examtool.api.saved_logs import (
+    FULL,
+    SHORT,
+    LogManifest,
+    fetch_with_retry,
+    get_log_path,
+    write_logs,
+)
 from examtool.cli.utils import exam_name_option, hidden_output_folder_option
 
 
@@ -20,40 +28,82 @@ from examtool.cli.utils import exam_name_option, hidden_output_folder_option
     is_flag=True,
     help="Re-download all logs.",
 )
-def save_logs(exam, out, full, fetch_all):
+@click.option(
+    "--num-threads",
+    default=16,
+    type=int,
+    help="The number of logs to download simultaneously.",
+)
+@click.option(
+    "--retries",
+    default=4,
+    type=int,
+    help="The number of times to retry a failed download.",
+)
+@click.option(
+    "--backoff",
+    default=1.0,
+    type=float,
+    help="The initial delay in seconds before retrying, doubled after each attempt.",
+)
+def save_logs(exam, out, full, fetch_all, num_threads, retries, backoff):
     """
     Save the full submission log for later analysis.
-    Note that this command is slow.
+    Logs are saved as gzipped JSON Lines, one file per student,
+    and are downloaded concurrently. An interrupted run resumes where it left off.
     To view a single log entry, run `examtool log`.
     """
     out = out or "out/logs/" + exam
-    full_out = os.path.join(out, "full")
 
     pathlib.Path(out).mkdir(parents=True, exist_ok=True)
-    pathlib.Path(full_out).mkdir(parents=True, exist_ok=True)
+    pathlib.Path(out, "full").mkdir(parents=True, exist_ok=True)
+
+    manifest = LogManifest(out)
+    fetchers = {SHORT: get_logs, FULL: get_full_logs}
+    kinds = [SHORT, FULL] if full else [SHORT]
 
     roster = get_roster(exam=exam)
-    for i, (email, deadline) in enumerate(roster):
-        print(email)
+    jobs = [
+        (email, kind)
+        for email, deadline in roster
+        for kind in kinds
+        if fetch_all or not manifest.is_saved(out, email, kind)
+    ]
+    print(f"Skipping {len(roster) * len(kinds) - len(jobs)} logs already saved.")
+
+    def fetch(job):
+        email, kind = job
         try:
-            target = os.path.join(out, email)
-            if os.path.exists(target) and not fetch_all:
-                print("Skipping", email)
-            else:
-                print("Fetching short logs for", email)
-                logs = get_logs(exam=exam, email=email)
-                with open(target, "w") as f:
-                    json.dump(logs, f)
-            if full:
-                target = os.path.join(full_out, email)
-                if os.path.exists(target) and not fetch_all:
-                    print("Skipping", email, "for full logs")
-                else:
-                    print("Fetching full logs for", email)
-                    logs = get_full_logs(exam=exam, email=email)
-                    with open(os.path.join(full_out, email), "w") as f:
-                        json.dump(logs, f)
+            logs = fetch_with_retry(
+                lambda: fetchers[kind](exam=exam, email=email),
+                retries=retries,
+                backoff=backoff,
+            )
+            write_logs(get_log_path(out, email, kind), logs)
         except KeyboardInterrupt:
             raise
-        except:
-            print("Failure for email", email, "continuing...")
+        except Exception as e:
+            manifest.record(email, kind, error=repr(e))
+        else:
+            manifest.record(email, kind, count=len(logs))
+
+    with ThreadPool(num_threads) as p:
+        list(
+            tqdm(
+                p.imap_unordered(fetch, jobs),
+                total=len(jobs),
+                desc="Fetching",
+                unit="Log",
+            )
+        )
+
+    attempted = set(jobs)
+    failures = [
+        (email, kind, error)
+        for email, kind, error in manifest.failures()
+        if (email, kind) in attempted
+    ]
+    for email, kind, error in failures:
+        print(f"Failed to fetch {kind} logs for {email}: {error}")
+    if failures:
+        print(f"{len(failures)} logs failed, rerun this command to retry them.")
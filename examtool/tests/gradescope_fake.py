@@ -0,0 +1,414 @@
+"""
+An in-memory stand-in for the parts of Gradescope used by the autograder, for testing it without the network.
+FakeGradescope is a requests transport adapter, so the real Gradescope clients run unmodified on top of it.
+"""
+import csv
+import html
+import json
+import re
+import time
+import zipfile
+from collections import Counter
+from datetime import datetime, timedelta
+from io import BytesIO, StringIO
+from itertools import count
+from threading import Lock
+from urllib.parse import urlparse
+
+import pytz
+from fullGSapi.api.client import GradescopeClient
+from fullGSapi.api.gs_api_client import GradescopeAPIClient
+from fullGSapi.api.login_tokens import LoginTokens
+from requests import Response
+from requests.adapters import BaseAdapter
+
+PAGE = '<html><head><meta name="csrf-token" content="fake-csrf-token"></head><body>{}</body></html>'
+
+
+class FakeGradescope(BaseAdapter):
+    """
+    If max_concurrency is set, requests beyond that many in flight at once are throttled with a 429,
+    and each request takes latency seconds, as they would against the real Gradescope.
+    The number of requests made to each route is counted in `requests`.
+    """
+
+    def __init__(self, *, max_concurrency=None, latency=0):
+        super().__init__()
+        self.max_concurrency = max_concurrency
+        self.latency = latency
+        self.in_flight = 0
+        self.lock = Lock()
+        self.ids = count(1000)
+        self.requests = Counter()
+        self.throttled = 0
+
+        self.assignments = {}
+        self.questions = {}
+
+        self.routes = [
+            ("GET", r"/login", self.get_login),
+            ("GET", r"/courses/(\w+)/assignments/rubrics", self.get_rubrics),
+            ("GET", r"/courses/(\w+)/assignments/(\w+)/outline/edit", self.get_outline),
+            ("PATCH", r"/courses/(\w+)/assignments/(\w+)/outline/", self.edit_outline),
+            ("GET", r"/courses/(\w+)/assignments/(\w+)/scores\.csv", self.get_scores),
+            (
+                "GET",
+                r"/courses/(\w+)/assignments/(\w+)/export_evaluations",
+                self.export_evaluations,
+            ),
+            ("PATCH", r"/courses/(\w+)/questions/(\w+)", self.set_group_type),
+            (
+                "GET",
+                r"/courses/(\w+)/questions/(\w+)/answer_groups\.json",
+                self.get_groups,
+            ),
+            ("POST", r"/courses/(\w+)/questions/(\w+)/answer_groups", self.add_group),
+            (
+                "POST",
+                r"/courses/(\w+)/questions/(\w+)/answer_group_memberships/many",
+                self.group_submissions,
+            ),
+            (
+                "POST",
+                r"/courses/(\w+)/questions/(\w+)/rubric_items",
+                self.add_rubric_item,
+            ),
+            (
+                "PUT",
+                r"/courses/(\w+)/questions/(\w+)/rubric_items/(\w+)",
+                self.update_rubric_item,
+            ),
+            (
+                "DELETE",
+                r"/courses/(\w+)/questions/(\w+)/rubric_items/(\w+)",
+                self.delete_rubric_item,
+            ),
+            (
+                "POST",
+                r"/courses/(\w+)/questions/(\w+)/submissions/(\w+)/(save_grade|save_many_grades)",
+                self.grade,
+            ),
+            (
+                "POST",
+                r"/api/v1/courses/(\w+)/assignments/(\w+)/submissions",
+                self.upload_submission,
+            ),
+            # Any other page is only fetched for its CSRF token
+            ("GET", r"/.*", self.get_page),
+        ]
+
+    def add_assignment(self, course_id):
+        assignment_id = str(next(self.ids))
+        self.assignments[assignment_id] = {
+            "course": str(course_id),
+            "outline": [],
+            "id_regions": {},
+            "submissions": {},
+        }
+        return assignment_id
+
+    def get_writes(self):
+        return sum(n for route, n in self.requests.items() if route[0] != "GET")
+
+    def send(self, request, **kwargs):
+        path = urlparse(request.url).path
+        for method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, path)
+            if method == request.method and match:
+                break
+        else:
+            return make_response(request, 404)
+
+        with self.lock:
+            self.in_flight += 1
+            throttled = (
+                self.max_concurrency is not None
+                and self.in_flight > self.max_concurrency
+            )
+            if throttled:
+                self.throttled += 1
+        try:
+            if throttled:
+                return make_response(request, 429)
+            time.sleep(self.latency)
+            with self.lock:
+                self.requests[(method, pattern)] += 1
+                return handler(request, *match.groups())
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def close(self):
+        pass
+
+    def get_login(self, request):
+        # Gradescope refuses to show the login page to someone who is logged in
+        return make_response(request, 401)
+
+    def get_page(self, request):
+        return make_response(request, 200, PAGE.format(""), "text/html")
+
+    def get_outline(self, request, course_id, assignment_id):
+        assignment = self.assignments[assignment_id]
+        props = {
+            "outline": [self.get_outline_question(q) for q in assignment["outline"]],
+            "assignment": {"id": assignment_id, "id_regions": assignment["id_regions"]},
+        }
+        page = PAGE.format(
+            '<div data-react-class="AssignmentOutline" data-react-props="{}"></div>'.format(
+                html.escape(json.dumps(props))
+            )
+        )
+        return make_response(request, 200, page, "text/html")
+
+    def get_outline_question(self, qid):
+        question = self.questions[qid]
+        data = {
+            "id": qid,
+            "title": question["title"],
+            "weight": question["weight"],
+            "crop_rect_list": question["crop_rect_list"],
+        }
+        if question["children"]:
+            data["children"] = [
+                self.get_outline_question(c) for c in question["children"]
+            ]
+        return data
+
+    def edit_outline(self, request, course_id, assignment_id):
+        assignment = self.assignments[assignment_id]
+        data = json.loads(request.body)
+        assignment["id_regions"] = data["assignment"]["identification_regions"]
+        assignment["outline"] = [
+            self.make_question(assignment_id, q) for q in data["question_data"]
+        ]
+        for email in assignment["submissions"]:
+            self.add_question_submissions(assignment_id, email)
+        return make_response(request, 200, {})
+
+    def make_question(self, assignment_id, data):
+        qid = str(data.get("id") or next(self.ids))
+        question = self.questions.setdefault(
+            qid,
+            {
+                "assignment": assignment_id,
+                "group_type": None,
+                "groups": [],
+                "rubric_items": [],
+                "submissions": {},
+            },
+        )
+        question["title"] = data.get("title", "")
+        question["weight"] = data.get("weight", 0)
+        question["crop_rect_list"] = data["crop_rect_list"]
+        question["children"] = [
+            self.make_question(assignment_id, child)
+            for child in data.get("children", [])
+        ]
+        if not question["children"] and not question["rubric_items"]:
+            self.make_rubric_item(qid, "Correct", question["weight"])
+        return qid
+
+    def get_leaf_questions(self, assignment_id):
+        def leaves(qids, prefix):
+            for i, qid in enumerate(qids, 1):
+                children = self.questions[qid]["children"]
+                if children:
+                    yield from leaves(children, f"{prefix}{i}.")
+                else:
+                    yield f"{prefix}{i}", qid
+
+        return list(leaves(self.assignments[assignment_id]["outline"], ""))
+
+    def add_question_submissions(self, assignment_id, email):
+        submission_id = self.assignments[assignment_id]["submissions"][email]
+        for number, qid in self.get_leaf_questions(assignment_id):
+            submissions = self.questions[qid]["submissions"]
+            if any(s["submission"] == submission_id for s in submissions.values()):
+                continue
+            qsid = str(next(self.ids))
+            submissions[qsid] = {
+                "submission": submission_id,
+                "group": None,
+                "graded": False,
+                "rubric_items": [],
+            }
+
+    def upload_submission(self, request, course_id, assignment_id):
+        assignment = self.assignments[assignment_id]
+        body = request.body.decode("utf-8", "replace")
+        email = re.search(r'name="owner_email"\r\n\r\n(.*?)\r\n', body).group(1)
+        if email not in assignment["submissions"]:
+            assignment["submissions"][email] = str(next(self.ids))
+        self.add_question_submissions(assignment_id, email)
+        return make_response(request, 200, {"id": assignment["submissions"][email]})
+
+    def get_scores(self, request, course_id, assignment_id):
+        f = StringIO()
+        writer = csv.writer(f)
+        writer.writerow(["Email", "Submission ID"])
+        for email, submission_id in self.assignments[assignment_id][
+            "submissions"
+        ].items():
+            writer.writerow([email, submission_id])
+        return make_response(request, 200, f.getvalue(), "text/csv")
+
+    def export_evaluations(self, request, course_id, assignment_id):
+        f = BytesIO()
+        with zipfile.ZipFile(f, "w") as z:
+            for number, qid in self.get_leaf_questions(assignment_id):
+                question = self.questions[qid]
+                rows = StringIO()
+                writer = csv.writer(rows)
+                writer.writerow(["Assignment Submission ID", "Question Submission ID"])
+                for qsid, submission in question["submissions"].items():
+                    writer.writerow([submission["submission"], qsid])
+                title = re.sub(r"\W", "_", question["title"])
+                z.writestr(f"export/{number}_{title}.csv", rows.getvalue())
+        return make_response(request, 200, f.getvalue(), "application/zip")
+
+    def set_group_type(self, request, course_id, qid):
+        data = json.loads(request.body)
+        self.questions[qid]["group_type"] = data["question"]["assisted_grading_type"]
+        return make_response(request, 200, {})
+
+    def get_groups(self, request, course_id, qid):
+        question = self.questions[qid]
+        return make_response(
+            request,
+            200,
+            {
+                "status": "ready",
+                "groups": question["groups"],
+                "submissions": [
+                    {"id": qsid, "graded": submission["graded"]}
+                    for qsid, submission in question["submissions"].items()
+                ],
+            },
+        )
+
+    def add_group(self, request, course_id, qid):
+        question = self.questions[qid]
+        data = json.loads(request.body)
+        group = {
+            "id": str(next(self.ids)),
+            "question_id": qid,
+            "question_type": question["group_type"],
+            "position": len(question["groups"]),
+            "internal_title": data.get("internal_title"),
+            "title": data.get("title"),
+            "hidden": False,
+        }
+        question["groups"].append(group)
+        return make_response(request, 200, group)
+
+    def group_submissions(self, request, course_id, qid):
+        question = self.questions[qid]
+        data = json.loads(request.body)
+        for qsid in data["submission_ids"]:
+            question["submissions"][str(qsid)]["group"] = data["answer_group_id"]
+        return make_response(request, 200, {})
+
+    def get_rubrics(self, request, course_id):
+        assignments = []
+        for assignment_id, assignment in self.assignments.items():
+            if assignment["course"] != course_id:
+                continue
+            questions = [
+                {"id": qid, "rubric_items": self.questions[qid]["rubric_items"]}
+                for number, qid in self.get_leaf_questions(assignment_id)
+            ]
+            assignments.append({"id": assignment_id, "questions": questions})
+        return make_response(request, 200, {"assignments": assignments})
+
+    def make_rubric_item(self, qid, description, weight):
+        rubric_items = self.questions[qid]["rubric_items"]
+        item = {
+            "id": str(next(self.ids)),
+            "description": description,
+            "weight": weight,
+            "group_id": None,
+            "position": len(rubric_items),
+        }
+        rubric_items.append(item)
+        return item
+
+    def get_rubric_item(self, qid, item_id):
+        for item in self.questions[qid]["rubric_items"]:
+            if item["id"] == item_id:
+                return item
+
+    def add_rubric_item(self, request, course_id, qid):
+        data = json.loads(request.body)["rubric_item"]
+        item = self.make_rubric_item(qid, data["description"], float(data["weight"]))
+        return make_response(request, 200, item)
+
+    def update_rubric_item(self, request, course_id, qid, item_id):
+        item = self.get_rubric_item(qid, item_id)
+        if item is None:
+            return make_response(request, 404)
+        data = json.loads(request.body)
+        for field in ["description", "weight"]:
+            if field in data:
+                item[field] = data[field]
+        return make_response(request, 200, item)
+
+    def delete_rubric_item(self, request, course_id, qid, item_id):
+        item = self.get_rubric_item(qid, item_id)
+        if item is None:
+            return make_response(request, 404)
+        self.questions[qid]["rubric_items"].remove(item)
+        return make_response(request, 200, {})
+
+    def grade(self, request, course_id, qid, qsid, action):
+        question = self.questions[qid]
+        data = json.loads(request.body)
+        selected = []
+        for item_id, score in data["rubric_items"].items():
+            if self.get_rubric_item(qid, str(item_id)) is None:
+                return make_response(request, 410, {"error": "changed"})
+            if json.loads(score["score"]):
+                selected.append(str(item_id))
+        graded = [question["submissions"][qsid]]
+        group = graded[0]["group"]
+        if action == "save_many_grades" and group is not None:
+            graded = [
+                s for s in question["submissions"].values() if s["group"] == group
+            ]
+        for submission in graded:
+            submission["graded"] = True
+            submission["rubric_items"] = selected
+        return make_response(request, 200, {})
+
+
+def make_response(request, status_code, content=b"", content_type="application/json"):
+    response = Response()
+    response.status_code = status_code
+    response.request = request
+    response.url = request.url
+    response.encoding = "utf-8"
+    response.headers["Content-Type"] = content_type
+    if isinstance(content, (dict, list)):
+        content = json.dumps(content)
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    response._content = content
+    return response
+
+
+def fake_login_tokens(gradescope: FakeGradescope, email="grader@example.com"):
+    """
+    Login tokens whose Gradescope clients send every request to the fake Gradescope,
+    to be passed to GradescopeGrader
+    """
+    gs_api_client = GradescopeAPIClient()
+    gs_api_client.token = "fake-token"
+    gs_api_client.cookie = {
+        "token": gs_api_client.token,
+        "token_expiration_time": str(datetime.now(pytz.UTC) + timedelta(days=1)),
+    }
+    gs_client = GradescopeClient()
+    gs_client.logged_in = True
+    for client in [gs_api_client, gs_client]:
+        client.session.mount("https://", gradescope)
+    return LoginTokens(email=email, gsAPI=gs_api_client, gsFullapi=gs_client)
@@ -0,0 +1,179 @@
+"""
+Runs the Gradescope autograder against an in-memory Gradescope.
+Run with `pytest tests` after installing examtool with `pip install -e .[cli]`.
+"""
+import os
+import random
+
+import pytest
+
+from examtool.api.gradescope_autograde import ExamtoolOutline, GradescopeGrader
+from gradescope_fake import FakeGradescope, fake_login_tokens
+
+NUM_STUDENTS = 12
+QUESTION_TYPES = ["multiple_choice", "select_all", "short_answer", "long_answer"]
+
+
+def make_exam(num_questions=4):
+    groups = []
+    for g in range(2):
+        elements = []
+        for i in range(num_questions):
+            question = {
+                "id": f"q{g}_{i}",
+                "type": QUESTION_TYPES[i % len(QUESTION_TYPES)],
+                "name": f"Q{g}.{i}",
+                "points": 2,
+                "text": "",
+                "html": "",
+                "tex": "",
+            }
+            if question["type"] in ["multiple_choice", "select_all"]:
+                question["options"] = [{"text": option} for option in "abcd"]
+                question["solution"] = {"options": ["a"]}
+            else:
+                question["solution"] = {"solution": {"text": "answer"}}
+            elements.append(question)
+        groups.append(
+            {
+                "type": "group",
+                "name": f"G{g}",
+                "text": "",
+                "html": "",
+                "tex": "",
+                "points": 2 * num_questions,
+                "elements": elements,
+            }
+        )
+    return {"public": None, "groups": groups}
+
+
+def make_responses(rand, exam):
+    responses = {}
+    for group in exam["groups"]:
+        for question in group["elements"]:
+            if question["type"] == "multiple_choice":
+                responses[question["id"]] = rand.choice(["a", "b", "c"])
+            elif question["type"] == "select_all":
+                responses[question["id"]] = rand.sample("abcd", rand.randrange(3))
+            elif question["type"] == "short_answer":
+                responses[question["id"]] = rand.choice(["answer", "", "ANSWER "])
+            else:
+                responses[question["id"]] = rand.choice(["some text", ""])
+    return responses
+
+
+@pytest.fixture
+def exam_export(tmp_path):
+    rand = random.Random(0)
+    exam = make_exam()
+    email_to_data_map = {}
+    for i in range(NUM_STUDENTS):
+        email = f"student{i}@berkeley.edu"
+        email_to_data_map[email] = {
+            "responses": make_responses(rand, exam),
+            "student_questions": [],
+        }
+        with open(os.path.join(tmp_path, email + ".pdf"), "w") as f:
+            f.write("pdf")
+    return str(tmp_path), exam, email_to_data_map
+
+
+def sync(gradescope, assignment_id, out, exam, email_to_data_map):
+    """
+    Follows GradescopeGrader.main, except that the exam is given instead of downloaded
+    """
+    grader = GradescopeGrader(gs_login_tokens=fake_login_tokens(gradescope))
+    grader.limiter.backoff = 0.01
+    grader.load_sync_state(out)
+    assignment_grader = grader.get_assignment_grader("1", assignment_id)
+    num_pages = sum(len(group["elements"]) for group in exam["groups"]) + 1
+    examtool_outline = ExamtoolOutline(
+        assignment_grader, exam, ["name", "sid"], list(range(1, num_pages + 1))
+    )
+    grader.upload_outline(assignment_grader, examtool_outline)
+    failed_uploads = grader.upload_student_submissions(
+        out,
+        "1",
+        assignment_id,
+        emails=email_to_data_map.keys(),
+        digests=grader.get_submission_digests(email_to_data_map),
+    )
+    assert not failed_uploads
+    gs_outline = examtool_outline.get_gs_outline()
+    grader.set_group_types(gs_outline)
+    grader.process_questions(
+        gs_outline,
+        None,
+        None,
+        email_to_data_map,
+        assignment_grader.email_to_qids(),
+        "name",
+        "sid",
+        None,
+    )
+
+
+def get_grades(gradescope):
+    return {
+        qid: [
+            (submission["group"], submission["rubric_items"])
+            for submission in question["submissions"].values()
+        ]
+        for qid, question in gradescope.questions.items()
+    }
+
+
+def check_graded(gradescope, exam, email_to_data_map):
+    """
+    Every submission should be graded, except for long answers that were not left blank,
+    which are left to be graded by hand
+    """
+    num_questions = sum(len(group["elements"]) for group in exam["groups"])
+    num_manual = sum(
+        1
+        for group in exam["groups"]
+        for question in group["elements"]
+        for data in email_to_data_map.values()
+        if question["type"] == "long_answer" and data["responses"][question["id"]]
+    )
+    submissions = [
+        submission
+        for question in gradescope.questions.values()
+        for submission in question["submissions"].values()
+    ]
+    assert len(submissions) == num_questions * len(email_to_data_map)
+    graded = [submission for submission in submissions if submission["graded"]]
+    assert len(graded) == len(submissions) - num_manual
+    assert all(submission["group"] is not None for submission in graded)
+
+
+def test_first_sync_grades_every_submission(exam_export):
+    gradescope = FakeGradescope()
+    assignment_id = gradescope.add_assignment("1")
+    sync(gradescope, assignment_id, *exam_export)
+
+    check_graded(gradescope, *exam_export[1:])
+
+
+def test_unchanged_rerun_only_reads_assignment(exam_export):
+    gradescope = FakeGradescope()
+    assignment_id = gradescope.add_assignment("1")
+    sync(gradescope, assignment_id, *exam_export)
+    grades = get_grades(gradescope)
+
+    gradescope.requests.clear()
+    sync(gradescope, assignment_id, *exam_export)
+
+    assert gradescope.get_writes() == 0
+    assert sum(gradescope.requests.values()) == 4
+    assert get_grades(gradescope) == grades
+
+
+def test_throttled_sync_grades_every_submission(exam_export):
+    gradescope = FakeGradescope(max_concurrency=2)
+    assignment_id = gradescope.add_assignment("1")
+    sync(gradescope, assignment_id, *exam_export)
+
+    assert gradescope.throttled > 0
+    check_graded(gradescope, *exam_export[1:])
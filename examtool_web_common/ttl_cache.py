@@ -0,0 +1,37 @@
+import time
+from threading import Lock
+
+MAX_ENTRIES = 10000
+
+
+class TTLCache:
+    """
+    Caches values for ttl seconds. Each instance of a function has its own cache,
+    so a change can take up to ttl seconds to be seen. None is never cached.
+    """
+
+    def __init__(self, ttl, *, max_entries=MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.entries = {}
+
+    def get(self, key, fetch):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        value = fetch()
+        if value is not None:
+            with self.lock:
+                if len(self.entries) >= self.max_entries:
+                    self.entries = {k: v for k, v in self.entries.items() if v[0] > now}
+                    if len(self.entries) >= self.max_entries:
+                        self.entries.clear()
+                self.entries[key] = (now + self.ttl, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -4,6 +4,8 @@ import functools
 import os
 import random
 import sys
+import tempfile
+import time
 
 import alembic
 import names
@@ -13,12 +15,16 @@ from flask import render_template
 from flask_debugtoolbar import DebugToolbarExtension
 from flask_migrate import Migrate, MigrateCommand
 from flask_script import Manager
+from sqlalchemy import event
 
 from common.course_config import get_course
 from oh_queue import app
 from oh_queue.models import (
     db,
     Assignment,
+    ChatMessage,
+    Group,
+    GroupAttendance,
     Location,
     Ticket,
     TicketStatus,
@@ -133,6 +139,224 @@ def seed_data():
     db.session.commit()
 
 
+def seed_queue(num_tickets):
+    """Seeds an active queue of num_tickets tickets, with a quarter of them belonging to
+    groups, and one appointment for every five tickets, all with chat messages.
+    """
+    assignment = Assignment(name="Hog", course=get_course(), visible=True)
+    location = Location(
+        name="109 Morgan", course=get_course(), visible=True, online=False, link=""
+    )
+    staff = [
+        User(
+            name=names.get_full_name(),
+            email="staff{}@berkeley.edu".format(i),
+            is_staff=True,
+            course=get_course(),
+        )
+        for i in range(10)
+    ]
+    db.session.add_all(staff)
+
+    def make_student():
+        student = User(
+            name=names.get_full_name(),
+            email="{}@berkeley.edu".format(random.getrandbits(64)),
+            course=get_course(),
+        )
+        db.session.add(student)
+        return student
+
+    def make_message(student, **kwargs):
+        for user in [student, random.choice(staff)]:
+            db.session.add(
+                ChatMessage(user=user, body="Hello!", course=get_course(), **kwargs)
+            )
+
+    for i in range(num_tickets):
+        student = make_student()
+        ticket = Ticket(
+            user=student,
+            helper=random.choice(staff + [None]),
+            status=random.choice([TicketStatus.pending, TicketStatus.assigned]),
+            assignment=assignment,
+            location=location,
+            question=str(i),
+            course=get_course(),
+        )
+        db.session.add(ticket)
+        make_message(student, ticket=ticket)
+        if i % 4 == 0:
+            group = Group(
+                assignment=assignment,
+                location=location,
+                question=str(i),
+                ticket=ticket,
+                course=get_course(),
+            )
+            db.session.add(group)
+            for attendee in [student, make_student(), make_student()]:
+                db.session.add(
+                    GroupAttendance(group=group, user=attendee, course=get_course())
+                )
+            make_message(student, group=group)
+        if i % 5 == 0:
+            appointment = Appointment(
+                start_time=datetime.datetime.now(),
+                duration=datetime.timedelta(minutes=30),
+                location=location,
+                helper=random.choice(staff),
+                capacity=5,
+                status=AppointmentStatus.pending,
+                course=get_course(),
+            )
+            db.session.add(appointment)
+            for _ in range(3):
+                db.session.add(
+                    AppointmentSignup(
+                        appointment=appointment,
+                        user=make_student(),
+                        assignment=assignment,
+                        question=str(i),
+                        course=get_course(),
+                    )
+                )
+            make_message(student, appointment=appointment)
+
+    db.session.commit()
+
+
+@manager.command
+@not_in_production
+def benchmark_queries():
+    """Counts the queries needed to serialize each section of the queue state,
+    against freshly seeded SQLite databases of increasing queue lengths, and fails
+    if any of the counts grows with the length of the queue.
+    """
+    from oh_queue.views import (
+        load_appointments,
+        load_groups,
+        load_helpers,
+        load_tickets,
+    )
+
+    sections = {
+        "tickets": load_tickets,
+        "groups": load_groups,
+        "appointments": load_appointments,
+        "helpers": load_helpers,
+    }
+    queue_lengths = [10, 100, 500]
+    counts = {}
+
+    queries = []
+
+    def count_query(*args):
+        queries.append(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for num_tickets in queue_lengths:
+            app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///{}/{}.db".format(
+                directory, num_tickets
+            )
+            db.create_all()
+            seed_queue(num_tickets)
+            event.listen(db.engine, "before_cursor_execute", count_query)
+            for name, load in sections.items():
+                # start from an empty identity map, as a new request would
+                db.session.remove()
+                queries.clear()
+                start = time.time()
+                load()
+                counts[name, num_tickets] = len(queries)
+                print(
+                    "{:>12} with {:>4} tickets: {:>3} queries in {:.3f}s".format(
+                        name, num_tickets, len(queries), time.time() - start
+                    )
+                )
+            event.remove(db.engine, "before_cursor_execute", count_query)
+            db.session.remove()
+
+    failed = [
+        name
+        for name in sections
+        if counts[name, queue_lengths[-1]] > counts[name, queue_lengths[0]]
+    ]
+    if failed:
+        print("Query counts grow with the length of the queue for:", *failed)
+        sys.exit(1)
+
+
+@manager.command
+@not_in_production
+def benchmark_next_ticket():
+    """Times picking the next ticket for a staff member, against freshly seeded SQLite
+    databases with the same active queue but increasing numbers of resolved and
+    deleted tickets, and fails if it takes more than one query.
+    """
+    from flask_login import login_user
+
+    from oh_queue.views import find_next_ticket
+
+    history_lengths = [0, 10000]
+    num_calls = 200
+
+    queries = []
+
+    def count_query(*args):
+        queries.append(args)
+
+    with tempfile.TemporaryDirectory() as directory:
+        for num_history in history_lengths:
+            app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///{}/{}.db".format(
+                directory, num_history
+            )
+            db.create_all()
+            seed_queue(50)
+            staff = User.query.filter_by(is_staff=True).all()
+            students = User.query.filter_by(is_staff=False).all()
+            ticket = Ticket.query.first()
+            start_time = datetime.datetime.now() - datetime.timedelta(days=100)
+            db.session.bulk_insert_mappings(
+                Ticket,
+                [
+                    dict(
+                        user_id=random.choice(students).id,
+                        helper_id=random.choice(staff).id,
+                        status=random.choice(
+                            [TicketStatus.resolved, TicketStatus.deleted]
+                        ),
+                        sort_key=start_time + datetime.timedelta(minutes=i),
+                        assignment_id=ticket.assignment_id,
+                        location_id=ticket.location_id,
+                        question=str(i),
+                        course=get_course(),
+                    )
+                    for i in range(num_history)
+                ],
+            )
+            db.session.commit()
+
+            with app.test_request_context():
+                login_user(staff[0])
+                event.listen(db.engine, "before_cursor_execute", count_query)
+                queries.clear()
+                start = time.time()
+                for _ in range(num_calls):
+                    find_next_ticket()
+                elapsed = time.time() - start
+                event.remove(db.engine, "before_cursor_execute", count_query)
+            print(
+                "{:>5} resolved tickets: {:.0f} queries in {:.2f}ms per call".format(
+                    num_history, len(queries) / num_calls, elapsed / num_calls * 1000
+                )
+            )
+            db.session.remove()
+            if len(queries) > num_calls:
+                print("Picking the next ticket takes more than one query")
+                sys.exit(1)
+
+
 @manager.command
 @not_in_production
 def resetdb():
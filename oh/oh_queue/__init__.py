@@ -17,6 +17,7 @@ from oh_queue.models import (
     TicketStatus,
 )
 from oh_queue.slack import worker
+from oh_queue.updates import prune_updates, publish_update
 
 logging.basicConfig(level=logging.INFO)
 
@@ -44,6 +45,7 @@ def slack_poll():
 @job(app, "clear_inactive_groups")
 def clear_inactive_groups():
     active_groups = Group.query.filter_by(group_status=GroupStatus.active).all()
+    courses = set()
     for group in active_groups:
         for attendance in group.attendees:
             if (
@@ -55,7 +57,15 @@ def clear_inactive_groups():
                 break
         else:
             oh_queue.views.delete_group_worker(group, emit=False)
+            courses.add(group.course)
     db.session.commit()
+    for course in courses:
+        publish_update(course, "state", attrs=["groups", "tickets"])
+
+
+@job(app, "prune_state_updates")
+def prune_state_updates():
+    prune_updates()
 
 
 # Caching
@@ -145,6 +145,12 @@ class Ticket(db.Model):
     call_url = db.Column(db.String(255))
     doc_url = db.Column(db.String(255))
 
+    __table_args__ = (
+        # for picking the next ticket from the queue
+        db.Index("ix_ticket_course_status_sort_key", "course", "status", "sort_key"),
+        db.Index("ix_ticket_course_helper_id_status", "course", "helper_id", "status"),
+    )
+
     @classmethod
     def for_user(cls, user):
         if user and user.is_authenticated:
@@ -327,6 +333,41 @@ class ChatMessage(db.Model):
     course = db.Column(db.String(255), nullable=False, index=True)
 
 
+class StateUpdate(db.Model):
+    """Represents a change to the state of the queue that is pushed to connected clients.
+    Its version is the version of the state of its course once the change is made.
+    """
+
+    __tablename__ = "state_update"
+    id = db.Column(db.Integer, primary_key=True)
+    created = db.Column(db.DateTime, default=db.func.now(), index=True)
+    version = db.Column(db.Integer, nullable=False)
+
+    kind = db.Column(db.String(255), nullable=False)
+    event_type = db.Column(db.String(255))
+    entity_id = db.Column(db.Integer)
+    attrs = db.Column(db.String(255), nullable=False, default="")
+
+    course = db.Column(db.String(255), nullable=False, index=True)
+
+    __table_args__ = (
+        db.Index("ix_state_update_course_version", "course", "version", unique=True),
+    )
+
+
+class StateVersion(db.Model):
+    """The latest version of the state of a course. Its row stays locked from when an
+    update is given the next version until the update is committed, so that updates are
+    committed in the order of their versions.
+    """
+
+    __tablename__ = "state_version"
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    course = db.Column(db.String(255), nullable=False, unique=True)
+
+
 class CourseNotificationState(db.Model):
     __tablename__ = "notification_state"
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,123 @@
+import datetime
+import threading
+
+from sqlalchemy import bindparam, or_
+
+from oh_queue.models import User, db
+
+# how long after their last heartbeat users are counted as present
+PRESENCE_WINDOW = datetime.timedelta(seconds=30)
+
+# how often heartbeats are written to the database, and read back from other workers
+FLUSH_INTERVAL = datetime.timedelta(seconds=5)
+
+
+class PresenceTracker:
+    """Keeps the heartbeats of the users seen in the last PRESENCE_WINDOW in memory, so
+    that presence can be counted without querying the database. Rather than being written
+    one at a time, heartbeats are written to the user table in a single batch every
+    FLUSH_INTERVAL, at which point the heartbeats written by other workers are read back.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user ID -> (heartbeat time, course, is staff, email, name)
+        self.heartbeats = {}
+        # user ID -> heartbeat time not yet written to the database
+        self.pending = {}
+        self.last_flush = datetime.datetime.min
+
+    def beat(self, user):
+        now = datetime.datetime.utcnow()
+        with self.lock:
+            self.heartbeats[user.id] = (
+                now,
+                user.course,
+                user.is_staff,
+                user.email,
+                user.name,
+            )
+            self.pending[user.id] = now
+
+    def flush_if_due(self):
+        now = datetime.datetime.utcnow()
+        with self.lock:
+            if now - self.last_flush < FLUSH_INTERVAL:
+                return
+            self.last_flush = now
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if pending:
+            try:
+                # another worker may have written a newer heartbeat, which must not be undone
+                db.session.execute(
+                    User.__table__.update()
+                    .where(User.id == bindparam("user_id_"))
+                    .where(
+                        or_(
+                            User.heartbeat_time == None,
+                            User.heartbeat_time < bindparam("heartbeat_time_"),
+                        )
+                    )
+                    .values(heartbeat_time=bindparam("heartbeat_time_")),
+                    [
+                        {"user_id_": user_id, "heartbeat_time_": heartbeat_time}
+                        for user_id, heartbeat_time in pending.items()
+                    ],
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # keep the heartbeats that failed, unless newer ones have arrived
+                with self.lock:
+                    self.pending = {**pending, **self.pending}
+                raise
+
+        cutoff = datetime.datetime.utcnow() - PRESENCE_WINDOW
+        recent = (
+            db.session.query(
+                User.id,
+                User.heartbeat_time,
+                User.course,
+                User.is_staff,
+                User.email,
+                User.name,
+            )
+            .filter(User.heartbeat_time > cutoff)
+            .all()
+        )
+        with self.lock:
+            for user_id, *heartbeat in recent:
+                if (
+                    user_id not in self.heartbeats
+                    or self.heartbeats[user_id][0] < heartbeat[0]
+                ):
+                    self.heartbeats[user_id] = tuple(heartbeat)
+            self.heartbeats = {
+                user_id: heartbeat
+                for user_id, heartbeat in self.heartbeats.items()
+                if heartbeat[0] > cutoff
+            }
+
+    def get_present(self, course):
+        """Returns the number of students of course who are present,
+        and the set of (email, name) of its staff who are present.
+        """
+        cutoff = datetime.datetime.utcnow() - PRESENCE_WINDOW
+        with self.lock:
+            heartbeats = list(self.heartbeats.values())
+        students = 0
+        staff = set()
+        for heartbeat_time, user_course, is_staff, email, name in heartbeats:
+            if heartbeat_time > cutoff and user_course == course:
+                if is_staff:
+                    staff.add((email, name))
+                else:
+                    students += 1
+        return students, staff
+
+
+presence = PresenceTracker()
@@ -13,6 +13,7 @@ from oh_queue.models import (
     db,
     ConfigEntry,
 )
+from oh_queue.updates import publish_update
 
 
 def make_send(course):
@@ -29,6 +30,7 @@ def worker(app):
         course_notif_states: List[
             CourseNotificationState
         ] = CourseNotificationState.query.all()
+        resolved_courses = set()
         for notif_state in course_notif_states:
             queue_url = "https://{}".format(notif_state.domain)
             course = notif_state.course
@@ -125,6 +127,7 @@ def worker(app):
                                 "wasn't hidden."
                             )
                         appointment.status = AppointmentStatus.resolved
+                        resolved_courses.add(course)
                     appointment.num_reminders_sent += 1
 
             if (
@@ -141,6 +144,8 @@ def worker(app):
                     send_appointment_summary(course)
 
         db.session.commit()
+        for course in resolved_courses:
+            publish_update(course, "state", attrs=["appointments"])
 
 
 def send_appointment_summary(course):
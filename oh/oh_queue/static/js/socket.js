@@ -31,15 +31,107 @@ async function post(endpoint, data, skipTimeout) {
   return timeoutPromise(10000, promise).then((resp) => resp.json());
 }
 
+// how long to wait before reloading the state after losing the connection
+const RECONNECT_DELAY = 5000;
+
+// must be longer than LONG_POLL_TIMEOUT on the server
+const LONG_POLL_REQUEST_TIMEOUT = 30000;
+
 class Socket {
   constructor() {
-    setInterval(
-      () => this.emit("connect", { url: window.location.href }),
-      10000
-    );
     this.handlers = new Map();
     this.jobs = [];
-    this.emit("connect", { url: window.location.href });
+    this.version = null;
+    this.stream = null;
+    this.subscription = 0;
+    this.reconnectTimeout = null;
+    this.useLongPoll = !window.EventSource;
+    this.reconnect();
+  }
+
+  reconnect() {
+    // load the full state, unless it has not changed since the version we have,
+    // then listen for the updates made since that version
+    this.unsubscribe();
+    const subscription = this.subscription;
+    const request = { url: window.location.href, version: this.version };
+    this.emit("connect", request, ({ version }) => {
+      if (subscription === this.subscription) {
+        this.subscribe(version);
+      }
+    });
+  }
+
+  scheduleReconnect() {
+    this.unsubscribe();
+    this.trigger("disconnect");
+    this.reconnectTimeout = setTimeout(() => this.reconnect(), RECONNECT_DELAY);
+  }
+
+  subscribe(version) {
+    this.version = version;
+    if (this.useLongPoll) {
+      this.poll(this.subscription);
+      return;
+    }
+    let received = false;
+    this.stream = new EventSource(`/api/updates?version=${version}`);
+    this.stream.onmessage = (e) => {
+      received = true;
+      const { updates, ...action } = JSON.parse(e.data);
+      this.receive(action, updates);
+    };
+    this.stream.onerror = () => {
+      if (!received) {
+        // the stream may be blocked by a proxy, so fall back to long-polling
+        this.useLongPoll = true;
+      }
+      this.scheduleReconnect();
+    };
+  }
+
+  unsubscribe() {
+    clearTimeout(this.reconnectTimeout);
+    this.subscription++;
+    if (this.stream) {
+      this.stream.close();
+      this.stream = null;
+    }
+  }
+
+  poll(subscription) {
+    timeoutPromise(
+      LONG_POLL_REQUEST_TIMEOUT,
+      post("/api/poll", { version: this.version }, true)
+    )
+      .then((resp) => resp.json())
+      .then(({ action, updates }) => {
+        if (subscription === this.subscription) {
+          this.receive(action, updates);
+          if (!action.resync) {
+            this.poll(subscription);
+          }
+        }
+      })
+      .catch((e) => {
+        console.error(e);
+        if (subscription === this.subscription) {
+          this.scheduleReconnect();
+        }
+      });
+  }
+
+  receive({ version, resync }, updates = []) {
+    if (resync) {
+      // we missed some updates, so reload the full state
+      this.reconnect();
+      return;
+    }
+    this.version = version;
+    this.trigger("connect");
+    for (const [event, payload] of updates) {
+      this.trigger(event, payload);
+    }
   }
 
   on(event, handler) {
@@ -91,7 +183,11 @@ class Socket {
       })
       .catch((e) => {
         console.error(e);
-        this.trigger("disconnect");
+        if (event === "connect") {
+          this.scheduleReconnect();
+        } else {
+          this.trigger("disconnect");
+        }
       });
   }
 }
@@ -0,0 +1,220 @@
+import datetime
+import threading
+import time
+
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+
+from oh_queue.models import StateUpdate, StateVersion, db
+
+# how often each worker checks for updates published by the other workers
+POLL_INTERVAL = 1
+
+# how long published updates are kept around for clients that fall behind
+RETENTION = datetime.timedelta(hours=1)
+
+
+class UpdateWatcher:
+    """Tracks the latest published version of each course, so that requests waiting
+    for new updates can sleep until one arrives, rather than each querying the database.
+    Updates published by this worker wake up waiting requests immediately, and updates
+    published by other workers are picked up by a background thread within POLL_INTERVAL
+    seconds. The thread only runs while some request is waiting.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.versions = {}
+        self.waiting = 0
+        self.thread = None
+
+    def notify(self, course, version):
+        with self.condition:
+            if version > self.versions.get(course, 0):
+                self.versions[course] = version
+                self.condition.notify_all()
+
+    def wait(self, course, since, timeout):
+        """Waits until course has a version newer than since, or until timeout seconds
+        have passed, and returns the latest version of course.
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            self.waiting += 1
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.run, args=[current_app._get_current_object()]
+                )
+                self.thread.daemon = True
+                self.thread.start()
+            try:
+                while self.versions.get(course, 0) <= since:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                return self.versions.get(course, 0)
+            finally:
+                self.waiting -= 1
+
+    def run(self, app):
+        while True:
+            with self.condition:
+                if not self.waiting:
+                    self.thread = None
+                    return
+            try:
+                with app.app_context():
+                    versions = db.session.query(
+                        StateVersion.course, StateVersion.version
+                    ).all()
+            except Exception:
+                app.logger.exception("Unable to check for state updates")
+            else:
+                for course, version in versions:
+                    self.notify(course, version)
+            time.sleep(POLL_INTERVAL)
+
+
+watcher = UpdateWatcher()
+
+
+class SnapshotCache:
+    """Caches the serialized sections of the state of each course, so that they are only
+    built once per version of the course and then shared between every user who may see
+    them. Only the sections for the latest version seen of each course are kept.
+    While a section is being built, other requests for it wait for that build to finish.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}
+        self.building = {}
+
+    def lookup(self, course, version, key):
+        cached_version, sections = self.snapshots.get(course, (None, {}))
+        if cached_version == version and key in sections:
+            return True, sections[key]
+        return False, None
+
+    def get(self, course, version, key, build):
+        with self.lock:
+            found, value = self.lookup(course, version, key)
+            if found:
+                return value
+            build_lock = self.building.setdefault(
+                (course, version, key), threading.Lock()
+            )
+        with build_lock:
+            with self.lock:
+                found, value = self.lookup(course, version, key)
+            if found:
+                return value
+            try:
+                value = build()
+                with self.lock:
+                    cached_version, sections = self.snapshots.get(course, (None, {}))
+                    if cached_version is None or version > cached_version:
+                        self.snapshots[course] = (version, {key: value})
+                    elif version == cached_version:
+                        sections[key] = value
+            finally:
+                with self.lock:
+                    self.building.pop((course, version, key), None)
+        return value
+
+
+snapshots = SnapshotCache()
+
+
+def next_version(course):
+    """Returns the next version of course. Its StateVersion row stays locked until the
+    session is committed, so concurrent updates to course are committed in version order.
+    """
+    counter = (
+        StateVersion.query.filter_by(course=course).with_for_update().one_or_none()
+    )
+    if counter is None:
+        try:
+            with db.session.begin_nested():
+                counter = StateVersion(course=course, version=0)
+                db.session.add(counter)
+        except IntegrityError:
+            # another worker published the first update to course at the same time
+            counter = (
+                StateVersion.query.filter_by(course=course).with_for_update().one()
+            )
+    counter.version += 1
+    return counter.version
+
+
+def publish_update(course, kind, *, event_type=None, entity_id=None, attrs=()):
+    """Records a change to the state of course that connected clients need to load,
+    and commits the session. kind is the name of the event that clients receive,
+    and the update is serialized for clients when it is sent.
+    """
+    version = next_version(course)
+    db.session.add(
+        StateUpdate(
+            version=version,
+            kind=kind,
+            event_type=event_type,
+            entity_id=entity_id,
+            attrs=",".join(attrs),
+            course=course,
+        )
+    )
+    db.session.commit()
+    watcher.notify(course, version)
+    return version
+
+
+def get_version(course):
+    return (
+        db.session.query(StateVersion.version)
+        .filter(StateVersion.course == course)
+        .scalar()
+        or 0
+    )
+
+
+def load_updates(course, since, version):
+    """Returns the updates to course published after version since, up to and including
+    version, keeping only the last update to each entity and merging all the state
+    updates into one, or None if some of those updates have been pruned.
+    """
+    if since and not StateUpdate.query.filter_by(course=course, version=since).count():
+        return None
+    updates = {}
+    for update in (
+        StateUpdate.query.filter(
+            StateUpdate.course == course,
+            StateUpdate.version > since,
+            StateUpdate.version <= version,
+        )
+        .order_by(StateUpdate.version)
+        .all()
+    ):
+        key = (update.kind, update.entity_id)
+        attrs = set(update.attrs.split(",")) if update.attrs else set()
+        if key in updates:
+            attrs |= updates.pop(key)[1]
+        updates[key] = (update.event_type, attrs)
+    return [
+        (kind, event_type, entity_id, sorted(attrs))
+        for (kind, entity_id), (event_type, attrs) in updates.items()
+    ]
+
+
+def prune_updates():
+    """Deletes the updates older than RETENTION, except for the latest update to each
+    course, so that clients that are up to date never need to reload the full state.
+    """
+    cutoff = datetime.datetime.utcnow() - RETENTION
+    for course, version in db.session.query(StateVersion.course, StateVersion.version):
+        StateUpdate.query.filter(
+            StateUpdate.course == course,
+            StateUpdate.created < cutoff,
+            StateUpdate.version < version,
+        ).delete(synchronize_session=False)
+    db.session.commit()
@@ -1,11 +1,18 @@
 import datetime
 import functools
+import json
 import random
 import time
-from operator import or_
 from urllib.parse import urljoin, urlparse
 
-from flask import g, jsonify, render_template, request
+from flask import (
+    Response,
+    g,
+    jsonify,
+    render_template,
+    request,
+    stream_with_context,
+)
 from flask_login import current_user, login_user
 from oh_queue import app, db
 from oh_queue.models import (
@@ -30,10 +37,18 @@ from oh_queue.models import (
     active_statuses,
     get_current_time,
 )
+from oh_queue.presence import presence
 from oh_queue.slack import send_appointment_summary
 from oh_queue.reminders import send_appointment_reminder
-from sqlalchemy import desc, func
-from sqlalchemy.orm import joinedload
+from oh_queue.updates import (
+    get_version,
+    load_updates,
+    publish_update,
+    snapshots,
+    watcher,
+)
+from sqlalchemy import and_, case, desc, func, or_
+from sqlalchemy.orm import joinedload, lazyload, selectinload
 
 from common.course_config import (
     format_coursecode,
@@ -44,6 +59,12 @@ from common.course_config import (
 from common.rpc.auth import post_slack_message, read_spreadsheet, validate_secret
 from common.url_for import url_for
 
+# how often streaming clients are marked as present, and sent the presence
+HEARTBEAT_INTERVAL = 10
+
+# how long a long-polling client waits for updates before polling again
+LONG_POLL_TIMEOUT = 20
+
 
 def user_json(user):
     return {
@@ -205,6 +226,39 @@ def group_attendance_json(attendance: GroupAttendance):
     }
 
 
+# Loader options that fetch everything read by the serializers above, so that any
+# number of entities can be serialized with a constant number of queries.
+# Collections are loaded with one extra query each, rather than joined, so that
+# the rows of the main query are not multiplied by the size of each collection.
+# The messages backrefs only exist once the mappers are configured.
+db.configure_mappers()
+
+MESSAGE_LOADERS = [joinedload(ChatMessage.user)]
+
+GROUP_LOADERS = [
+    selectinload(Group.attendees).joinedload(GroupAttendance.user),
+    selectinload(Group.messages).options(*MESSAGE_LOADERS),
+]
+
+TICKET_LOADERS = [
+    joinedload(Ticket.user, innerjoin=True),
+    joinedload(Ticket.helper),
+    selectinload(Ticket.messages).options(*MESSAGE_LOADERS),
+    # ticket_json only needs the group's ID
+    selectinload(Ticket.group).options(
+        lazyload(Group.attendees), lazyload(Group.messages)
+    ),
+]
+
+APPOINTMENT_LOADERS = [
+    joinedload(Appointment.helper),
+    selectinload(Appointment.signups).joinedload(
+        AppointmentSignup.user, innerjoin=True
+    ),
+    selectinload(Appointment.messages).options(*MESSAGE_LOADERS),
+]
+
+
 def add_response(event, payload):
     g.response_buffer.append([event, payload])
 
@@ -214,12 +268,20 @@ def emit_event(ticket, event_type):
         event_type=event_type, ticket=ticket, user=current_user, course=get_course()
     )
     db.session.add(ticket_event)
-    db.session.commit()
+    publish_update(
+        get_course(), "event", event_type=event_type.name, entity_id=ticket.id
+    )
     add_response("event", {"type": event_type.name, "ticket": ticket_json(ticket)})
 
 
 def emit_appointment_event(appointment, event_type):
     # TODO: log to db
+    publish_update(
+        get_course(),
+        "appointment_event",
+        event_type=event_type,
+        entity_id=appointment.id,
+    )
     add_response(
         "appointment_event",
         {"type": event_type, "appointment": appointments_json(appointment)},
@@ -227,105 +289,225 @@ def emit_appointment_event(appointment, event_type):
 
 
 def emit_group_event(group, event_type):
+    publish_update(
+        get_course(), "group_event", event_type=event_type, entity_id=group.id
+    )
     add_response("group_event", {"type": event_type, "group": group_json(group)})
 
 
-def emit_state(attrs, entity=None):
+def ticket_entry(ticket):
+    """Returns (owner ID, staff JSON, public JSON) for ticket, which can be shared
+    between users and then passed to visible_ticket_json for each of them.
+    """
+    staff_json = dict(ticket_json(ticket), user=user_json(ticket.user))
+    public_json = staff_json if ticket.group else dict(staff_json, user=None)
+    return ticket.user_id, staff_json, public_json
+
+
+def visible_ticket_json(user_id, staff_json, public_json):
+    if current_user.is_authenticated and (
+        current_user.is_staff or current_user.id == user_id
+    ):
+        return staff_json
+    return public_json
+
+
+def load_tickets():
+    """Returns the ticket_entry for each active ticket."""
+    tickets = (
+        Ticket.query.filter(
+            Ticket.status.in_(active_statuses), Ticket.course == get_course()
+        )
+        .options(*TICKET_LOADERS)
+        .all()
+    )
+    return [ticket_entry(ticket) for ticket in tickets]
+
+
+def load_appointments():
+    appointments = (
+        Appointment.query.filter(
+            Appointment.status != AppointmentStatus.resolved,
+            Appointment.course == get_course(),
+        )
+        .order_by(Appointment.id)
+        .options(*APPOINTMENT_LOADERS)
+        .all()
+    )
+    return [appointments_json(appointment) for appointment in appointments]
+
+
+def load_groups():
+    groups = (
+        Group.query.filter(
+            Group.group_status == GroupStatus.active, Group.course == get_course()
+        )
+        .options(*GROUP_LOADERS)
+        .all()
+    )
+    return [group_json(group) for group in groups]
+
+
+def load_assignments():
+    assignments = Assignment.query.filter_by(course=get_course()).all()
+    return [assignment_json(assignment) for assignment in assignments]
+
+
+def load_locations():
+    locations = Location.query.filter(
+        Location.course == get_course(), Location.name != "Online"
+    ).all()
+    return [location_json(location) for location in locations] + [
+        location_json(get_online_location())
+    ]
+
+
+def load_helpers():
+    """Returns the (email, name) of the staff helping with active tickets."""
+    return {
+        (email, name)
+        for email, name in db.session.query(User.email, User.name)
+        .join(Ticket, Ticket.helper_id == User.id)
+        .filter(Ticket.status.in_(active_statuses), Ticket.course == get_course())
+        .distinct()
+    }
+
+
+def emit_state(attrs, entity=None, *, version=None):
+    """Adds the requested sections of the state to the response. The sections that do
+    not depend on the current user are built once per version and shared between users.
+    """
+    course = get_course()
+    if version is None:
+        version = get_version(course)
     state = {}
     if "tickets" in attrs:
-        tickets = (
-            Ticket.query.filter(
-                Ticket.status.in_(active_statuses), Ticket.course == get_course()
-            )
-            .options(joinedload(Ticket.user, innerjoin=True))
-            .options(joinedload(Ticket.helper))
-            .options(joinedload(Ticket.group))
-            .all()
-        )
-        if entity not in tickets and isinstance(entity, Ticket):
+        state["tickets"] = [
+            visible_ticket_json(*entry)
+            for entry in snapshots.get(course, version, "tickets", load_tickets)
+        ]
+        if isinstance(entity, Ticket) and entity.status not in active_statuses:
             if has_ticket_access(entity):
-                tickets.append(entity)
-        state["tickets"] = [ticket_json(ticket) for ticket in tickets]
+                state["tickets"].append(ticket_json(entity))
     if "assignments" in attrs:
-        assignments = Assignment.query.filter_by(course=get_course()).all()
-        state["assignments"] = [
-            assignment_json(assignment) for assignment in assignments
-        ]
+        state["assignments"] = snapshots.get(
+            course, version, "assignments", load_assignments
+        )
     if "locations" in attrs:
-        locations = Location.query.filter(
-            Location.course == get_course(), Location.name != "Online"
-        ).all()
-        state["locations"] = [location_json(location) for location in locations]
-        state["locations"].append(location_json(get_online_location()))
+        state["locations"] = snapshots.get(course, version, "locations", load_locations)
     if "config" in attrs:
-        state["config"] = config_json()
+        state["config"] = snapshots.get(course, version, "config", config_json)
     if "appointments" in attrs:
-        appointments = (
-            Appointment.query.filter(
-                Appointment.status != AppointmentStatus.resolved,
-                Appointment.course == get_course(),
-            )
-            .order_by(Appointment.id)
-            .options(joinedload(Appointment.helper))
-            .options(
-                joinedload(Appointment.signups).joinedload(
-                    AppointmentSignup.user, innerjoin=True
-                )
-            )
-            .all()
+        state["appointments"] = snapshots.get(
+            course, version, "appointments", load_appointments
         )
-        if entity not in appointments and isinstance(entity, Appointment):
+        if (
+            isinstance(entity, Appointment)
+            and entity.status == AppointmentStatus.resolved
+        ):
             if current_user.is_staff or current_user.id in [
                 signup.user.id for signup in entity.signups
             ]:
-                appointments.append(entity)
-
-        state["appointments"] = [
-            appointments_json(appointment) for appointment in appointments
-        ]
+                state["appointments"] = state["appointments"] + [
+                    appointments_json(entity)
+                ]
     if "groups" in attrs:
-        groups = Group.query.filter(
-            Group.group_status == GroupStatus.active, Group.course == get_course()
-        ).all()
-        if entity not in groups and isinstance(entity, Group):
+        state["groups"] = snapshots.get(course, version, "groups", load_groups)
+        if isinstance(entity, Group) and entity.group_status != GroupStatus.active:
             if has_group_access(entity):
-                groups.append(entity)
-        state["groups"] = [group_json(group) for group in groups]
+                state["groups"] = state["groups"] + [group_json(entity)]
     if "current_user" in attrs:
         state["current_user"] = student_json(current_user)
     if "presence" in attrs:
-        out = dict(
-            students=User.query.filter(
-                User.heartbeat_time
-                > datetime.datetime.utcnow() - datetime.timedelta(seconds=30),
-                User.course == get_course(),
-                User.is_staff == False,
-            ).count()
+        presence.flush_if_due()
+        students, active_staff = presence.get_present(course)
+        active_staff |= snapshots.get(course, version, "helpers", load_helpers)
+        state["presence"] = dict(
+            students=students, staff=len(active_staff), staff_list=list(active_staff)
         )
-        active_staff = {
-            (t.helper.email, t.helper.name)
-            for t in Ticket.query.filter(
-                Ticket.status.in_(active_statuses),
-                Ticket.helper != None,
-                Ticket.course == get_course(),
-            ).all()
-        }
-        active_staff |= {
-            (user.email, user.name)
-            for user in User.query.filter(
-                User.heartbeat_time
-                > datetime.datetime.utcnow() - datetime.timedelta(seconds=30),
-                User.course == get_course(),
-                User.is_staff == True,
-            ).all()
-        }
-        out["staff"] = len(active_staff)
-        out["staff_list"] = list(active_staff)
-        state["presence"] = out
 
     add_response("state", state)
 
 
+def broadcast_state(attrs):
+    """Like emit_state, but also pushes the new state to all connected clients."""
+    publish_update(get_course(), "state", attrs=attrs)
+    emit_state(attrs)
+
+
+def load_serialized_updates(since, version):
+    """Returns the updates published after version since up to version as
+    (event, event type, data) entries that can be shared between users, with each
+    ticket as its ticket_entry, or None if some of those updates have been pruned.
+    """
+    updates = load_updates(get_course(), since, version)
+    if updates is None:
+        return None
+
+    def load(model, kind, loaders):
+        ids = [entity_id for event, _, entity_id, _ in updates if event == kind]
+        if not ids:
+            return {}
+        return {
+            entity.id: entity
+            for entity in model.query.filter(
+                model.id.in_(ids), model.course == get_course()
+            )
+            .options(*loaders)
+            .all()
+        }
+
+    tickets = load(Ticket, "event", TICKET_LOADERS)
+    appointments = load(Appointment, "appointment_event", APPOINTMENT_LOADERS)
+    groups = load(Group, "group_event", GROUP_LOADERS)
+
+    entries = []
+    for event, event_type, entity_id, attrs in updates:
+        if event == "event" and entity_id in tickets:
+            entries.append((event, event_type, ticket_entry(tickets[entity_id])))
+        elif event == "appointment_event" and entity_id in appointments:
+            entries.append(
+                (event, event_type, appointments_json(appointments[entity_id]))
+            )
+        elif event == "group_event" and entity_id in groups:
+            entries.append((event, event_type, group_json(groups[entity_id])))
+        elif event == "state":
+            entries.append((event, None, attrs))
+    return entries
+
+
+def emit_updates_since(since, version):
+    """Adds the updates published after version since up to version to the response,
+    and returns the new version of the client, or None if the client has fallen too far
+    behind and must reload the full state. The updates are serialized once per version
+    and shared, and only what the current user may see is picked for them.
+    """
+    # the client may have a version from another worker that this one has not seen yet
+    version = max(since, version)
+    entries = snapshots.get(
+        get_course(),
+        version,
+        ("updates", since),
+        lambda: load_serialized_updates(since, version),
+    )
+    if entries is None:
+        return None
+
+    for event, event_type, data in entries:
+        if event == "event":
+            add_response(
+                event, {"type": event_type, "ticket": visible_ticket_json(*data)}
+            )
+        elif event == "appointment_event":
+            add_response(event, {"type": event_type, "appointment": data})
+        elif event == "group_event":
+            add_response(event, {"type": event_type, "group": data})
+        elif event == "state":
+            emit_state(data, version=version)
+
+    return version
+
+
 def init_config():
     db.session.add(
         ConfigEntry(
@@ -642,7 +824,7 @@ def connect(data=None):
     if not current_user.is_authenticated:
         pass
 
-    current_user.heartbeat_time = datetime.datetime.utcnow()
+    heartbeat()
 
     entity_type = None
 
@@ -667,6 +849,14 @@ def connect(data=None):
     else:
         entity = None
 
+    # read the version first, so that updates made while loading the state are resent
+    version = get_version(get_course())
+
+    if entity is None and data and data.get("version") == version:
+        # the client already has the latest state
+        emit_state(["current_user", "presence"], version=version)
+        return {"version": version, "not_modified": True}
+
     emit_state(
         [
             "tickets",
@@ -679,9 +869,70 @@ def connect(data=None):
             "presence",
         ],
         entity,
+        version=version,
+    )
+
+    return {"version": version}
+
+
+def heartbeat():
+    if current_user.is_authenticated:
+        presence.beat(current_user)
+        presence.flush_if_due()
+
+
+@app.route("/api/updates")
+def stream_updates():
+    """Streams the updates published after the version given by the client,
+    as server-sent events, along with the presence every HEARTBEAT_INTERVAL seconds.
+    """
+    version = request.args.get("version", 0, type=int)
+    course = get_course()
+
+    def generate():
+        nonlocal version
+        next_heartbeat = time.time()
+        while True:
+            # end the transaction, so the connection goes back to the pool while waiting
+            db.session.commit()
+            latest = watcher.wait(course, version, next_heartbeat - time.time())
+            g.response_buffer = []
+            if latest != version:
+                version = emit_updates_since(version, latest)
+                if version is None:
+                    yield "data: {}\n\n".format(json.dumps({"resync": True}))
+                    return
+            if time.time() >= next_heartbeat:
+                heartbeat()
+                emit_state(["presence"])
+                next_heartbeat = time.time() + HEARTBEAT_INTERVAL
+            if g.response_buffer:
+                yield "data: {}\n\n".format(
+                    json.dumps({"version": version, "updates": g.response_buffer})
+                )
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"X-Accel-Buffering": "no"},
     )
 
 
+@api("poll")
+def poll(data):
+    """Long-polling fallback for clients that cannot use /api/updates."""
+    version = data["version"]
+    heartbeat()
+    emit_state(["presence"])
+    db.session.commit()
+    latest = watcher.wait(get_course(), version, LONG_POLL_TIMEOUT)
+    if latest != version:
+        version = emit_updates_since(version, latest)
+        if version is None:
+            return {"resync": True}
+    return {"version": version}
+
+
 def get_magic_word(mode=None, data=None, time_offset=0):
     if mode is None:
         mode = (
@@ -849,40 +1100,46 @@ def get_tickets(ticket_ids):
     ).all()
 
 
-def get_next_ticket(location=None):
+def find_next_ticket(location=None):
     """Return the user's first assigned but unresolved ticket.
-    If none exist, return the first pending student re-request.
-    If none exist, return to the first unassigned ticket.
+    If none exist, return the user's first pending re-request.
+    If none exist, return the first pending re-request that nobody is holding.
+    If none exist, return the first unassigned ticket.
 
-    If a location is passed in, only returns a next ticket from
+    If a location is passed in, only returns an unassigned ticket from
     provided location.
+
+    This is a single query over the active tickets of the course, which are
+    found through the ticket index on (course, status, sort_key).
     """
-    ticket = Ticket.query.filter(
-        Ticket.helper_id == current_user.id,
-        Ticket.status == TicketStatus.assigned,
-        Ticket.course == get_course(),
-    ).first()
-    if not ticket:
-        ticket = Ticket.query.filter(
-            Ticket.status == TicketStatus.rerequested,
-            Ticket.helper_id == current_user.id,
-            Ticket.course == get_course(),
-        ).order_by(Ticket.sort_key)
-        ticket = ticket.first()
-    if not ticket:
-        ticket = Ticket.query.filter(
-            Ticket.status == TicketStatus.rerequested,
-            Ticket.helper_id == None,
+    mine = Ticket.helper_id == current_user.id
+    assigned = and_(Ticket.status == TicketStatus.assigned, mine)
+    my_rerequest = and_(Ticket.status == TicketStatus.rerequested, mine)
+    free_rerequest = and_(
+        Ticket.status == TicketStatus.rerequested, Ticket.helper_id == None
+    )
+    pending = Ticket.status == TicketStatus.pending
+    if location:
+        pending = and_(pending, Ticket.location_id == location.id)
+    return (
+        Ticket.query.filter(
             Ticket.course == get_course(),
-        ).order_by(Ticket.sort_key)
-        ticket = ticket.first()
-    if not ticket:
-        ticket = Ticket.query.filter(
-            Ticket.status == TicketStatus.pending, Ticket.course == get_course()
-        ).order_by(Ticket.sort_key)
-        if location:
-            ticket = ticket.filter(Ticket.location == location)
-        ticket = ticket.first()
+            Ticket.status.in_(
+                [TicketStatus.assigned, TicketStatus.rerequested, TicketStatus.pending]
+            ),
+            or_(assigned, my_rerequest, free_rerequest, pending),
+        )
+        .order_by(
+            case([(assigned, 0), (my_rerequest, 1), (free_rerequest, 2)], else_=3),
+            Ticket.sort_key,
+        )
+        .options(lazyload(Ticket.messages))
+        .first()
+    )
+
+
+def get_next_ticket(location=None):
+    ticket = find_next_ticket(location)
     if ticket:
         return socket_redirect(ticket_id=ticket.id)
     else:
@@ -1115,7 +1372,7 @@ def update_tickets(arr):
     for data in arr:
         apply_ticket_update(data, ticket_dict[data["id"]])
     db.session.commit()
-    return emit_state(["tickets"])
+    return broadcast_state(["tickets"])
 
 
 @api("add_assignment")
@@ -1126,7 +1383,7 @@ def add_assignment(data):
     db.session.add(assignment)
     db.session.commit()
 
-    emit_state(["assignments"])
+    broadcast_state(["assignments"])
     db.session.refresh(assignment)
     return assignment_json(assignment)
 
@@ -1141,7 +1398,7 @@ def update_assignment(data):
         assignment.visible = data["visible"]
     db.session.commit()
 
-    emit_state(["assignments"])
+    broadcast_state(["assignments"])
     return assignment_json(assignment)
 
 
@@ -1155,7 +1412,7 @@ def add_location(data):
     db.session.add(location)
     db.session.commit()
 
-    emit_state(["locations"])
+    broadcast_state(["locations"])
     db.session.refresh(location)
     return location_json(location)
 
@@ -1179,7 +1436,7 @@ def update_location(data):
         return
     db.session.commit()
 
-    emit_state(["locations"])
+    broadcast_state(["locations"])
     return location_json(location)
 
 
@@ -1201,7 +1458,7 @@ def update_config(data):
         entry.value = value
     db.session.commit()
 
-    emit_state(["config", "locations"])
+    broadcast_state(["config", "locations"])
 
     return config_json()
 
@@ -1457,7 +1714,7 @@ def delete_appointment(appointment_id):
     db.session.delete(appointment)
     db.session.commit()
 
-    emit_state(["appointments"])
+    broadcast_state(["appointments"])
 
 
 @api("upload_appointments")
@@ -1523,7 +1780,7 @@ def upload_appointments(data):
         db.session.commit()
     except Exception as e:
         return socket_error("Internal Error:" + str(e))
-    emit_state(["appointments"])
+    broadcast_state(["appointments"])
 
 
 @api("update_staff_online_setup")
@@ -1542,7 +1799,7 @@ def update_staff_online_setup(data):
     db.session.commit()
 
     emit_state(["current_user"])
-    emit_state(["tickets", "appointments"])
+    broadcast_state(["tickets", "appointments"])
 
 
 @api("send_chat_message")
@@ -1648,7 +1905,7 @@ def bulk_appointment_action(data):
                 send_appointment_reminder(signup)
 
     db.session.commit()
-    emit_state(["appointments"])
+    broadcast_state(["appointments"])
 
 
 @api("list_users")
@@ -1669,9 +1926,7 @@ def get_user(user_id):
             Ticket.course == get_course(),
         )
         .order_by(desc(Ticket.created))
-        .options(joinedload(Ticket.user, innerjoin=True))
-        .options(joinedload(Ticket.helper))
-        .options(joinedload(Ticket.group))
+        .options(*TICKET_LOADERS)
         .all()
     )
     appointments = (
@@ -1679,12 +1934,7 @@ def get_user(user_id):
             Appointment.helper_id == user.id, Appointment.course == get_course()
         )
         .order_by(desc(Appointment.start_time))
-        .options(joinedload(Appointment.helper))
-        .options(
-            joinedload(Appointment.signups).joinedload(
-                AppointmentSignup.user, innerjoin=True
-            )
-        )
+        .options(*APPOINTMENT_LOADERS)
         .all()
     )
     signups = (
@@ -1693,9 +1943,7 @@ def get_user(user_id):
             AppointmentSignup.user_id == user.id, Appointment.course == get_course()
         )
         .options(
-            joinedload(AppointmentSignup.appointment).options(
-                joinedload(Appointment.helper)
-            )
+            joinedload(AppointmentSignup.appointment).options(*APPOINTMENT_LOADERS)
         )
         .order_by(desc(Appointment.start_time))
         .all()
@@ -1737,7 +1985,7 @@ def apply_appointment_update(data, appointment=None):
 def update_appointment(data):
     apply_appointment_update(data)
     db.session.commit()
-    return emit_state(["appointments"])
+    return broadcast_state(["appointments"])
 
 
 @api("update_appointments")
@@ -1751,7 +1999,7 @@ def update_appointments(arr):
     for data in arr:
         apply_appointment_update(data, appointment_dict[data["id"]])
     db.session.commit()
-    return emit_state(["appointments"])
+    return broadcast_state(["appointments"])
 
 
 @api("test_slack")
@@ -1963,7 +2211,7 @@ def update_groups(arr):
     for data in arr:
         apply_group_update(data, group_dict[data["id"]])
     db.session.commit()
-    return emit_state(["groups"])
+    return broadcast_state(["groups"])
 
 
 @api("create_group_ticket")